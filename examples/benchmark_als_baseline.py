@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of asymmetric least squares (ALS) baselines, as used to remove backgrounds from spectra.
+
+Spectra the size of a 1340-pixel CCD (noisy peaks on a curved background) are baselined with the sparse solve that
+used to be copied into each analysis module, and with the shared banded solver in
+nplab.analysis.background_removal.asymmetric_least_squares: one spectrum at a time, as a batch, and as a batch shared
+between worker processes.  Results are reported in spectra per second.
+"""
+from __future__ import print_function
+
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+from nplab.analysis.background_removal.asymmetric_least_squares import baseline_als
+
+LENGTH, LAM, P = 1340, 1e5, 0.01
+
+
+def sparse_baseline_als(y, lam, p, niter=10):
+    """The old implementation, with a dense L x L matrix to build the difference operator."""
+    L = len(y)
+    D = sparse.csc_matrix(np.diff(np.eye(L), 2))
+    w = np.ones(L)
+    for i in range(niter):
+        W = sparse.spdiags(w, 0, L, L)
+        Z = W + lam * D.dot(D.transpose())
+        z = spsolve(Z, w*y)
+        w = p * (y > z) + (1-p) * (y < z)
+    return z
+
+
+def make_spectra(n):
+    rng = np.random.RandomState(0)
+    x = np.linspace(0, 1, LENGTH)
+    return 100*np.exp(-x) + 50*np.exp(-((x - rng.uniform(0.2, 0.8, (n, 1)))/0.02)**2) + rng.normal(size=(n, LENGTH))
+
+
+def rate(name, function, spectra):
+    start = time.time()
+    result = function(spectra)
+    print("{}: {:.0f} spectra/s".format(name, len(spectra) / (time.time() - start)))
+    return result
+
+
+if __name__ == '__main__':
+    spectra = make_spectra(8192)
+    print("{} spectra of {} pixels, {} CPUs".format(len(spectra), LENGTH, os.cpu_count()))
+    old = rate("sparse solve (old)", lambda s: np.array([sparse_baseline_als(y, LAM, P) for y in s]), spectra[:50])
+    single = rate("banded solve, one at a time", lambda s: np.array([baseline_als(y, LAM, P) for y in s]),
+                  spectra[:1000])
+    batch = rate("banded solve, batch", lambda s: baseline_als(s, LAM, P), spectra)
+    rate("banded solve, batch in processes", lambda s: baseline_als(s, LAM, P, processes=None), spectra)
+    print("Largest difference from the old baselines: {:.2g}".format(np.max(np.abs(batch[:50] - old))))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of appending spectra to a resizable dataset.
+
+Compares Group.append_dataset (one resize and write per row) with an AppendBuffer (rows collected in memory and
+written in blocks), with and without crash-safe flushing, and reports rows per second.
+"""
+from __future__ import print_function
+
+import os
+import tempfile
+import time
+import numpy as np
+
+import nplab.datafile as df
+
+
+def rows_per_second(append, n_rows, row):
+    start = time.time()
+    for i in range(n_rows):
+        append(row)
+    return n_rows / (time.time() - start)
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    row = np.random.random(1044)
+    n_rows = 5000
+    f = df.DataFile(os.path.join(directory, "benchmark_append.h5"))
+
+    print("%-32s %12s" % ("method", "rows/s"))
+    rate = rows_per_second(lambda r: f.append_dataset("append_dataset", r, dtype=r.dtype), n_rows, row)
+    print("%-32s %12.0f" % ("append_dataset", rate))
+    for crash_safe in [True, False]:
+        name = "buffered_crash_safe" if crash_safe else "buffered"
+        with f.append_buffer(name, buffer_rows=64, crash_safe=crash_safe) as buffer:
+            rate = rows_per_second(buffer.append, n_rows, row)
+        print("%-32s %12.0f" % ("AppendBuffer, crash_safe=%s" % crash_safe, rate))
+    f.close()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of autofocus on a simulated microscope.
+
+A simulated camera images a random texture, blurred according to how far the stage is from focus, on a tilted sample.
+We visit a grid of "particles" and focus on each one, first with CameraWithLocation.autofocus (a fixed set of Z
+positions), then with search_autofocus (a coarse-to-fine search, which remembers where it found the focus nearby).
+The number of exposures per focus and the focus error are printed for each.
+"""
+from __future__ import print_function
+
+import time
+
+import cv2
+import numpy as np
+
+from nplab.instrument.camera import DummyCamera
+from nplab.instrument.camera.camera_with_location import CameraWithLocation
+from nplab.instrument.stage import DummyStage
+
+
+class SimulatedStage(DummyStage):
+    """A 3-axis stage that doesn't move anything."""
+    def __init__(self):
+        super(SimulatedStage, self).__init__()
+        self.axis_names = ('x', 'y', 'z')
+        self._position = np.zeros(3)
+
+    def move(self, position, axis=None, relative=False):
+        super(SimulatedStage, self).move(list(np.ravel(position)) if axis is None else position, axis, relative)
+
+
+def focal_plane(x, y):
+    """The Z position where the sample is in focus."""
+    return 0.05 * x - 0.03 * y + 0.3 * np.sin(x / 7.0)
+
+
+class SimulatedCamera(DummyCamera):
+    """A camera that sees a blurred texture, where the blur depends on the distance from the focal plane."""
+    def __init__(self, stage):
+        super(SimulatedCamera, self).__init__()
+        self.stage = stage
+        self.texture = (np.random.RandomState(0).random_sample((256, 256)) * 255).astype(np.float32)
+        self.exposures = 0
+
+    def raw_snapshot(self):
+        self.exposures += 1
+        x, y, z = self.stage.position
+        sigma = 0.5 + 1.5 * abs(z - focal_plane(x, y))
+        image = cv2.GaussianBlur(self.texture, (0, 0), sigma)
+        return True, np.repeat(image.astype(np.uint8)[:, :, np.newaxis], 3, axis=2)
+
+
+def run(cwl, focus_function, n=8, spacing=4.0):
+    """Focus on an n x n grid of points, returning (exposures per focus, RMS focus error, time per focus)."""
+    exposures, errors = [], []
+    start = time.time()
+    for x in np.arange(n) * spacing:
+        for y in np.arange(n) * spacing:
+            cwl.stage.move([x, y, cwl.stage.position[2]])
+            before = cwl.camera.exposures
+            focus_function()
+            exposures.append(cwl.camera.exposures - before)
+            errors.append(cwl.stage.position[2] - focal_plane(x, y))
+    return np.mean(exposures), np.sqrt(np.mean(np.square(errors))), (time.time() - start) / n ** 2
+
+
+if __name__ == '__main__':
+    stage = SimulatedStage()
+    cwl = CameraWithLocation(SimulatedCamera(stage), stage)
+    cwl.pixel_to_sample_displacement = np.identity(3)
+    cwl.af_steps = 9
+    cwl.af_step_size = 0.5
+    cwl.autofocus_engine.step = 0.5
+    results = dict()
+    results["autofocus (9 steps)"] = run(cwl, cwl.autofocus)
+    cwl.autofocus_engine.focus_map = None
+    results["search_autofocus, no focus map"] = run(cwl, cwl.search_autofocus)
+    cwl.autofocus_engine.roi_size = (100, 100)
+    results["search_autofocus, no focus map, 100px ROI"] = run(cwl, cwl.search_autofocus)
+    from nplab.instrument.camera.autofocus import FocusMap
+    cwl.autofocus_engine.focus_map = FocusMap(region_size=5.0)
+    results["search_autofocus, focus map, 100px ROI"] = run(cwl, cwl.search_autofocus)
+    print("NB each image also costs one discarded frame when the stage settles (frames_to_discard=1)")
+    for name, (exposures, error, t) in results.items():
+        print("{}: {:.1f} exposures per focus, RMS error {:.3f}, {:.1f} ms per focus".format(
+            name, exposures, error, t * 1000))
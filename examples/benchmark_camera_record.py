@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of recording a burst of frames from a camera.
+
+Compares saving frames one at a time with Camera.save_raw_image (which reads the metadata, creates a dataset and
+flushes the file for every frame) with Camera.record, which streams frames from live view into one dataset on a
+writer thread.  DummyCamera's live view is run as fast as it will go.
+"""
+from __future__ import print_function
+
+import os
+import tempfile
+import time
+
+import nplab.datafile as df
+from nplab.instrument.camera import DummyCamera
+
+
+if __name__ == '__main__':
+    n_frames = 500
+    camera = DummyCamera()
+    camera.live_view_interval = 0
+    camera.frame_buffer_size = 64
+    path = os.path.join(tempfile.mkdtemp(), "camera_record.h5")
+    df.set_current(df.DataFile(path))
+
+    start = time.time()
+    for i in range(n_frames // 5):
+        camera.save_raw_image(update_latest_frame=False)
+    print("save_raw_image: {:.0f} frames per second".format(n_frames // 5 / (time.time() - start)))
+
+    start = time.time()
+    group = camera.record(n_frames=n_frames)
+    elapsed = time.time() - start
+    print("record: {:.0f} frames per second sustained, {:.0f} including setup, {} frames dropped".format(
+        group.attrs['frames_per_second'], n_frames / elapsed, group.attrs['dropped_frames']))
+
+    start = time.time()
+    group = camera.record(n_frames=n_frames, crash_safe=True)
+    print("record (crash safe): {:.0f} frames per second sustained, {} frames dropped".format(
+        group.attrs['frames_per_second'], group.attrs['dropped_frames']))
+    df.current().close()
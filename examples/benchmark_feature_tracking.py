@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of finding a feature in a stream of 2048x2048 camera frames.
+
+A 128x128 feature is cut out of the first frame, and then located in frames where the sample has drifted by a
+fraction of a pixel each time.  We compare locate_feature_in_image (searching the whole image, and searching a
+restricted window) with a FeatureTracker, which searches a window around where it last found the feature.
+"""
+from __future__ import print_function
+
+import time
+
+import cv2
+import numpy as np
+
+from nplab.utils.image_with_location import ImageWithLocation, FeatureTracker, locate_feature_in_image
+
+SIZE = 2048
+texture = np.random.RandomState(0).random_sample((SIZE + 200, SIZE + 200)).astype(np.float32)
+texture = cv2.GaussianBlur(texture, (0, 0), 3)
+texture = (255 * (texture - texture.min()) / np.ptp(texture)).astype(np.uint8)
+
+
+def frame(dy, dx):
+    """An RGB camera frame, with the sample shifted by (dy, dx) pixels, plus some noise."""
+    shift = np.float32([[1, 0, dx], [0, 1, dy]])
+    image = cv2.warpAffine(texture, shift, texture.shape[::-1], flags=cv2.INTER_LINEAR)[100:SIZE + 100, 100:SIZE + 100]
+    image = np.clip(image + np.random.normal(0, 5, image.shape), 0, 255).astype(np.uint8)
+    image = ImageWithLocation(np.repeat(image[:, :, np.newaxis], 3, axis=2))
+    image.attrs['pixel_to_sample_matrix'] = np.identity(4)
+    return image
+
+
+def benchmark(name, locate, frames, truths):
+    start = time.time()
+    errors = [locate(f) - t for f, t in zip(frames, truths)]
+    print("{}: {:.1f} ms per frame, RMS error {:.2f} pixels".format(
+        name, (time.time() - start) / len(frames) * 1000, np.sqrt(np.mean(np.square(errors)))))
+
+
+if __name__ == '__main__':
+    centre = SIZE // 2
+    feature = frame(0, 0).feature_at((centre, centre), (128, 128))
+    drifts = [(0.7 * i, -0.45 * i) for i in range(20)]
+    frames = [frame(dy, dx) for dy, dx in drifts]
+    truths = [np.array([centre + dy, centre + dx]) for dy, dx in drifts]
+    benchmark("locate_feature_in_image, whole image",
+              lambda f: locate_feature_in_image(f, feature), frames[:3], truths[:3])
+    benchmark("locate_feature_in_image, 40 pixel margin",
+              lambda f: locate_feature_in_image(f, feature, margin=40, restrict=True), frames, truths)
+    tracker = FeatureTracker(feature, margin=40)
+    benchmark("FeatureTracker, 40 pixel margin", tracker.locate, frames, truths)
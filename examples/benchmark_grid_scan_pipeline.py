@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of a pipelined GridScan.
+
+Simulates a scan where each point takes a few ms to move to and acquire, and a few more to process and save, and
+compares the total time with and without a processing thread (GridScan.pipeline_depth).  The time spent in each
+stage of the scan is printed at the end of each scan.
+"""
+from __future__ import print_function
+
+import time
+
+from nplab.experiment.scanning_experiment import GridScan
+from nplab.instrument.stage import DummyStage
+
+
+class SlowGridScan(GridScan):
+    move_time = 0.002
+    acquire_time = 0.003
+    process_time = 0.004
+
+    def __init__(self):
+        super(SlowGridScan, self).__init__()
+        self.set_stage(DummyStage(), axes=['x1', 'y1'])
+        self.size_unit = 'nm'
+        self.step_unit = 'nm'
+        self.size[:] = 200
+        self.step[:] = 10
+
+    def move(self, position, axis):
+        time.sleep(self.move_time)
+        super(SlowGridScan, self).move(position, axis)
+
+    def scan_function(self, *indices):
+        self.process_data(self.acquire(*indices), *indices)
+
+    def acquire(self, *indices):
+        time.sleep(self.acquire_time)
+
+    def process_data(self, data, *indices):
+        time.sleep(self.process_time)
+
+
+if __name__ == '__main__':
+    for depth in [0, 1, 10]:
+        scan = SlowGridScan()
+        scan.pipeline_depth = depth
+        print("pipeline_depth = {}".format(depth))
+        start = time.time()
+        scan.scan(scan.axes, scan.size, scan.step, scan.init)
+        print("{:.2f} ms per point\n".format((time.time() - start) / scan.total_points * 1000))
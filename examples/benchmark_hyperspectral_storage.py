@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the storage modes of HyperspectralScan.
+
+Runs the same scan (with a dummy stage and a spectrometer that returns 16-bit counts straight away) saving processed
+and raw float64 cubes (the default), then only the raw counts (raw_only), with and without compression.  Reports
+the time taken to save each point and the size of the file.
+"""
+from __future__ import print_function
+
+import os
+import tempfile
+import numpy as np
+
+import nplab
+import nplab.datafile as df
+from nplab.experiment.hyperspectral_imaging import HyperspectralScan
+from nplab.experiment.scanning_experiment import GridScan
+from nplab.instrument.spectrometer import DummySpectrometer
+from nplab.instrument.stage import DummyStage
+
+
+class CountingSpectrometer(DummySpectrometer):
+    """A dummy spectrometer that returns counts straight away, like a real detector."""
+    def read_spectrum(self, bundle_metadata=False):
+        return np.random.poisson(1000, size=len(self.wavelengths)).astype(np.uint16)
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    for name, raw_only, compression in [("processed and raw, float64", False, None),
+                                        ("raw only", True, None),
+                                        ("raw only, gzip", True, 'gzip'),
+                                        ("raw only, lzf", True, 'lzf')]:
+        filename = os.path.join(directory, "{}.h5".format(name.replace(" ", "_").replace(",", "")))
+        nplab.datafile._current_datafile = df.DataFile(filename)
+        scan = HyperspectralScan()
+        scan.set_stage(DummyStage(), axes=['x1', 'y1'])
+        scan.size_unit = 'nm'
+        scan.step_unit = 'nm'
+        scan.size[:] = 490
+        scan.step[:] = 10
+        scan.set_spectrometers(CountingSpectrometer())
+        scan.raw_only = raw_only
+        scan.compression = compression
+        GridScan.run(scan)  # run the scan in a thread, without the Qt timer
+        scan.acquisition_thread.join()
+        process_time = scan.stage_timings['scan_function'] / scan.total_points
+        print("{}: {:.3f} ms per point, {:.1f} MB\n".format(name, process_time * 1000,
+                                                           os.path.getsize(filename) / 1e6))
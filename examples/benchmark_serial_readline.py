@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Loopback benchmark of SerialInstrument.readline.
+
+A block of replies (e.g. a dump of positions, one per line) is written to a pseudo-terminal and read back a line at
+a time, with the old reader (one ser.read(1) call per byte) and the buffered one (reading everything that's waiting,
+and keeping the rest for the next line).  Where there are no pseudo-terminals, pyserial's loop:// device is used
+instead, though as that passes data through a Python queue one byte at a time it hides most of the difference.
+"""
+from __future__ import print_function
+
+import os
+import time
+
+from nplab.instrument.serial_instrument import SerialInstrument
+
+
+class LoopbackInstrument(SerialInstrument):
+    port_settings = {'timeout': 0.1}
+    termination_character = "\r\n"
+
+
+def byte_by_byte_readline(instrument, timeout=10):
+    """The old implementation of SerialInstrument.readline, for comparison."""
+    eol = str.encode(instrument.termination_character)
+    leneol = len(eol)
+    line = bytearray()
+    start = time.time()
+    while time.time() - start < timeout:
+        c = instrument.ser.read(1)
+        if c:
+            line += c
+            if line[-leneol:] == eol:
+                break
+        else:
+            break
+    return line.decode().replace(instrument.termination_read, '\n')
+
+
+def open_loopback():
+    """Return an instrument, and a function that sends it a reply."""
+    try:
+        import pty
+        master, slave = pty.openpty()
+    except (ImportError, OSError):
+        instrument = LoopbackInstrument('loop://')
+        return instrument, instrument.ser.write
+    instrument = LoopbackInstrument(os.ttyname(slave))
+
+    def send(reply):
+        os.write(master, reply)
+        while instrument.ser.in_waiting < len(reply):  # make sure it's all arrived before we start timing
+            time.sleep(0.0001)
+    return instrument, send
+
+
+def time_per_line(readline, send, reply, lines, repeats=50):
+    """The time to read a line, not counting sending the reply."""
+    elapsed = 0
+    for i in range(repeats):
+        send(reply)
+        start = time.time()
+        for j in range(lines):
+            readline()
+        elapsed += time.time() - start
+    return elapsed / (repeats * lines)
+
+
+if __name__ == '__main__':
+    instrument, send = open_loopback()
+    print("Reading from {}".format(instrument.ser.port))
+    for lines, line in [(1, b"1 2 3"), (100, b"TP 12.345678 -3.210000 0.500000")]:
+        reply = b"".join([line + b"\r\n"] * lines)  # loop:// holds 4096 bytes at most
+        old = time_per_line(lambda: byte_by_byte_readline(instrument), send, reply, lines)
+        new = time_per_line(instrument.readline, send, reply, lines)
+        print("{} lines of {} bytes: {:.1f} us per line byte-by-byte, {:.1f} us buffered ({:.1f}x faster)".format(
+            lines, len(line) + 2, old * 1e6, new * 1e6, old / new))
+    instrument.close()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Loopback latency benchmark of remote instrument calls.
+
+Runs servers for a DummySpectrometer and a DummyCamera on localhost, and measures the round-trip time per call for:
+    text      - the text protocol, which opens a new TCP connection for every call
+    binary    - the binary protocol over the pooled persistent connection, one call at a time
+    pipelined - the binary protocol with many calls in flight at once (client.call_async)
+"""
+from __future__ import print_function
+
+import time
+
+import nplab.datafile
+from nplab.instrument.spectrometer import DummySpectrometer
+from nplab.instrument.camera import DummyCamera
+from nplab.instrument.server_instrument import create_server_class, create_client_class
+
+
+def time_per_call(function, n=500):
+    function()  # warm up
+    start = time.time()
+    for i in range(n):
+        function()
+    return (time.time() - start) / n
+
+
+def time_per_call_pipelined(client, method_name, args, n=500):
+    client.call_async(method_name, *args).result()  # warm up
+    start = time.time()
+    futures = [client.call_async(method_name, *args) for i in range(n)]
+    for future in futures:
+        future.result()
+    return (time.time() - start) / n
+
+
+if __name__ == '__main__':
+    nplab.datafile.set_temporary_current_datafile()  # the spectrometer wants a datafile, don't pop up a dialog
+    tests = [(DummySpectrometer, 'get_integration_time', ()),
+             (DummyCamera, 'get_camera_parameter', ('exposure',))]
+    print("%-20s %-24s %-10s %14s" % ("instrument", "call", "mode", "us per call"))
+    for instrument_class, method_name, args in tests:
+        server = create_server_class(instrument_class)(('localhost', 0))
+        server.run(with_gui=False, backgrounded=True)
+        client_class = create_client_class(instrument_class)
+        for mode in ['text', 'binary', 'pipelined']:
+            client = client_class(server.server_address, binary_transport=(mode != 'text'))
+            if mode == 'pipelined':
+                dt = time_per_call_pipelined(client, method_name, args)
+            else:
+                method = getattr(client, method_name)
+                dt = time_per_call(lambda: method(*args))
+            print("%-20s %-24s %-10s %14.1f" % (instrument_class.__name__, method_name, mode, dt * 1e6))
+        server.shutdown()
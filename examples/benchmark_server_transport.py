@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Loopback benchmark of the server_instrument transport.
+
+Runs a server for a trivial instrument on localhost and times how quickly a client can fetch camera frames and spectra
+of typical sizes, using the text (repr/literal_eval) and binary protocols.
+"""
+from __future__ import print_function
+
+import time
+import numpy as np
+
+from nplab.instrument import Instrument
+from nplab.instrument.server_instrument import create_server_class, create_client_class
+
+
+class BenchmarkInstrument(Instrument):
+    def __init__(self):
+        super(BenchmarkInstrument, self).__init__()
+        self.arrays = dict()
+
+    def get_array(self, name):
+        return self.arrays[name]
+
+
+SIZES = [('spectrum 1044', (1044,), np.float64),
+         ('spectrum 2048', (2048,), np.float64),
+         ('camera 640x480 RGB', (480, 640, 3), np.uint8),
+         ('camera 2048x2048 16bit', (2048, 2048), np.uint16)]
+
+
+def benchmark(client, name, min_time=2.0, max_calls=1000):
+    """Fetch an array repeatedly for at least min_time seconds, and return (frames per second, MB/s)"""
+    array = client.get_array(name)  # warm up
+    n = 0
+    start = time.time()
+    while time.time() - start < min_time and n < max_calls:
+        array = client.get_array(name)
+        n += 1
+    elapsed = time.time() - start
+    return n / elapsed, n * array.nbytes / elapsed / 1e6
+
+
+if __name__ == '__main__':
+    server = create_server_class(BenchmarkInstrument)(('localhost', 0))
+    for name, shape, dtype in SIZES:
+        server.instrument.arrays[name] = (np.random.random(shape) * 255).astype(dtype)
+    server.run(with_gui=False, backgrounded=True)
+
+    print("%-24s %-8s %12s %12s" % ("array", "protocol", "frames/s", "MB/s"))
+    for name, shape, dtype in SIZES:
+        for binary in [False, True]:
+            client = create_client_class(BenchmarkInstrument)(server.server_address, binary_transport=binary)
+            fps, mbps = benchmark(client, name)
+            print("%-24s %-8s %12.1f %12.1f" % (name, "binary" if binary else "text", fps, mbps))
+    server.shutdown()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of stitching a grid of tiles saved in an HDF5 file, as the particle tracking app does.
+
+An 8x8 grid of 512x512 RGB tiles (with 15% overlap and a couple of pixels of error in their recorded positions) is
+cut out of a random image.  We time each step of reconstruct_tiled_image: correlating the overlapping pairs, solving
+for the positions (the old iterative optimisation versus the sparse least-squares solve) and stitching (the old
+in-memory stitch_images versus writing a pyramid of chunked datasets to the file).
+"""
+from __future__ import print_function
+
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import nplab.datafile as df
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), "..", "nplab", "Lab1_BX-60 Local Python Scripts",
+                           "particle_tracking_app", "particle_tracking_app", "reconstruct_tiled_image.py")
+spec = importlib.util.spec_from_file_location("reconstruct_tiled_image", MODULE_PATH)
+rti = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = rti
+spec.loader.exec_module(rti)
+
+N, SIZE, STEP = 8, 512, 435
+
+
+def make_tiles(group):
+    """Save a grid of overlapping tiles from a random image in an HDF5 group."""
+    rng = np.random.RandomState(0)
+    scene = cv2.GaussianBlur(rng.random_sample((STEP*(N-1) + SIZE,)*2 + (3,)).astype(np.float32), (0, 0), 3)
+    scene = (255*(scene - scene.min())/np.ptp(scene)).astype(np.uint8)
+    for i in range(N):
+        for j in range(N):
+            M = np.identity(4)
+            M[3, :2] = [i*STEP, j*STEP] + rng.uniform(-2, 2, 2)
+            M[3, 2] = 0
+            group.create_dataset("tile_%d", data=scene[i*STEP:i*STEP+SIZE, j*STEP:j*STEP+SIZE],
+                                 attrs={'pixel_to_sample_matrix': M})
+    return list(group.values())
+
+
+def timed(name, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print("{}: {:.2f} s".format(name, time.time() - start))
+    return result
+
+
+if __name__ == '__main__':
+    f = df.DataFile(os.path.join(tempfile.mkdtemp(), "tiles.h5"))
+    tiles = make_tiles(f.create_group("tiles"))
+    positions = rti.get_pixel_positions(tiles)[0]
+    pairs = rti.find_overlapping_pairs(positions, tiles[0].shape[:2])
+    print("{} tiles, {} overlapping pairs, {} CPUs".format(len(tiles), len(pairs), os.cpu_count()))
+    displacements = timed("correlation, serial", rti.croscorrelate_overlapping_images,
+                          tiles, pairs, positions, processes=1)
+    timed("correlation, process pool", rti.croscorrelate_overlapping_images, tiles, pairs, positions)
+    positions = rti.fit_affine_transform(pairs, positions, displacements)[1]
+
+    def iterate(positions):
+        errors = [rti.rms_error(pairs, positions, displacements)]
+        while len(errors) < 5 or (errors[-2] - errors[-1]) > 0.001:
+            positions = rti.optimise_positions(pairs, positions, displacements)
+            errors.append(rti.rms_error(pairs, positions, displacements))
+        return positions, len(errors)
+    iterated, iterations = timed("iterative optimisation", iterate, positions.copy())
+    solved = timed("sparse least squares", rti.solve_positions, pairs, positions, displacements)
+    print("RMS error: {:.3f} pixels after {} iterations, {:.3f} pixels from least squares".format(
+        rti.rms_error(pairs, iterated, displacements), iterations, rti.rms_error(pairs, solved, displacements)))
+
+    stitched = timed("stitch_images (in memory)", rti.stitch_images, tiles, solved, downsample=1)[0]
+    shape, centre, corners = rti.stitched_geometry(solved, tiles[0].shape[:2])
+    attrs = rti.stitched_image_attrs(tiles, np.zeros(3), centre, shape)
+    levels = timed("write_tiled_image_pyramid", rti.write_tiled_image_pyramid,
+                   tiles, solved, f.create_group("pyramid"), attrs)
+    print("Pyramid levels: {}".format([level.shape[:2] for level in levels]))
+    f.close()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of auto-incremented dataset names.
+
+Creates 50,000 datasets called spectrum_%d in one group and reports how long each block of creations takes, which
+should stay flat as the group grows.  For comparison, the old approach (probing spectrum_0, spectrum_1... until a free
+name is found) is timed at the same group sizes.
+"""
+from __future__ import print_function
+
+import os
+import tempfile
+import time
+import numpy as np
+
+import nplab.datafile as df
+
+
+def probe_unique_name(group, name):
+    """The old find_unique_name: one link lookup for every existing item"""
+    n = 0
+    while (name % n) in group:
+        n += 1
+    return name % n
+
+
+if __name__ == '__main__':
+    n_datasets = 50000
+    block = 5000
+    f = df.DataFile(os.path.join(tempfile.mkdtemp(), "benchmark_unique_names.h5"))
+    data = np.zeros(16)
+    print("%-12s %22s %22s" % ("datasets", "create_dataset (ms)", "probing lookup (ms)"))
+    start = time.time()
+    for i in range(1, n_datasets + 1):
+        f.create_dataset("spectrum_%d", data=data, autoflush=False)
+        if i % block == 0:
+            per_dataset = (time.time() - start) / block
+            probe_start = time.time()
+            probe_unique_name(f, "spectrum_%d")
+            probe_time = time.time() - probe_start
+            print("%-12d %22.3f %22.3f" % (i, per_dataset * 1e3, probe_time * 1e3))
+            start = time.time()
+    f.close()
@@ -23,7 +23,7 @@ import os
 import pyqtgraph as pg
 import numpy as np
 from random import choice
-from .reconstruct_tiled_image import reconstruct_tiled_image
+from .reconstruct_tiled_image import reconstruct_tiled_image, load_pyramid_level, PyramidLevel
 
 def distance(p1, p2):
         '''distance between two points'''
@@ -163,21 +163,48 @@ class TrackingWizard(QtWidgets.QWizard, UiTools):
         """Once the grid of images has been taken they are stitched together 
         from the hdf5 group """
         self.tiled_group = self.tiler.dest
-        self.tiled_image = reconstruct_tiled_image(list(self.tiled_group.values()))
-        self.scan_group.create_dataset('reconstructed_tiles',
-                                       data=self.tiled_image,
-                                       attrs=self.tiled_image.attrs)
+        pyramid = self.scan_group.create_group('reconstructed_tiles_pyramid', auto_increment=False)
+        # the stitched image is written straight to the file, at several resolutions
+        reconstructed_tiles = reconstruct_tiled_image(list(self.tiled_group.values()),
+                                                      output_group=pyramid)
+        self.scan_group['reconstructed_tiles'] = reconstructed_tiles # hard link to the full resolution image
+        # the full resolution image stays in the file, and is read a piece at a time (see find_particle_centers)
+        self.tiled_image = PyramidLevel(pyramid, level=0)
         # self.tiled_image_widget_analysis.setImage(self.tiled_image)
      #   self.tiled_image_widget_analysis.setDownsampling(self.tiles_x)
         self.tiled_image_widget_analysis.imageItem.setAutoDownsample(True)
-        self.tiled_image_item.setImage(transform_for_view(self.tiled_image))
+        self.tiled_image_item.setImage(transform_for_view(load_pyramid_level(pyramid, max_size=2048)))
+
+    def preview_region(self, size=2048):
+        """The middle of the full resolution tiled image, at most size pixels square, for previewing filters"""
+        centre = np.array(self.tiled_image.shape[:2])//2
+        return self.tiled_image.region(*np.concatenate((centre - size//2, centre + size//2)))
+
+    def find_particle_centers(self, block_size=2048, margin=128):
+        """Find the particles in the tiled image, a block at a time so it's never all loaded at once.
+
+        Blocks overlap by margin pixels, so particles on the edge of a block are
+        seen whole, and each particle is kept only by the block it's centred in.
+        Returns the centres in pixels of the full image, or None if there aren't any.
+        """
+        centers = []
+        for block, (u0, v0, u1, v1) in self.tiled_image.blocks(block_size, margin):
+            found = self.filter_box.STBOC_with_size_filter(block, return_centers=True)
+            if found is None:
+                continue
+            found = found + [max(u0 - margin, 0), max(v0 - margin, 0)]
+            in_core = np.logical_and(np.all(found >= [u0, v0], axis=1), np.all(found < [u1, v1], axis=1))
+            centers.append(found[in_core])
+        if len(centers) == 0:
+            return None
+        return np.concatenate(centers)
 
     def update_tiled_image(self,value):
         """ Apply live updates to the tiled images as the image filtering properties are changed
         """
         try:
             
-            filtered_tile = self.filter_box.current_filter(self.tiled_image)
+            filtered_tile = self.filter_box.current_filter(self.preview_region())
             print('shape', np.shape(filtered_tile))
             self.tiled_image_widget_analysis.setImage(transform_for_view(filtered_tile))
         except Exception as e:
@@ -194,13 +221,13 @@ class TrackingWizard(QtWidgets.QWizard, UiTools):
         self.scanner_status = 'Scanning!'
         tiles = self.tiled_image
         # self.payload = self.task_manager.construct_payload()
-        centers = self.filter_box.STBOC_with_size_filter(self.tiled_image,return_centers=True)
+        centers = self.find_particle_centers()
         tile_edge = self.tile_edge # number of pixels from the edge to ignore a particle
         centers = centers[np.logical_and(centers[:,0]>(tile_edge),
                                          centers[:,0]<(tiles.shape[0]-tile_edge))]
         centers = centers[np.logical_and(centers[:,1]>(tile_edge),
                                          centers[:,1]<(tiles.shape[1]-tile_edge))]
-        path = sort_centers(centers.tolist(), starting_point=(0, self.tiled_image.shape[0]))
+        path = sort_centers(centers.tolist(), starting_point=(0, tiles.shape[0]))
         self.total_particles = len(centers)
         for p_number, particle_center in enumerate(path):
             self.payload = self.task_manager.construct_payload()
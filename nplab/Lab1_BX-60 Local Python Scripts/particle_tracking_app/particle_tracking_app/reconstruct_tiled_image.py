@@ -10,12 +10,16 @@ from __future__ import print_function
 from builtins import zip
 from builtins import range
 from past.utils import old_div
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import nplab
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 #import cv2.cv
-from scipy import ndimage
+from scipy import ndimage, sparse
+from scipy.sparse.linalg import lsqr
 from nplab.utils.image_with_location import ImageWithLocation
 from nplab.utils.array_with_attrs import ArrayWithAttrs
 
@@ -138,7 +142,7 @@ def find_overlapping_pairs(pixel_positions, image_size,
             overlap = image_size - np.abs(pixel_positions[i,:2] -
                                           pixel_positions[j,:2])
             overlap[overlap<0] = 0
-            tile_pairs.append((i, j, np.product(overlap)))
+            tile_pairs.append((i, j, np.prod(overlap)))
     overlaps = np.array([o for i,j,o in tile_pairs])
     try:
         overlap_threshold = np.max(overlaps)*0.2
@@ -148,13 +152,82 @@ def find_overlapping_pairs(pixel_positions, image_size,
     return overlapping_pairs
 
 #################### Cross-correlate overlapping pairs to match them up #######
+def overlap_slices(image_size, original_displacement, margin):
+    """Work out which parts of two overlapping images should be correlated.
+
+    Arguments:
+    image_size: numpy.ndarray
+        The (2 element) size of the images in pixels.
+    original_displacement: numpy.ndarray
+        The (rounded) displacement in pixels from the first image to the second.
+    margin: int
+        The number of pixels of error to allow for in the displacement.
+
+    Returns: (tuple, tuple)
+        Slices that extract the overlapping part of the first image, and the
+        overlapping part of the second image minus the margin (i.e. the
+        template that's scanned over the first image's overlap).
+    """
+    #FIXME currently breaks if overlap in X or Y is negative
+    overlap_size = image_size - np.abs(original_displacement)
+    assert np.all(overlap_size > margin), "Overlaps must be greater than the margin"
+    assert np.all(overlap_size <= image_size), "Overlaps can't be bigger than the image"
+    #this slightly dense structure creates slices for the overlapping part
+    i_slices = tuple(slice(0,ol) if od<0 else slice(im-ol,im)
+                     for im, ol, od in zip(image_size.astype(int),
+                                           overlap_size.astype(int),
+                                           original_displacement))
+    j_slices = tuple(slice(margin,ol-margin) if od>0 else slice(im-ol+margin,im-margin)
+                     for im, ol, od in zip(image_size.astype(int),
+                                           overlap_size.astype(int),
+                                           original_displacement))
+    return i_slices, j_slices
+
+
+def correlate_overlap(i_overlap, j_overlap):
+    """Find the shift (in pixels) of j_overlap that best matches i_overlap.
+
+    j_overlap should be smaller than i_overlap (by the margin on each side);
+    the shift is relative to j_overlap being centred on i_overlap.
+    """
+    #correlate them: NB the match position is the MINIMUM
+    corr = -cv2.matchTemplate(np.ascontiguousarray(i_overlap),
+                              np.ascontiguousarray(j_overlap),
+                              cv2.TM_SQDIFF_NORMED)
+    corr += (corr.max()-corr.min())*0.1 - corr.max() #background-subtract 90% of maximum
+    corr = cv2.threshold(corr, 0, 0, cv2.THRESH_TOZERO)[1] #zero out any negative pixels - but there should always be > 0 nonzero pixels
+    peak = ndimage.center_of_mass(corr) #take the centroid (NB this is of grayscale values not just binary)
+    return peak - (np.array(corr.shape) - 1)/2 # the centre of an odd-sized array is a pixel
+
+
+# Tiles shared with worker processes (see croscorrelate_overlapping_images)
+_shared_tiles = None
+_shared_tiles_memory = None
+
+def _attach_shared_tiles(name, shape, dtype):
+    """Map the block of shared memory holding the tiles (in a worker process)."""
+    global _shared_tiles, _shared_tiles_memory
+    _shared_tiles_memory = shared_memory.SharedMemory(name=name)
+    _shared_tiles = np.ndarray(shape, dtype=dtype, buffer=_shared_tiles_memory.buf)
+
+def _correlate_shared_pair(job):
+    """Correlate one pair of tiles from the shared memory block."""
+    i, j, i_slices, j_slices = job
+    return correlate_overlap(_shared_tiles[i][i_slices], _shared_tiles[j][j_slices])
+
+
 def croscorrelate_overlapping_images(tiles, overlapping_pairs, 
                                      pixel_positions, 
-                                     fractional_margin=0.02):
+                                     fractional_margin=0.02,
+                                     processes=None):
     """Calculate actual displacements between pairs of overlapping images.
     
     For each pair of overlapping images, perform a cross-correlation to
     fine-tune the displacement between them.
+
+    Correlations are run in parallel, in a pool of worker processes.  Each tile
+    is read (e.g. from the HDF5 file) once, into a block of shared memory that
+    all the workers can see, so tiles aren't copied to every worker.
     
     Arguments:
     tiles: [h5py.Dataset]
@@ -167,41 +240,47 @@ def croscorrelate_overlapping_images(tiles, overlapping_pairs,
         Allow for this much error in the specified positions (given as a 
         fraction of the length of the smaller side of the image).  Defaults to
         0.02 which should be fine for our typical microscope set-ups.
+    processes: int
+        The number of worker processes to use (default: one per CPU).  If this
+        is 1, the pairs are correlated one after another in this process,
+        reading only the overlapping parts of each tile.
     
     Results: np.ndarray
         An Mx2 array, giving the displacement in pixels between each pair of
         images specified in overlapping_pairs.
     """
-    #FIXME currently half a pixel out for odd-sized images
-    #FIXME currently breaks if overlap in X or Y is negative
     image_size = np.array(tiles[0].shape[:2]) #:2 because we only want width, height
-    margin = np.int(np.min(image_size) * 0.02)
-    correlated_pixel_displacements = []
-    for i, j in overlapping_pairs:
-        original_displacement = np.round(pixel_positions[j,:2] - pixel_positions[i,:2])
-        overlap_size = image_size - np.abs(original_displacement)
-        assert np.all(overlap_size > margin), "Overlaps must be greater than the margin"
-        assert np.all(overlap_size <= image_size), "Overlaps can't be bigger than the image"
-        #this slightly dense structure creates slices for the overlapping part
-        i_slices = [slice(0,ol) if od<0 else slice(im-ol,im) 
-                    for im, ol, od in zip(image_size.astype(np.int), 
-                                          overlap_size.astype(np.int), 
-                                          original_displacement)]
-        j_slices = [slice(margin,ol-margin) if od>0 else slice(im-ol+margin,im-margin) 
-                    for im, ol, od in zip(image_size.astype(np.int), 
-                                          overlap_size.astype(np.int), 
-                                          original_displacement)]
-        #correlate them: NB the match position is the MINIMUM
-        corr = -cv2.matchTemplate(np.array(tiles[i])[i_slices+[slice(None)]],
-                                  np.array(tiles[j])[j_slices+[slice(None)]],
-                                  cv2.TM_SQDIFF_NORMED)
-        corr += (corr.max()-corr.min())*0.1 - corr.max() #background-subtract 90% of maximum
-        corr = cv2.threshold(corr, 0, 0, cv2.THRESH_TOZERO)[1] #zero out any negative pixels - but there should always be > 0 nonzero pixels
-        peak = ndimage.measurements.center_of_mass(corr) #take the centroid (NB this is of grayscale values not just binary)
-        shift = peak - old_div(np.array(corr.shape),2)
-        correlated_pixel_displacements.append(original_displacement + shift)
-    correlated_pixel_displacements = np.array(correlated_pixel_displacements)
-    return correlated_pixel_displacements
+    margin = int(np.min(image_size) * fractional_margin)
+    original_displacements = [np.round(pixel_positions[j,:2] - pixel_positions[i,:2])
+                              for i, j in overlapping_pairs]
+    jobs = [(i, j) + overlap_slices(image_size, d, margin)
+            for (i, j), d in zip(overlapping_pairs, original_displacements)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        shifts = [correlate_overlap(tiles[i][i_slices], tiles[j][j_slices])
+                  for i, j, i_slices, j_slices in jobs]
+    else:
+        shape = (len(tiles),) + tuple(tiles[0].shape)
+        dtype = np.dtype(tiles[0].dtype)
+        memory = shared_memory.SharedMemory(create=True,
+                                            size=int(np.prod(shape))*dtype.itemsize)
+        try:
+            shared_tiles = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+            for k, tile in enumerate(tiles):
+                shared_tiles[k] = tile
+            with ProcessPoolExecutor(processes, initializer=_attach_shared_tiles,
+                                     initargs=(memory.name, shape, dtype.str)) as executor:
+                shifts = list(executor.map(_correlate_shared_pair, jobs,
+                                           chunksize=max(1, len(jobs)//(4*processes))))
+            del shared_tiles
+        finally:
+            memory.close()
+            memory.unlink()
+    correlated_pixel_displacements = np.array([d + shift for d, shift
+                                               in zip(original_displacements, shifts)])
+    return correlated_pixel_displacements.reshape((len(overlapping_pairs), 2))
 
 def pair_displacements(pairs, positions):
     """Calculate the displacement between each pair of positions specified.
@@ -311,6 +390,45 @@ def optimise_positions(pairs, positions, displacements):
         
 
 
+def solve_positions(pairs, positions, displacements):
+    """Find the positions that best match a set of displacements.
+
+    This is a sparse linear least-squares problem: each pair contributes a row
+    to an MxN matrix (with -1 for the first image and +1 for the second) and we
+    solve for the positions, in X and Y, that make its product match the
+    displacements.  Unlike repeatedly calling optimise_positions, this gets
+    to the optimum in one go however big the grid is.
+
+    Arguments:
+    pairs: [(int,int)]
+        A list of M tuples, where each tuple describes two images that overlap.
+    positions: numpy.ndarray
+        An Nx2 array, giving the 2D position in pixels of each image.  This is
+        used as the starting point, and is not modified.
+    displacements: numpy.ndarray
+        An Mx2 array, giving the 2D displacement between each pair of images.
+
+    Returns: numpy.ndarray
+        The optimised positions.  Only relative positions are fixed by the
+        displacements: we make the smallest change to the starting positions,
+        so the mean position of each connected group of tiles doesn't change
+        (and tiles that don't overlap anything stay where they are).
+    """
+    positions = np.array(positions, dtype=float)
+    if not pairs:
+        return positions
+    pairs = np.array(pairs)
+    m = pairs.shape[0]
+    incidence = sparse.csr_matrix((np.tile([-1.0, 1.0], m),
+                                   (np.repeat(np.arange(m), 2), pairs.ravel())),
+                                  shape=(m, positions.shape[0]))
+    residuals = np.asarray(displacements)[:, :2] - incidence.dot(positions[:, :2])
+    for k in range(2):
+        # lsqr returns the minimum-norm correction when there's a choice
+        positions[:, k] += lsqr(incidence, residuals[:, k], atol=1e-10, btol=1e-10)[0]
+    return positions
+
+
 ################### Stitch the images together ################################
 def stitch_images(tiles, positions, downsample=3):
     """Merge images together, using supplied positions (in pixels).
@@ -345,7 +463,7 @@ def stitch_images(tiles, positions, downsample=3):
     # first, work out the size and position of the stitched image
     image_size = np.array(tiles[0].shape[:2])
     stitched_size = np.array(np.round(old_div((np.max(p, axis=0) - np.min(p, axis=0) 
-                                + image_size),downsample)),dtype = np.int)
+                                + image_size),downsample)),dtype = int)
     
     stitched_centre = old_div((np.max(p, axis=0) + np.min(p, axis=0)),2)
     stitched_image = np.zeros(tuple(stitched_size)+(3,), dtype=np.uint8)
@@ -398,8 +516,294 @@ def stitch_images(tiles, positions, downsample=3):
                        int(np.ceil(topleft[1])):int(np.ceil(topleft[1])+img.shape[1]),:] += img
     return stitched_image, stitched_centre, stitched_centres
                        
+def stitched_geometry(positions, image_size, downsample=1):
+    """Work out the size of a stitched image, and where each tile goes in it.
+
+    This is the same layout as stitch_images uses.
+
+    Arguments:
+    positions: numpy.ndarray
+        An Nx2 array, giving the 2D position in pixels of each image.
+    image_size: numpy.ndarray
+        The size of each image in pixels.
+    downsample: int
+        The downsampling factor of the stitched image.
+
+    Returns: (shape, stitched_centre, tile_corners)
+        The 2D shape of the stitched image (in downsampled pixels), the
+        position (in pixels) of the centre of the stitched image, and an Nx2
+        integer array of the position of the top left corner of each tile,
+        in full-resolution pixels relative to the stitched image's corner.
+    """
+    p = np.asarray(positions)[:, :2]
+    image_size = np.array(image_size[:2])
+    shape = np.round((np.max(p, axis=0) - np.min(p, axis=0) + image_size)/downsample).astype(int)
+    stitched_centre = (np.max(p, axis=0) + np.min(p, axis=0))/2
+    origin = stitched_centre - shape*downsample/2.0
+    tile_corners = np.round(p - image_size/2.0 - origin).astype(int)
+    return tuple(shape), stitched_centre, tile_corners
+
+
+def _covered_range(block_start, block_length, tile_corner, tile_length, downsample):
+    """The range of indices in a block of the stitched image covered by a tile (along one axis)."""
+    first = block_start*downsample
+    lo = max(0, -((first - tile_corner) // downsample))
+    hi = min(block_length, -((first - tile_corner - tile_length) // downsample))
+    return lo, hi
+
+
+def stitch_images_into(tiles, positions, out, downsample=1, block_size=1024):
+    """Merge images together into an existing array or HDF5 dataset.
+
+    Each pixel comes from the image whose centre is closest, as in
+    stitch_images, but the stitched image is built up a block at a time, and
+    only the parts of the tiles that are needed for each block are read.  That
+    means `out` can be a (chunked) HDF5 dataset much larger than the available
+    memory.
+
+    Arguments:
+    tiles: [h5py.Dataset]
+        A list of datasets (or numpy images) that represent the images.
+    positions: numpy.ndarray
+        An Nx2 array, giving the 2D position in pixels of each image.
+    out: numpy.ndarray or h5py.Dataset
+        The destination, which must have the shape given by stitched_geometry
+        (plus the trailing dimensions of the tiles).
+    downsample: int
+        The stitched image is decimated by this factor (after working out the
+        positions, so the tiles are placed to within one original pixel).
+    block_size: int
+        The size of the square blocks (in stitched pixels) we build in memory.
+    """
+    image_size = np.array(tiles[0].shape[:2])
+    shape, stitched_centre, corners = stitched_geometry(positions, image_size, downsample)
+    assert tuple(out.shape[:2]) == shape, "The output is the wrong shape for these positions"
+    centres = corners + (image_size - 1)/2.0
+    for u0 in range(0, shape[0], block_size):
+        for v0 in range(0, shape[1], block_size):
+            bh, bw = min(block_size, shape[0] - u0), min(block_size, shape[1] - v0)
+            ranges = [(t, _covered_range(u0, bh, corners[t, 0], image_size[0], downsample),
+                          _covered_range(v0, bw, corners[t, 1], image_size[1], downsample))
+                      for t in range(len(tiles))]
+            ranges = [(t, ur, vr) for t, ur, vr in ranges if ur[0] < ur[1] and vr[0] < vr[1]]
+            block = np.zeros((bh, bw) + out.shape[2:], dtype=out.dtype)
+            if ranges:
+                # each pixel comes from the tile (that covers it) with the closest centre
+                u = (u0 + np.arange(bh))*downsample
+                v = (v0 + np.arange(bw))*downsample
+                distances = np.full((len(ranges), bh, bw), np.inf, dtype=np.float32)
+                for k, (t, (ulo, uhi), (vlo, vhi)) in enumerate(ranges):
+                    distances[k, ulo:uhi, vlo:vhi] = ((u[ulo:uhi, np.newaxis] - centres[t, 0])**2 +
+                                                      (v[np.newaxis, vlo:vhi] - centres[t, 1])**2)
+                closest = np.argmin(distances, axis=0)
+                for k, (t, (ulo, uhi), (vlo, vhi)) in enumerate(ranges):
+                    su, sv = (u0 + ulo)*downsample - corners[t, 0], (v0 + vlo)*downsample - corners[t, 1]
+                    region = tiles[t][su:su + (uhi - ulo - 1)*downsample + 1:downsample,
+                                      sv:sv + (vhi - vlo - 1)*downsample + 1:downsample]
+                    mask = closest[ulo:uhi, vlo:vhi] == k
+                    block[ulo:uhi, vlo:vhi][mask] = np.asarray(region)[mask]
+            out[u0:u0 + bh, v0:v0 + bw, ...] = block
+
+
+def stitched_image_attrs(tiles, scan_centre, stitched_centre, shape, downsample=1):
+    """The ImageWithLocation metadata for a stitched image.
+
+    Arguments:
+    tiles: [h5py.Dataset]
+        The source images (the last one's pixel_to_sample_matrix is used).
+    scan_centre: numpy.ndarray
+        The mean position (in sample coordinates) of the tiles.
+    stitched_centre: numpy.ndarray
+        The position (in pixels) of the centre of the stitched image.
+    shape: tuple
+        The shape of the stitched image.
+    downsample: int
+        The downsampling factor of the stitched image.
+
+    Returns: dict
+        datum_pixel, stage_position and pixel_to_sample_matrix attributes.
+    """
+    datum_pixel = [stitched_centre[0]+old_div(shape[0],2),
+                   stitched_centre[1]+old_div(shape[1],2)]
+    pixel_to_sample_mat = np.zeros((4,4))
+    pixel_to_sample_mat[:2,:2] = tiles[-1].attrs['pixel_to_sample_matrix'][:2,:2]*downsample
+    pixel_to_sample_mat[2,2] = 1
+    theory_centre =np.dot(datum_pixel,pixel_to_sample_mat[:2,:2])
+    offset = scan_centre[:2] - theory_centre
+    pixel_to_sample_mat[3,:2]=offset #wrong must be the 0,0 pixel location not the e
+    pixel_to_sample_mat[3,2]=scan_centre[2]
+    return {'datum_pixel': datum_pixel,
+            'stage_position': scan_centre,
+            'pixel_to_sample_matrix': pixel_to_sample_mat}
+
+
+def pyramid_level_attrs(attrs, factor):
+    """Adjust ImageWithLocation metadata for an image binned by `factor`.
+
+    Pixel i of the binned image is the mean of pixels factor*i to
+    factor*(i+1)-1 of the original, so its centre is (factor-1)/2 pixels
+    further on than pixel factor*i.
+    """
+    attrs = dict(attrs)
+    offset = (factor - 1)/2.0
+    M = np.array(attrs['pixel_to_sample_matrix'], dtype=float)
+    M[3, :] += offset*(M[0, :] + M[1, :])
+    M[:2, :] *= factor
+    attrs['pixel_to_sample_matrix'] = M
+    attrs['datum_pixel'] = (np.array(attrs['datum_pixel'], dtype=float) - offset)/factor
+    return attrs
+
+
+def _bin_2x2(block):
+    """Halve the size of an image by taking the mean of 2x2 blocks (padding odd edges)."""
+    dtype = block.dtype
+    pad = [(0, n % 2) for n in block.shape[:2]] + [(0, 0)]*(block.ndim - 2)
+    block = np.pad(block, pad, mode='edge').astype(np.float32)
+    binned = (block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2])/4
+    if np.issubdtype(dtype, np.integer):
+        binned = np.round(binned)
+    return binned.astype(dtype)
+
+
+def write_tiled_image_pyramid(tiles, positions, group, attrs, downsample=1,
+                              chunk_size=256, min_size=512, block_size=1024):
+    """Stitch images into a chunked, multi-resolution set of HDF5 datasets.
+
+    The full-resolution stitched image is written to "level_0" in `group` one
+    block at a time (see stitch_images_into).  Each subsequent level,
+    "level_1", "level_2" and so on, is half the size of the previous one (the
+    mean of 2x2 blocks), and is calculated from the previous level, again a
+    block at a time.  Levels are added until the image fits within min_size
+    pixels.  Each level has its own ImageWithLocation metadata, so a viewer
+    can load whichever level suits the current zoom (see load_pyramid_level)
+    and the whole image never needs to be in memory at once.
+
+    Arguments:
+    tiles: [h5py.Dataset]
+        A list of datasets (or numpy images) that represent the images.
+    positions: numpy.ndarray
+        An Nx2 array, giving the 2D position in pixels of each image.
+    group: nplab.datafile.Group
+        The (empty) group in which to create the datasets.
+    attrs: dict
+        Metadata for level 0, usually from stitched_image_attrs.
+    downsample: int
+        The downsampling factor of level 0 relative to the tiles.
+    chunk_size: int
+        The datasets are chunked in squares of this size.
+    min_size: int
+        Stop adding levels once both dimensions are no larger than this.
+    block_size: int
+        The size of the square blocks (in pixels) we process in memory.
+
+    Returns: [h5py.Dataset]
+        The datasets, from full resolution to the smallest.
+    """
+    image_size = np.array(tiles[0].shape[:2])
+    shape = stitched_geometry(positions, image_size, downsample)[0] + tuple(tiles[0].shape[2:])
+
+    def create_level(n, shape, level_attrs):
+        chunks = tuple(min(chunk_size, s) for s in shape[:2]) + shape[2:]
+        return group.create_dataset("level_%d" % n, auto_increment=False, shape=shape,
+                                    dtype=tiles[0].dtype, chunks=chunks, attrs=level_attrs)
+
+    levels = [create_level(0, shape, attrs)]
+    stitch_images_into(tiles, positions, levels[0], downsample=downsample, block_size=block_size)
+    block_size -= block_size % 2
+    while max(levels[-1].shape[:2]) > min_size:
+        previous = levels[-1]
+        shape = tuple((s + 1)//2 for s in previous.shape[:2]) + previous.shape[2:]
+        level = create_level(len(levels), shape, pyramid_level_attrs(attrs, 2**len(levels)))
+        for u0 in range(0, previous.shape[0], block_size):
+            for v0 in range(0, previous.shape[1], block_size):
+                binned = _bin_2x2(previous[u0:u0 + block_size, v0:v0 + block_size])
+                level[u0//2:u0//2 + binned.shape[0], v0//2:v0//2 + binned.shape[1]] = binned
+        levels.append(level)
+    group.attrs['levels'] = len(levels)
+    group.attrs['downsample'] = downsample
+    return levels
+
+
+def load_pyramid_level(group, max_size=None, level=None):
+    """Load one level of an image written by write_tiled_image_pyramid.
+
+    Arguments:
+    group: h5py.Group
+        The group containing the pyramid.
+    max_size: int
+        If specified, load the largest level that fits within max_size pixels
+        in both dimensions (or the smallest level, if none fit).
+    level: int
+        If specified, load this level (0 is full resolution).
+
+    Returns: ImageWithLocation
+        The image, with metadata appropriate to its resolution.
+    """
+    n_levels = group.attrs['levels']
+    if level is None:
+        level = 0
+        if max_size is not None:
+            while level < n_levels - 1 and max(group['level_%d' % level].shape[:2]) > max_size:
+                level += 1
+    dset = group['level_%d' % level]
+    return ImageWithLocation(dset[()], dset.attrs)
+
+
+class PyramidLevel(object):
+    """One level of an image written by write_tiled_image_pyramid, read from the file only as it's needed.
+
+    This has the parts of the ImageWithLocation interface needed to find and
+    visit features in a stitched image that's too big to load: `shape`,
+    `attrs`, `pixel_to_location` and `feature_at`.  `region` loads part of the
+    image, and `blocks` goes through the whole image a piece at a time.
+    """
+    def __init__(self, group, level=0):
+        self.dataset = group['level_%d' % level]
+        self.attrs = dict(self.dataset.attrs)
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    def region(self, u0, v0, u1, v1):
+        """Load pixels [u0:u1, v0:v1] (clipped to the image) as an ImageWithLocation."""
+        u0, v0 = max(int(u0), 0), max(int(v0), 0)
+        image = ImageWithLocation(self.dataset[u0:int(u1), v0:int(v1)], self.attrs)
+        # shift the metadata so the pixels stay in the same place on the sample, as slicing an ImageWithLocation does
+        M = np.array(self.attrs['pixel_to_sample_matrix'], dtype=float)
+        M[3, :3] += np.dot([u0, v0, 0], M[:3, :3])
+        image.pixel_to_sample_matrix = M
+        image.datum_pixel = np.array(self.attrs['datum_pixel'], dtype=float) - [u0, v0]
+        return image
+
+    def pixel_to_location(self, pixel):
+        """Return the location in the sample of the given pixel (see ImageWithLocation.pixel_to_location)."""
+        return self.region(0, 0, 0, 0).pixel_to_location(pixel)
+
+    def feature_at(self, centre_position, size=(100, 100)):
+        """Load a thumbnail centred on a pixel, with its datum at its centre (see ImageWithLocation.feature_at)."""
+        u, v = int(centre_position[0]), int(centre_position[1])
+        thumb = self.region(u - size[0]//2, v - size[1]//2, u + size[0]//2, v + size[1]//2)
+        thumb.datum_pixel = (size[0]//2, size[1]//2)
+        return thumb
+
+    def blocks(self, block_size=2048, margin=128):
+        """Yield (image, core) for each block of the image in turn.
+
+        The cores, (u0, v0, u1, v1), tile the image without overlapping.  Each
+        image is the core with up to `margin` extra pixels on each side, so
+        features near the edge of a core can be seen whole.
+        """
+        for u0 in range(0, self.shape[0], block_size):
+            for v0 in range(0, self.shape[1], block_size):
+                u1, v1 = min(u0 + block_size, self.shape[0]), min(v0 + block_size, self.shape[1])
+                yield self.region(u0 - margin, v0 - margin, u1 + margin, v1 + margin), (u0, v0, u1, v1)
+
+
 def reconstruct_tiled_image(tiles,
-                            downsample=1):
+                            downsample=1,
+                            output_group=None,
+                            processes=None):
     """Combine a sequence of images into a large tiled image.
     
     This function takes a list of images and approximate positions.  It first
@@ -423,26 +827,19 @@ def reconstruct_tiled_image(tiles,
     downsample: int
         Downsampling factor (produces a less huge output image).  Only applies
         to the final stitching step.
-    
-    Returns: dict
-        This function returns a dictionary with various elements:
-        stitched_image: numpy.ndarray
-            The stitched image as a numpy array
-        stitched_to_sample: numpy.ndarray
-            A mapping matrix that transforms from image coordinates (0-1 for X 
-            and Y) to "sample" coordinates (whatever the original positions 
-            were specified in)
-        stitched_centre: numpy.ndarray
-            The centre of the stitched image, again in sample coordinates.
-        image_centres: numpy.ndarray
-            The centres of the tiles, in pixels in the stitched image (mostly 
-            for debug purposes, but can be useful to locate the original tile 
-            for a given pixel).  It has dimensions Nx2, where N is the number
-            of source images.
-        corrected_camera_to_sample: numpy.ndarray
-            The 2x2 mapping matrix passed as input, tweaked to better match
-            the measured displacements between the images, and their given
-            positions.
+    output_group: nplab.datafile.Group
+        If specified, the stitched image is written a block at a time into
+        this (empty) group, as a multi-resolution pyramid of chunked datasets
+        (see write_tiled_image_pyramid), rather than being built in memory.
+    processes: int
+        The number of processes used to cross-correlate the images (default:
+        one per CPU).
+    
+    Returns: ImageWithLocation or h5py.Dataset
+        The stitched image, with "datum_pixel", "stage_position" and
+        "pixel_to_sample_matrix" metadata relating its pixels to the sample.
+        If output_group was given, this is the full-resolution dataset
+        "level_0" in that group, which is not loaded into memory.
     """
     # extract positions from the metadata
    # positions, scan_centre = get_pixel_positions(tiles, camera_to_sample)
@@ -454,52 +851,38 @@ def reconstruct_tiled_image(tiles,
     print("Finding displacements between  images (may take a while)...")
     # compare overlapping images to find the true displacement between them
     displacements = croscorrelate_overlapping_images(tiles, pairs, positions, 
-                                                     fractional_margin=0.02)
+                                                     fractional_margin=0.02,
+                                                     processes=processes)
                                                      
     # now we start the optimisation...
-    errors = [rms_error(pairs, positions, displacements, print_err=True)]
+    rms_error(pairs, positions, displacements, print_err=True)
     
     # first, fit an affine transform, to correct for the calibration between
     # camera and stage being slightly off (rotation, scaling, etc.)
     affine_transform, positions = fit_affine_transform(pairs, positions,
                                                        displacements)
-    pixel_to_sample_matrix = tiles[-1].attrs['pixel_to_sample_matrix']
+    pixel_to_sample_matrix = np.array(tiles[-1].attrs['pixel_to_sample_matrix']) # don't modify the tiles
     pixel_to_sample_matrix[:2,:2] = np.dot(np.linalg.inv(affine_transform),
                                            pixel_to_sample_matrix[:2,:2])
-    errors.append(rms_error(pairs, positions, displacements, print_err=True))
+    rms_error(pairs, positions, displacements, print_err=True)
     
     print("Optimising image positions...")
-    # next, optimise the positions iteratively
-    while len(errors) < 5 or (errors[-2] - errors[-1]) > 0.001:
-        assert len(errors) < 100, "Optimisation failed to converge"
-        positions = optimise_positions(pairs, positions, displacements)
-        errors.append(rms_error(pairs, positions, displacements, print_err=True))
+    # next, solve for the positions that best match the displacements
+    positions = solve_positions(pairs, positions, displacements)
+    rms_error(pairs, positions, displacements, print_err=True)
     
     print("Combining images...")
-    # finally, stitch the image!
-    stitched_image, stitched_centre, image_centres = stitch_images(tiles, 
-                                            positions, downsample=downsample)
-    
-    # now work out how the new image relates to the stage coordinates
-    # the correct camera-to-sample matrix for source images is 
-    # corrected_camera_to_sample; we need to adjust for image size though.
-    stitched_image = ImageWithLocation(stitched_image)
-    stitched_image.attrs['datum_pixel'] = [stitched_centre[0]+old_div(stitched_image.shape[0],2),
-                                             stitched_centre[1]+old_div(stitched_image.shape[1],2)]
-#    stitched_image.attrs['datum_pixel'] = [stitched_centre[0]+stitched_image.shape[0],
-#                                             stitched_centre[1]+stitched_image.shape[1]]
-#    stitched_image.attrs['datum_pixel'] = [stitched_image.shape[0]/2,
-#                                             stitched_image.shape[1]/2]
-    stitched_image.attrs['stage_position'] = scan_centre
-    pixel_to_sample_mat = np.zeros((4,4))
-    pixel_to_sample_mat[:2,:2] = tiles[-1].attrs['pixel_to_sample_matrix'][:2,:2]*downsample
-    pixel_to_sample_mat[2,2] = 1
-    theory_centre =np.dot(stitched_image.attrs['datum_pixel'],pixel_to_sample_mat[:2,:2])
-    offset = scan_centre[:2] - theory_centre
-    pixel_to_sample_mat[3,:2]=offset #wrong must be the 0,0 pixel location not the e
-    pixel_to_sample_mat[3,2]=scan_centre[2]
-    stitched_image.attrs['pixel_to_sample_matrix'] = pixel_to_sample_mat
-    return stitched_image
+    # finally, stitch the image!  We work out how the new image relates to the
+    # stage coordinates first, so it can be saved along with each level.
+    shape, stitched_centre, _ = stitched_geometry(positions, tiles[0].shape[:2],
+                                                  downsample=downsample)
+    attrs = stitched_image_attrs(tiles, scan_centre, stitched_centre, shape, downsample)
+    if output_group is not None:
+        return write_tiled_image_pyramid(tiles, positions, output_group, attrs,
+                                         downsample=downsample)[0]
+    stitched_image = np.zeros(shape + tuple(tiles[0].shape[2:]), dtype=tiles[0].dtype)
+    stitch_images_into(tiles, positions, stitched_image, downsample=downsample)
+    return ImageWithLocation(stitched_image, attrs)
 #    image_size = np.array(tiles[0].shape[:2])
 #    stitched_size = np.array(stitched_image.shape[:2])
 #    size_in_images =  stitched_size.astype(np.float) * downsample / image_size
@@ -12,9 +12,8 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 from importlib import reload
 from scipy.integrate import quad as spQuad
-from scipy import sparse
-from scipy.sparse.linalg import spsolve
 import nplab.analysis.NPoM_DF_Analysis.DF_Multipeakfit as mpf
+from nplab.analysis.background_removal.asymmetric_least_squares import baseline_als
 from matplotlib.ticker import (MultipleLocator, FormatStrFormatter, AutoMinorLocator)
 import matplotlib as mpl
 from IPython import display as ipDisp
@@ -150,17 +149,6 @@ def gaussian(x, height, center, fwhm, offset = 0):
 
     return y
 
-def baseline_als(y, lam, p, niter=10):
-    L = len(y)
-    D = sparse.diags([1,-2,1],[0,-1,-2], shape=(L,L-2))
-    w = np.ones(L)
-    for i in range(niter):
-        W = sparse.spdiags(w, 0, L, L)
-        Z = W + lam * D.dot(D.transpose())
-        z = spsolve(Z, w*y)
-        w = p * (y > z) + (1-p) * (y < z)
-    return z
-
 def nmToEv(nm):
     wavelength = nm*1e-9
     c = 299792458
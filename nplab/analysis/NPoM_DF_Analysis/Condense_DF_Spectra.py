@@ -775,19 +775,7 @@ def boltzmann(x, height, center, x0 = 0):
     A = height*np.sqrt(np.pi/2)*(a*np.exp(1)/2)
     return A*np.sqrt(2/np.pi)*(X**2*np.exp(-X**2/(2*a**2)))/a**3
 
-from scipy import sparse
-from scipy.sparse.linalg import spsolve
-
-def baseline_als(y, lam, p, niter=10):
-    L = len(y)
-    D = sparse.diags([1,-2,1],[0,-1,-2], shape=(L,L-2))
-    w = np.ones(L)
-    for i in range(niter):
-        W = sparse.spdiags(w, 0, L, L)
-        Z = W + lam * D.dot(D.transpose())
-        z = spsolve(Z, w*y)
-        w = p * (y > z) + (1-p) * (y < z)
-    return z
+from nplab.analysis.background_removal.asymmetric_least_squares import baseline_als
 
 def approximateLaserBg(xPl, yPl, yDf, plRange = [540, 820], plot = False):
     xTrunc, yTrunc = truncateSpectrum(xPl, yPl, startWl = 505, finishWl = plRange[1])#removes spike from laser leak
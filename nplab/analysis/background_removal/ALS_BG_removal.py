@@ -12,8 +12,7 @@ also known as the Whittaker method.
 @author: jb2444
 """
 import numpy as np
-from scipy import sparse
-from scipy.sparse.linalg import spsolve
+from nplab.analysis.background_removal import asymmetric_least_squares
 from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 #%% find index
@@ -32,16 +31,9 @@ def baseline_als(data, lda , p, niter=10):
     # generally 0.001 ≤ p ≤ 0.1 is a good choice (for a signal with positive peaks),
     # and 10^2 ≤ λ ≤ 10^9 , but exceptions may occur. 
     # In any case one should vary λ on a grid that is approximately linear for log λ
+    # data may also be a 2D array of spectra (one per row), which are baselined together
 
-  L = len(data)
-  D = sparse.csc_matrix(np.diff(np.eye(L), 2))
-  w = np.ones(L)
-  for i in range(niter):
-    W = sparse.spdiags(w, 0, L, L)
-    Z = W + lda * D.dot(D.transpose())
-    z = spsolve(Z, w*data)
-    w = p * (data > z) + (1-p) * (data < z)
-  return z
+  return asymmetric_least_squares.baseline_als(data, lda, p, niter=niter)
 
 
 #%% find local minima of vector for pre-processing of signal before ALS BG removal
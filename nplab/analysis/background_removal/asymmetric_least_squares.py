@@ -1,25 +1,154 @@
+"""
+Asymmetric least squares (ALS) baselines, shared by the analysis modules that remove backgrounds from spectra.
+
+The baseline z of a spectrum y minimises sum(w*(y - z)**2) + lam*sum(diff(z, 2)**2), where the weights w are
+p where the spectrum is above the baseline and 1 - p where it's below, iterated niter times (Eilers & Boelens, 2005).
+Each iteration solves (W + lam*D D^T) z = w*y, where D D^T is the second difference penalty.  That matrix is
+symmetric, positive definite and pentadiagonal, so we solve it as a banded matrix in O(L) time: the penalty's
+diagonals are cached for each (length, lam), and only the weights on the main diagonal change between iterations.
+
+A 2D array is treated as one spectrum per row.  Rows are solved together, with a banded LDL^T factorisation that's
+vectorised across the spectra, and can be shared between worker processes for large batches.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, wraps
+
 import numpy as np
 from scipy import sparse
-from scipy.sparse.linalg import spsolve
-from functools import wraps
+from scipy.linalg import solveh_banded
+
 from nplab.analysis import Spectrum
 
-def baseline_als(y, lam, p, niter=10):
-    """
-    y is the spectrum
-    lam is the smoothness, should be between 10**2 and 10**9
-    p is asymmetry, should be between 0.001 and 0.1
+# below this many spectra, solving them one at a time with LAPACK is quicker than the vectorised solver
+MIN_BATCH_SIZE = 256
+
+
+@lru_cache(maxsize=32)
+def penalty_diagonals(length, lam):
+    """Return the main, first and second diagonals of lam*D D^T, the smoothness penalty for `length` points.
+
+    The arrays are cached, so they are read-only.
     """
-    L = len(y)
-    D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(L, L - 2))
-    w = np.ones(L)
+    if length < 3:
+        raise ValueError("ALS baselines need spectra at least 3 points long")
+    D = sparse.diags([1, -2, 1], [0, -1, -2], shape=(length, length - 2), dtype=np.float64)
+    penalty = lam * D.dot(D.transpose())
+    diagonals = tuple(np.array(penalty.diagonal(k), dtype=np.float64) for k in range(3))
+    for d in diagonals:
+        d.flags.writeable = False
+    return diagonals
+
+
+@lru_cache(maxsize=32)
+def _penalty_upper_band(length, lam):
+    """The penalty in the "upper" banded form used by scipy.linalg.solveh_banded (cached, so read-only)."""
+    main, first, second = penalty_diagonals(length, lam)
+    band = np.zeros((3, length))
+    band[0, 2:] = second
+    band[1, 1:] = first
+    band[2] = main
+    band.flags.writeable = False
+    return band
+
+
+def _baseline_als_single(y, lam, p, niter):
+    """The ALS baseline of one spectrum, using LAPACK's banded Cholesky solver."""
+    penalty = _penalty_upper_band(len(y), lam)
+    band = np.empty_like(penalty)
+    w = np.ones(len(y))
     for _ in range(niter):
-        W = sparse.spdiags(w, 0, L, L)
-        Z = W + lam * D.dot(D.transpose())
-        z = spsolve(Z, w * y)
+        band[...] = penalty
+        band[2] += w
+        z = solveh_banded(band, w*y, check_finite=False)
         w = p * (y > z) + (1 - p) * (y < z)
     return z
 
+
+def _solve_pentadiagonal(main, first, second, b):
+    """Solve symmetric pentadiagonal systems, one per column, by LDL^T factorisation.
+
+    main and b are (L, N) arrays, holding the main diagonal and right-hand side of each of the N systems; first and
+    second are the off-diagonals (length L-1 and L-2), which are the same for every system.  Each step works on all
+    the systems at once, so the Python loop is over the L points rather than the N spectra.
+    """
+    length = main.shape[0]
+    d = np.empty_like(main)  # the diagonal of D
+    l1 = np.empty_like(main)  # L[i+1, i]
+    l2 = np.empty_like(main)  # L[i+2, i]
+    u = np.empty_like(b)
+    for i in range(length):
+        d[i] = main[i]
+        u[i] = b[i]
+        if i >= 1:
+            d[i] -= l1[i-1]**2 * d[i-1]
+            u[i] -= l1[i-1] * u[i-1]
+        if i >= 2:
+            d[i] -= l2[i-2]**2 * d[i-2]
+            u[i] -= l2[i-2] * u[i-2]
+        if i + 1 < length:
+            l1[i] = first[i]
+            if i >= 1:
+                l1[i] -= l2[i-1] * l1[i-1] * d[i-1]
+            l1[i] /= d[i]
+        if i + 2 < length:
+            l2[i] = second[i] / d[i]
+    z = u
+    z /= d
+    for i in range(length - 2, -1, -1):
+        z[i] -= l1[i] * z[i+1]
+        if i + 2 < length:
+            z[i] -= l2[i] * z[i+2]
+    return z
+
+
+def _baseline_als_batch(y, lam, p, niter):
+    """The ALS baselines of the rows of a 2D array, solved together."""
+    if y.shape[0] < MIN_BATCH_SIZE:
+        return np.array([_baseline_als_single(row, lam, p, niter) for row in y]).reshape(y.shape)
+    y = np.ascontiguousarray(y.T, dtype=np.float64)  # (L, N), so each step of the solver is a contiguous row
+    main, first, second = penalty_diagonals(y.shape[0], lam)
+    w = np.ones_like(y)
+    for _ in range(niter):
+        z = _solve_pentadiagonal(main[:, np.newaxis] + w, first, second, w*y)
+        w = p * (y > z) + (1 - p) * (y < z)
+    return z.T
+
+
+def _baseline_als_batch_star(args):
+    return _baseline_als_batch(*args)
+
+
+def baseline_als(y, lam, p, niter=10, processes=1, block_size=1024):
+    """
+    y is the spectrum, or a 2D array with one spectrum per row
+    lam is the smoothness, should be between 10**2 and 10**9
+    p is asymmetry, should be between 0.001 and 0.1
+    niter is the number of iterations
+
+    For 2D arrays, the spectra are processed in blocks of block_size rows (bigger blocks are quicker, up to a
+    point, but use more memory).  If processes is more than 1, blocks are shared between that many worker
+    processes (None means one per CPU).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    if y.ndim == 1:
+        return _baseline_als_single(y, lam, p, niter)
+    if y.ndim != 2:
+        raise ValueError("baseline_als needs a spectrum, or a 2D array of spectra")
+    if processes is None:
+        processes = os.cpu_count() or 1
+    blocks = [(y[i:i + block_size], lam, p, niter) for i in range(0, y.shape[0], block_size)]
+    processes = min(processes, len(blocks))
+    if processes <= 1:
+        baselines = [_baseline_als_batch(*block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            baselines = list(executor.map(_baseline_als_batch_star, blocks))
+    if len(baselines) == 0:
+        return np.empty_like(y)
+    return np.concatenate(baselines)
+
+
 @wraps(baseline_als)
 def als(y, lam=10**3, p=0.01, niter=10):
-    return baseline_als(y, lam, p, niter=niter)
\ No newline at end of file
+    return baseline_als(y, lam, p, niter=niter)
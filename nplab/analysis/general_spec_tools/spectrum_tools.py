@@ -25,6 +25,7 @@ import matplotlib.pyplot as plt
 import os
 
 from nplab.analysis.general_spec_tools import all_rc_params as arp
+from nplab.analysis.background_removal import asymmetric_least_squares
 
 #pyplot rcParams to make pretty Timescans:
 timescan_params = arp.master_param_dict['NPoM SERS Timescan']
@@ -171,32 +172,20 @@ def baseline_als(y, lam, p, niter=10):
     Calculates spectral baseline using iterative asymmetric least-squares fitting
 
     Parameters:
-        y: signal to be baselined; 1D array_like
+        y: signal to be baselined; 1D array_like, or 2D with one signal per row (baselined together, see
+            nplab.analysis.background_removal.asymmetric_least_squares)
         lam: (aka lambda) large number determining smoothness; typically 10^2 - 10^9
         p: small number (between 0 and 1); determines asymmetry; typically 10^-1 to 10^-3
             generally lam = 10^n and p = 10^-m; higher values of m or n increase "roughness" of baseline
         niter: number of iterations
 
     Returns:
-        z: baseline of signal; 1D numpy array with same length as y
+        z: baseline of signal; numpy array with same shape as y
     '''
 
     assert 0 < p < 1, 'p must be between 0 and 1 for baseline_als'
 
-    y = np.array(y)
-    
-    L = len(y)
-    D = sp.sparse.diags([1,-2,1],[0,-1,-2], shape=(L,L-2))
-    D = sp.sparse.csc_matrix(np.diff(np.eye(L), 2)) 
-    w = np.ones(L)
-
-    for i in range(niter):
-        W = sp.sparse.spdiags(w, 0, L, L)
-        Z = W + lam * D.dot(D.transpose())
-        z = sp.sparse.linalg.spsolve(Z, w*y)
-        w = p * (y > z) + (1-p) * (y < z)
-
-    return z
+    return asymmetric_least_squares.baseline_als(y, lam, p, niter = niter)
 
 def boltzmann_dist(x, a, A):
     '''
@@ -707,11 +696,11 @@ class Spectrum:
             if type(args[0]) in [list, np.ndarray]:#if only y data provided
                 self.y = args[0]
             
-            elif type(args[0]) == h5py._hl.dataset.Dataset:#if only open h5 dataset provided
+            elif isinstance(args[0], h5py._hl.dataset.Dataset):#if only open h5 dataset provided
                 self.dset = args[0]
                 self.name = self.dset.name.split('/')[-1]#extract name from dataset
 
-            elif type(args[0]) == h5py._hl.group.Group:#if h5 group provided by mistake
+            elif isinstance(args[0], h5py._hl.group.Group):#if h5 group provided by mistake
                 assert type(args[0]) == h5py._hl.dataset.Dataset, f'{args[0].name} is an h5 group, not a dataset; please provide a dataset instead'
             
         elif len(args) == 2:
@@ -720,7 +709,7 @@ class Spectrum:
                 
             else:#if h5 dset and spectrum are provided
                 for arg in args:
-                    if type(arg) == h5py._hl.dataset.Dataset:
+                    if isinstance(arg, h5py._hl.dataset.Dataset):
                         self.dset = arg
                         
                     elif type(arg) == str:
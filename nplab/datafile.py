@@ -4,6 +4,24 @@ NPLab Data Files
 
 This module provides the DataFile class, a subclass of h5py's File class with a few extended functions.  The Groups returned by a DataFile are subclassed h5py Groups, again to facilitate extended functions.
 
+Shared attributes
+-----------------
+Instruments save the same large arrays (wavelengths, references, backgrounds...) as metadata with every dataset.  If a
+file is created with ``DataFile(..., shared_attributes=True)``, array attributes bigger than
+``SHARED_ATTRIBUTE_MIN_BYTES`` are written once, into a hidden ``nplab_shared`` group named by the hash of their
+contents, and each dataset's attribute holds an HDF5 object reference to that copy instead.  The ``attrs`` of the
+Groups and Datasets returned by this module resolve these references transparently, so reading code doesn't change
+(plain h5py will show the references, which can be read with ``f[dset.attrs[key]][()]``).
+
+Asynchronous writes
+-------------------
+If a file is opened with ``DataFile(..., async_writes=True)``, ``create_dataset`` and ``append_dataset`` calls on any
+of its groups (including those made by instruments) are queued and run by a single writer thread, so acquisition
+doesn't wait for the disk.  The data are copied when the call is queued; if the queue is full the caller waits
+(back-pressure).  ``create_dataset`` then returns a DatasetFuture, which behaves like the dataset once it has been
+written (waiting for it if needed).  ``DataFile.wait_until_written()`` waits for the queue to empty and raises any
+error that happened in the writer thread.
+
 
 :author: Richard Bowman
 """
@@ -16,6 +34,15 @@ import os.path
 import datetime
 import re
 import sys
+import hashlib
+import logging
+import time
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from concurrent.futures import Future
 try:
     from collections import Sequence
 except ImportError:
@@ -26,12 +53,61 @@ from nplab.utils.show_gui_mixin import ShowGUIMixin
 from nplab.utils.array_with_attrs import DummyHDF5Group
 
 
+SHARED_ATTRIBUTES_GROUP = "nplab_shared"
+SHARED_ATTRIBUTE_MIN_BYTES = 1024
+
+
+def shared_attribute_reference(group_or_dataset, value):
+    """Return a reference to a shared copy of value, or None if it shouldn't be shared.
+
+    Arrays of at least SHARED_ATTRIBUTE_MIN_BYTES are stored once per file, in the nplab_shared group, named by the
+    hash of their dtype, shape and contents.  This only happens if the file has a nplab_shared group (see
+    ``DataFile(shared_attributes=True)``).
+    """
+    if not isinstance(value, np.ndarray) or value.nbytes < SHARED_ATTRIBUTE_MIN_BYTES or value.dtype.hasobject:
+        return None
+    shared_group = group_or_dataset.file.get(SHARED_ATTRIBUTES_GROUP)
+    if shared_group is None:
+        return None
+    value = np.ascontiguousarray(value)
+    content_hash = hashlib.sha1(("%s%s" % (value.dtype.str, value.shape)).encode())
+    content_hash.update(value.view(np.uint8).reshape(-1))
+    key = content_hash.hexdigest()
+    if key not in shared_group:
+        h5py.Group.create_dataset(shared_group, key, data=value)
+    return shared_group[key].ref
+
+
+def resolve_shared_attribute(attrs, value):
+    """If value is a reference to a shared attribute, return the shared array, otherwise return value unchanged."""
+    if isinstance(value, h5py.Reference) and value:
+        target = h5py.h5r.dereference(value, attrs._id)
+        if target is not None and isinstance(target, h5py.h5d.DatasetID):
+            name = h5py.h5i.get_name(target)
+            if name is not None and name.startswith(("/" + SHARED_ATTRIBUTES_GROUP + "/").encode()):
+                return h5py.Dataset(target)[()]
+    return value
+
+
+class AttributeManager(h5py.AttributeManager):
+    """HDF5 attributes, resolving shared attributes transparently (see shared_attribute_reference)."""
+
+    def __getitem__(self, name):
+        return resolve_shared_attribute(self, super(AttributeManager, self).__getitem__(name))
+
+
 def attributes_from_dict(group_or_dataset, dict_of_attributes):
-    """Update the metadata of an HDF5 object with a dictionary."""
+    """Update the metadata of an HDF5 object with a dictionary.
+
+    Large array values are stored as references to shared copies, if the file supports it (see
+    shared_attribute_reference)."""
     attrs = group_or_dataset.attrs
     for key, value in list(dict_of_attributes.items()):
         if value is not None:
             try:
+                reference = shared_attribute_reference(group_or_dataset, value)
+                if reference is not None:
+                    value = reference
                 attrs[key] = value
             except TypeError:
                 print("Warning, metadata {0}='{1}' can't be saved in HDF5.  Saving with str()".format(key, value))
@@ -108,12 +184,14 @@ def transpose_datafile(data_set):
     parent.create_dataset(file_name,data = transposed_datafile)
 
 def wrap_h5py_item(item):
-    """Wrap an h5py object: groups are returned as Group objects, datasets are unchanged."""
+    """Wrap an h5py object: groups are returned as Group objects, datasets as Dataset objects."""
     if isinstance(item, h5py.Group):
         # wrap groups before returning them (this makes our group objects rather than h5py.Group)
         return Group(item.id)
+    elif isinstance(item, h5py.Dataset) and not isinstance(item, Dataset):
+        return Dataset(item.id)
     else:
-        return item  # for now, don't bother wrapping datasets
+        return item
 
 def ensure_str(str_or_bytes):
     if type(str_or_bytes) in (bytes, np.bytes_):
@@ -140,12 +218,82 @@ def sort_by_timestamp(hdf5_group):
     items_lists = [(key, hdf5_group[key]) for key in keys]
     return items_lists
 
+class _NumberedNameIndex(object):
+    """An index of the numbered names (e.g. spectrum_0, spectrum_1...) in a group.
+
+    Names are split into a prefix and the number at the end, and we keep the set of numbers used with each prefix,
+    plus the lowest number that might be free.  That makes finding the next free name constant-time, rather than
+    probing the file once for every existing item.  The index is updated as nplab creates and deletes items; changes
+    made some other way (another handle or process) are caught by Group._numbered_name_index, which rebuilds the
+    index if the number of items in the group doesn't match, and by checking the names it returns really exist.
+    """
+
+    def __init__(self, names):
+        self.numbers = dict()
+        self.lowest_free = dict()
+        self.names = set()
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """Add an item's name to the index"""
+        self.names.add(name)
+        m = re.match(r"(.*?)(\d+)$", name)
+        if m:
+            self.numbers.setdefault(m.group(1), set()).add(m.group(2))
+
+    def remove(self, name):
+        """Remove an item's name from the index"""
+        self.names.discard(name)
+        m = re.match(r"(.*?)(\d+)$", name)
+        if m and m.group(2) in self.numbers.get(m.group(1), ()):
+            self.numbers[m.group(1)].remove(m.group(2))
+            if m.group(2) == str(int(m.group(2))):
+                self.lowest_free[m.group(1)] = min(self.lowest_free.get(m.group(1), 0), int(m.group(2)))
+
+    def next_free_number(self, prefix):
+        """Return the lowest n such that prefix + str(n) is not in the index"""
+        used = self.numbers.get(prefix, set())
+        n = self.lowest_free.get(prefix, 0)
+        while str(n) in used:
+            n += 1
+        self.lowest_free[prefix] = n
+        return n
+
+    def keys_with_prefix(self, name, separator_regex):
+        """Return names that are `name`, then a string matching separator_regex, then a number"""
+        return [prefix + number for prefix, numbers in self.numbers.items()
+                if prefix.startswith(name) and re.match(separator_regex, prefix[len(name):])
+                for number in numbers]
+
+
+_name_indices = dict()
+_name_index_lock = threading.RLock()
+
+
+class Dataset(h5py.Dataset):
+    """HDF5 Dataset.
+
+    NPLab "wraps" h5py's Dataset objects so that shared attributes are resolved when reading ``attrs``.
+    """
+
+    @property
+    def attrs(self):
+        """Attributes attached to this dataset (shared attributes are resolved transparently)"""
+        return AttributeManager(self)
+
+
 class Group(h5py.Group, ShowGUIMixin):
     """HDF5 Group, a collection of datasets and subgroups.
 
     NPLab "wraps" h5py's Group objects to provide extra functions.
     """
 
+    @property
+    def attrs(self):
+        """Attributes attached to this group (shared attributes are resolved transparently)"""
+        return AttributeManager(self)
+
     def __getitem__(self, key):
         item = super(Group, self).__getitem__(key)  # get the dataset or group
         return wrap_h5py_item(item) #wrap as a Group if necessary
@@ -159,17 +307,56 @@ class Group(h5py.Group, ShowGUIMixin):
         """Find a unique name for a subgroup or dataset in this group.
 
         :param name: If this contains a %d placeholder, it will be replaced with the lowest integer such that the new name is unique.  If no %d is included, _%d will be appended to the name if the name already exists in this group.
+
+        Names ending in %d are looked up in an index of the numbered items in this group (see _NumberedNameIndex),
+        so this takes constant time however many items there are.
         """
-        if "%d" not in name and name not in list(self.keys()):
+        if "%d" not in name and name not in self:
             return name  # simplest case: it's a unique name
         else:
-            n = 0
             if "%d" not in name:
                 name += "_%d"
+            prefix = name[:-2]
+            if name.endswith("%d") and "%" not in prefix:
+                with _name_index_lock:
+                    n = self._numbered_name_index().next_free_number(prefix)
+                    if (prefix + str(n)) in self:
+                        # the group was changed behind our back (e.g. by another handle or process): start again
+                        n = self._numbered_name_index(rebuild=True).next_free_number(prefix)
+                    if (prefix + str(n)) not in self:
+                        return prefix + str(n)
+            n = 0
             while (name % n) in self:
                 n += 1  # increase the number until the name's unique
             return (name % n)
 
+    def _numbered_name_index(self, rebuild=False):
+        """Return the index of numbered names in this group, building it from the group's keys if needed.
+
+        The index is also rebuilt if it has the wrong number of names, i.e. the group has been changed by another
+        handle or process.
+        """
+        key = (self.file.filename, self.name)
+        index = _name_indices.get(key)
+        if index is None or rebuild or len(index.names) != len(self):
+            index = _NumberedNameIndex(list(self.keys()))
+            _name_indices[key] = index
+        return index
+
+    def _register_new_name(self, name):
+        """Update the index of numbered names after creating an item called `name`."""
+        with _name_index_lock:
+            index = _name_indices.get((self.file.filename, self.name))
+            if index is not None:
+                index.add(name)
+
+    def __delitem__(self, name):
+        super(Group, self).__delitem__(name)
+        with _name_index_lock:
+            index = _name_indices.get((self.file.filename, self.name))
+            if index is not None:
+                index.remove(name)
+
     def numbered_items(self, name):
         """Get a list of datasets/groups that have a given name + number,
         sorted by the number appended to the end.
@@ -179,9 +366,7 @@ class Group(h5py.Group, ShowGUIMixin):
         come in alphabetical order, so 10 comes before 2).  `name` is the
         name passed in without the _0 suffix.
         """
-        items = [wrap_h5py_item(v) for k, v in list(self.items())
-                 if k.startswith(name)  # only items that start with `name`
-                 and re.match(r"_*(\d+)$", k[len(name):])]  # and end with numbers
+        items = [wrap_h5py_item(self[k]) for k in self._numbered_keys(name)]
         return sorted(items, key=h5_item_number)
 
     def count_numbered_items(self, name):
@@ -190,11 +375,19 @@ class Group(h5py.Group, ShowGUIMixin):
         If all you need to do is count how many items match a name, this is
         a faster way to do it than len(group.numbered_items("name")).
         """
-        n = 0
-        for k in list(self.keys()):
-            if k.startswith(name) and re.match(r"_*(\d+)$", k[len(name):]):
-                n += 1
-                return n
+        return len(self._numbered_keys(name))
+
+    def _numbered_keys(self, name):
+        """The names of items that are `name`, then optionally underscores, then a number."""
+        if re.search(r"\d$", name):  # the index splits names at the last non-digit, so can't be used here
+            return [k for k in list(self.keys())
+                    if k.startswith(name)  # only items that start with `name`
+                    and re.match(r"_*(\d+)$", k[len(name):])]  # and end with numbers
+        with _name_index_lock:
+            keys = self._numbered_name_index().keys_with_prefix(name, r"_*$")
+            if not all(k in self for k in keys):  # the group was changed behind our back: start again
+                keys = self._numbered_name_index(rebuild=True).keys_with_prefix(name, r"_*$")
+            return keys
 
     def create_group(self, name, attrs=None, auto_increment=True, timestamp=True):
         """Create a new group, ensuring we don't overwrite old ones.
@@ -212,6 +405,7 @@ class Group(h5py.Group, ShowGUIMixin):
         if auto_increment and name is not None:
             name = self.find_unique_name(name) #name is None if creating via the dict interface
         g = super(Group, self).create_group(name)
+        self._register_new_name(name)
         if timestamp:
             g.attrs.create('creation_timestamp', datetime.datetime.now().isoformat().encode())
         if attrs is not None:
@@ -236,10 +430,22 @@ class Group(h5py.Group, ShowGUIMixin):
         :param timestamp: if True (default), we save a "creation_timestamp" attribute with the current time.
 
         Further arguments are passed to h5py.Group.create_dataset.
+
+        If the file has asynchronous writes enabled, this returns a DatasetFuture straight away, and the dataset is
+        created by the writer thread.
         """
+        writer = _async_writers.get(self.file.filename)
+        if writer is not None and not writer.in_writer_thread():
+            attrs = dict(attrs) if attrs is not None else dict()
+            if timestamp:  # record when the data were taken, not when they were written
+                attrs['creation_timestamp'] = datetime.datetime.now().isoformat().encode()
+            return writer.submit(Group.create_dataset, self, name, auto_increment, shape, dtype, _copy_data(data),
+                                 attrs, False, autoflush, *args, **kwargs)
         if auto_increment and name is not None: #name is None if we are creating via the dict interface
             name = self.find_unique_name(name)
         dset = super(Group, self).create_dataset(name, shape, dtype, data, *args, **kwargs)
+        if name is not None:
+            self._register_new_name(name)
         if timestamp:
             dset.attrs.create('creation_timestamp', datetime.datetime.now().isoformat().encode())
         if hasattr(data, "attrs"): #if we have an ArrayWithAttrs, use the attrs!
@@ -248,7 +454,7 @@ class Group(h5py.Group, ShowGUIMixin):
             attributes_from_dict(dset, attrs)  # quickly set the attributes
         if autoflush==True:
             dset.file.flush()
-        return dset
+        return Dataset(dset.id)
 
     create_dataset.__doc__ += '\n\n'+h5py.Group.create_dataset.__doc__
 
@@ -265,8 +471,9 @@ class Group(h5py.Group, ShowGUIMixin):
     def create_resizable_dataset(self, name, shape=(0,), maxshape=(None,), auto_increment=True, dtype=None, attrs=None, timestamp=True,
                                  *args, **kwargs):
         """See create_dataset documentation"""
-        return self.create_dataset(name, auto_increment, shape, dtype, attrs, timestamp,
-                                   maxshape=maxshape, chunks=True, *args, **kwargs)
+        kwargs.setdefault('chunks', True)
+        return self.create_dataset(name, auto_increment, shape, dtype, None, attrs, timestamp,
+                                   maxshape=maxshape, *args, **kwargs)
 
     def require_resizable_dataset(self, name, shape=(0,), maxshape=(None,), auto_increment=True, dtype=None, attrs=None, timestamp=True,
                                   *args, **kwargs):
@@ -283,7 +490,19 @@ class Group(h5py.Group, ShowGUIMixin):
         attributes_from_dict(self, attribute_dict)
 
     def append_dataset(self, name, value, dtype=None):
-        """Append the given data to an existing dataset, creating it if it doesn't exist."""
+        """Append the given data to an existing dataset, creating it if it doesn't exist.
+
+        If an AppendBuffer is open for this dataset (see append_buffer), the value goes into the buffer instead, and
+        is written to the file with the next block of rows.  If the file has asynchronous writes enabled, the value
+        is queued for the writer thread."""
+        writer = _async_writers.get(self.file.filename)
+        if writer is not None and not writer.in_writer_thread():
+            writer.submit(Group.append_dataset, self, name, _copy_data(value), dtype)
+            return
+        buffer = _append_buffers.get(_append_buffer_key(self, name))
+        if buffer is not None:
+            buffer.append(value)
+            return
         if name not in self:
             if hasattr(value, 'shape'):
                 shape = (0,)+value.shape
@@ -302,6 +521,20 @@ class Group(h5py.Group, ShowGUIMixin):
         dset.resize(index+1,0)
         dset[index,...] = value
 
+    def append_buffer(self, name, dtype=None, **kwargs):
+        """Return an AppendBuffer that appends rows to the dataset `name`, creating it if needed.
+
+        While the buffer is open, append_dataset calls for this dataset also go through it.  Use it as a context
+        manager, or call close() when finished, so the dataset is trimmed to the number of rows appended.  Further
+        arguments are passed to AppendBuffer.
+        """
+        key = _append_buffer_key(self, name)
+        if key in _append_buffers:
+            return _append_buffers[key]
+        buffer = AppendBuffer(self, name, dtype=dtype, **kwargs)
+        _append_buffers[key] = buffer
+        return buffer
+
     def get_qt_ui(self):
         """Return a file browser widget for this group."""
         # Sorry about the dynamic import - the alternative is always
@@ -326,7 +559,8 @@ class DataFile(Group):
     """
 
     def __init__(self, name, mode='a', save_version_info=False,
-                 update_current_group=True, *args, **kwargs):
+                 update_current_group=True, shared_attributes=False, async_writes=False, async_queue_size=100,
+                 *args, **kwargs):
         """Open or create an HDF5 file.
 
         :param name: The filename/path of the HDF5 file to open or create, or an h5py File object
@@ -343,6 +577,11 @@ class DataFile(Group):
                 Open read/write if the file exists, otherwise create it.
         :param save_version_info: If True (default), save a string attribute at top-level
         with information about the current module and system.
+        :param shared_attributes: If True, store large array attributes once per file and reference them from each
+        dataset (see the module documentation).  This is remembered by the file, so only needs to be set when it's
+        created.
+        :param async_writes: If True, datasets are written by a background thread (see the module documentation).
+        :param async_queue_size: The number of writes that may be queued before callers have to wait.
         """
         if isinstance(name, h5py.Group):
             f = name #if it's already an open file, just use it
@@ -372,13 +611,38 @@ class DataFile(Group):
             except:
                print("Error: could not save version information")
         self.update_current_group = update_current_group
+        with _name_index_lock:  # forget anything we knew about a file that used to have this name
+            for key in [k for k in _name_indices if k[0] == self.file.filename]:
+                del _name_indices[key]
+        if shared_attributes and self.file.mode != 'r':
+            h5py.Group.require_group(self, SHARED_ATTRIBUTES_GROUP)
+        if async_writes and self.file.filename not in _async_writers:
+            _async_writers[self.file.filename] = AsyncWriter(async_queue_size)
         
 
     def flush(self):
+        self.wait_until_written()
+        for buffer in _open_append_buffers(self):
+            buffer.flush()
         self.file.flush()
 
     def close(self):
+        writer = _async_writers.pop(self.file.filename, None)
+        if writer is not None:
+            writer.stop()
+        for buffer in _open_append_buffers(self):
+            buffer.close()
         self.file.close()
+        if writer is not None:
+            writer.raise_errors()
+
+    def wait_until_written(self, timeout=None):
+        """Wait until all queued asynchronous writes are done, and raise any error that occurred in them.
+
+        Does nothing if asynchronous writes are not enabled."""
+        writer = _async_writers.get(self.file.filename)
+        if writer is not None:
+            writer.wait_until_written(timeout)
 
     def make_current(self):
         """Set this as the default location for all new data."""
@@ -395,6 +659,224 @@ class DataFile(Group):
         """ Returns the path of the datafolder the current datafile is in"""
         return os.path.dirname(self.file.filename)
 
+def _copy_data(data):
+    """Copy an array before it's queued for writing, so the caller can reuse it"""
+    if isinstance(data, np.ndarray):
+        return data.copy()  # keeps the attrs of ArrayWithAttrs
+    return data
+
+
+class DatasetFuture(Future):
+    """The result of an asynchronous create_dataset call.
+
+    Once the write is done, ``result()`` returns the dataset.  For compatibility with code that expects a dataset,
+    attribute access and indexing are passed on to the dataset, waiting for it to be written first.
+    """
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return getattr(self.result(), item)
+
+    def __getitem__(self, key):
+        return self.result()[key]
+
+    def __setitem__(self, key, value):
+        self.result()[key] = value
+
+    def __len__(self):
+        return len(self.result())
+
+
+class AsyncWriter(object):
+    """A thread that runs queued writes to an HDF5 file, one at a time and in order."""
+
+    def __init__(self, max_queue_size=100):
+        self._queue = queue.Queue(max_queue_size)
+        self._errors = []
+        self._thread = threading.Thread(target=self._run, name="nplab datafile writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def in_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, function, *args, **kwargs):
+        """Queue function(*args, **kwargs) to run in the writer thread, waiting if the queue is full.
+
+        :return: a DatasetFuture for the return value of the function
+        """
+        future = DatasetFuture()
+        self._queue.put((future, function, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                future, function, args, kwargs = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(function(*args, **kwargs))
+                except Exception as e:
+                    # errors are raised again by wait_until_written, but that may be much later (or never)
+                    logging.getLogger(__name__).error("Error in asynchronous write: %s", e, exc_info=True)
+                    self._errors.append(e)
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def raise_errors(self):
+        """Raise the first error that occurred in the writer thread since the last call, if there was one."""
+        errors, self._errors = self._errors, []
+        if len(errors) > 0:
+            raise errors[0]
+
+    def wait_until_written(self, timeout=None):
+        """Wait for the queue to empty, then raise any errors from the writes."""
+        if not self.in_writer_thread():
+            self.submit(lambda: None).result(timeout)
+        self.raise_errors()
+
+    def stop(self):
+        """Finish the queued writes and stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+_async_writers = dict()
+_append_buffers = dict()
+
+
+def _append_buffer_key(group, name):
+    """The key of a dataset in the table of open AppendBuffers"""
+    return group.file.filename, group.name.rstrip("/") + "/" + name
+
+
+def _open_append_buffers(group):
+    """Return the open AppendBuffers writing to the same file as group"""
+    return [b for k, b in list(_append_buffers.items()) if k[0] == group.file.filename]
+
+
+class AppendBuffer(object):
+    """Collect rows in memory and append them to a resizable dataset in blocks.
+
+    Appending a row at a time (as append_dataset does) resizes the dataset and writes to the file for every row.
+    This class keeps up to `buffer_rows` rows in memory, and writes them in one go when the buffer is full, or when
+    `flush_interval` seconds have passed since the last write.  The dataset is grown geometrically, in whole chunks,
+    so it is only resized occasionally; close() trims it to the number of rows actually appended.
+
+    If crash_safe is True (the default), every block written also updates the dataset's "valid_length" attribute
+    and flushes the file, so after a crash everything up to the last block can be recovered (rows beyond
+    valid_length are padding).  Set it to False for speed if losing the whole run on a crash is acceptable.
+    """
+    valid_length_attribute = "valid_length"
+
+    def __init__(self, group, name, dtype=None, buffer_rows=64, flush_interval=1.0, chunk_rows=None,
+                 growth_factor=2.0, crash_safe=True, attrs=None):
+        """Create a buffer for the dataset `name` in `group` (created on the first append if it doesn't exist).
+
+        :param dtype: data type of a new dataset (defaults to that of the first row)
+        :param buffer_rows: write to the file every time this many rows are buffered
+        :param flush_interval: also write if this many seconds have passed since the last write (None to disable)
+        :param chunk_rows: number of rows in an HDF5 chunk of a new dataset (defaults to buffer_rows)
+        :param growth_factor: the dataset's allocated length is multiplied by this when it's full
+        :param crash_safe: update the valid_length attribute and flush the file after each block (see above)
+        :param attrs: metadata to save with a new dataset
+        """
+        self.group = group
+        self.name = name
+        self.dtype = dtype
+        self.buffer_rows = buffer_rows
+        self.flush_interval = flush_interval
+        self.chunk_rows = chunk_rows if chunk_rows is not None else buffer_rows
+        self.growth_factor = growth_factor
+        self.crash_safe = crash_safe
+        self.attrs = attrs
+        self.dataset = None
+        self.length = 0
+        self._buffer = None
+        self._n_buffered = 0
+        self._last_flush = time.time()
+        if name in group:
+            self._open_dataset(group[name])
+
+    def _open_dataset(self, dset):
+        """Start appending to an existing dataset"""
+        self.dataset = dset
+        self.length = int(dset.attrs.get(self.valid_length_attribute, dset.shape[0]))
+        self._buffer = np.empty((self.buffer_rows,) + dset.shape[1:], dtype=dset.dtype)
+
+    def _create_dataset(self, row):
+        """Create the dataset, with the shape of row and room for one buffer"""
+        row_shape = row.shape
+        dtype = self.dtype if self.dtype is not None else row.dtype
+        dset = self.group.create_resizable_dataset(self.name, shape=(0,) + row_shape, maxshape=(None,) + row_shape,
+                                                   auto_increment=False, dtype=dtype, attrs=self.attrs,
+                                                   chunks=(self.chunk_rows,) + row_shape)
+        self._open_dataset(dset)
+
+    def __len__(self):
+        """The number of rows appended, including those not yet written to the file"""
+        return self.length + self._n_buffered
+
+    def append(self, value):
+        """Add one row to the dataset"""
+        value = np.asarray(value)
+        if self.dataset is None:
+            self._create_dataset(value)
+        self._buffer[self._n_buffered] = value
+        self._n_buffered += 1
+        if self._n_buffered >= self.buffer_rows or \
+                (self.flush_interval is not None and time.time() - self._last_flush > self.flush_interval):
+            self.flush()
+
+    def extend(self, values):
+        """Add several rows to the dataset"""
+        for value in values:
+            self.append(value)
+
+    def flush(self):
+        """Write any buffered rows to the dataset"""
+        self._last_flush = time.time()
+        if self._n_buffered == 0:
+            return
+        dset = self.dataset
+        new_length = self.length + self._n_buffered
+        if new_length > dset.shape[0]:
+            allocated = max(new_length, int(dset.shape[0] * self.growth_factor))
+            allocated = -(-allocated // self.chunk_rows) * self.chunk_rows  # round up to whole chunks
+            dset.resize(allocated, axis=0)
+        dset[self.length:new_length, ...] = self._buffer[:self._n_buffered]
+        self.length = new_length
+        self._n_buffered = 0
+        if self.crash_safe:
+            dset.attrs[self.valid_length_attribute] = self.length
+            dset.file.flush()
+
+    def close(self):
+        """Write any buffered rows, and trim the dataset to the number of rows appended"""
+        if self.dataset is not None:
+            self.flush()
+            if self.dataset.shape[0] != self.length:
+                self.dataset.resize(self.length, axis=0)
+            if self.valid_length_attribute in self.dataset.attrs:
+                del self.dataset.attrs[self.valid_length_attribute]
+            self.dataset.file.flush()
+        key = _append_buffer_key(self.group, self.name)
+        if _append_buffers.get(key) is self:
+            del _append_buffers[key]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 _current_datafile = None
 
 def current(create_if_none=True, create_if_closed=True, mode='a',working_directory = None):
@@ -477,7 +959,7 @@ def set_temporary_current_datafile():
     """Create a temporary datafile, for testing purposes."""
     nplab.log("WARNING: using a temporary file")
     print("WARNING: using a file in memory as the current datafile.  DATA WILL NOT BE SAVED.")
-    df = h5py.File("temporary_file.h5", driver='core', backing_store=False)
+    df = h5py.File("temporary_file.h5", mode="w", driver='core', backing_store=False)
     return set_current(df)
 
 def close_current():
@@ -8,7 +8,8 @@ __author__ = 'alansanders'
 
 from nplab.experiment.scanning_experiment import ScanningExperimentHDF5, GridScanQt
 from nplab.instrument.stage import Stage
-from nplab.instrument.spectrometer import Spectrometer, Spectrometers
+from nplab.instrument.spectrometer import (Spectrometer, Spectrometers, spectrum_corrections,
+                                           apply_spectrum_corrections)
 from nplab.instrument.light_sources import LightSource
 from nplab.instrument.shutter import Shutter
 from nplab.utils.gui import *
@@ -19,8 +20,12 @@ import matplotlib
 import warnings
 import time
 
-matplotlib.use('Qt4Agg')
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
+if QtCore.qVersion().startswith('5'):
+    matplotlib.use('Qt5Agg')
+    from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+else:
+    matplotlib.use('Qt4Agg')
+    from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 import matplotlib.gridspec as gridspec
 #from nplab.ui.mpl_gui import FigureCanvasWithDeferredDraw as FigureCanvas
 from matplotlib.figure import Figure
@@ -35,6 +40,33 @@ pg.setConfigOption('foreground', 'k')
 
 # TODO: hyperspectral image renderer
 
+PROCESSING_METADATA = ('background', 'reference', 'integration_time', 'background_int', 'reference_int',
+                       'variable_int_enabled', 'background_constant', 'background_gradient', 'absorption_enabled')
+
+
+def process_hs_image(raw_data, wavelength_index=None):
+    """Compute processed spectra from a raw hyperspectral image, using the metadata saved with it.
+
+    This does the same background subtraction and referencing as `Spectrometer.process_spectrum`,
+    using the background, reference etc. stored in the attributes of the raw data.
+
+    :param raw_data: the raw hyperspectral image (usually scan['raw_data/hs_image'])
+    :param wavelength_index: if specified, return only the image at this index along the last axis
+    """
+    settings = dict((name, raw_data.attrs.get(name)) for name in PROCESSING_METADATA)
+    if wavelength_index is None:
+        spectra = np.asarray(raw_data[...], dtype=np.float64)
+    else:
+        spectra = np.asarray(raw_data[..., wavelength_index], dtype=np.float64)
+        for name, value in settings.items():
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                settings[name] = value[[wavelength_index]]  # keep it an array, spectrum_corrections edits it
+    spectrometer_settings = type('SpectrometerSettings', (object,), settings)()
+    offset, gain = spectrum_corrections(spectrometer_settings)
+    # spectra is usually a copy read from the file, which we can process in place (but not if it's a view of raw_data)
+    return apply_spectrum_corrections(spectra, offset, gain, settings['absorption_enabled'],
+                                      out=spectra if spectra.flags.owndata else None)
+
 
 class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
     view_layer_updated = QtCore.Signal(int)
@@ -53,6 +85,9 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
         self.view_wavelength = 600
         self.view_layer = 0
         self.override_view_layer = False  # used to manually show a specific layer instead of current one scanning
+        self.raw_only = False  # if True, save only the raw spectra, in their original dtype (see open_scan)
+        self.compression = None  # compression of the raw data if raw_only is True, e.g. 'gzip' or 'lzf'
+        self.compression_opts = None
 
     @property
     def view_layer(self):
@@ -93,9 +128,18 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
     def open_scan(self):
         super(HyperspectralScan, self).open_scan()
         group = self.f.require_group('hyperspectral_images')
-        self.data = group.create_group('scan_%d', attrs=dict(description=self.description))
+        self.data = group.create_group('scan_%d', attrs=dict(description=self.description, raw_only=self.raw_only))
         print('Saving scan to: {}'.format(self.f.file.filename), self.data)
         raw_group = self.data.create_group('raw_data')
+        self._metadata = [None] * self.num_spectrometers
+        self._row_buffers = [None] * self.num_spectrometers
+        self._row_indices = None
+        self._row_filled = np.zeros(self.grid_shape[-1], dtype=bool)
+        # the live view is kept in memory, so we don't need to read it back from the file
+        self._acquired = np.zeros(self.grid_shape, dtype=bool)
+        self._live_views = [np.full(self.grid_shape, np.nan) for i in range(self.num_spectrometers)]
+        self._live_view_indices = [None] * self.num_spectrometers
+        self._latest_spectra = [None] * self.num_spectrometers
         for axis_name, axis_values in zip(self.axes_names, self.scan_axes):
             self.data.create_dataset(axis_name, data=axis_values)
         for i in range(self.num_spectrometers):
@@ -103,6 +147,11 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
             spectrometer = self.spectrometer.spectrometers[i]\
                 if isinstance(self.spectrometer, Spectrometers) else self.spectrometer
             self.data.create_dataset('wavelength'+suffix, data=spectrometer.wavelengths)
+            self._live_view_indices[i] = abs(spectrometer.wavelengths - self.view_wavelength).argmin()
+            if self.raw_only:
+                # the raw data are saved a row at a time (see flush_row_buffers), when we know their dtype
+                self._metadata[i] = spectrometer.metadata
+                continue
             self.data.create_dataset('hs_image'+suffix,
                                      shape=self.grid_shape + (spectrometer.wavelengths.size,),
                                      dtype=np.float64,
@@ -120,6 +169,7 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
         self.init_figure()
 
     def close_scan(self):
+        self.flush_row_buffers()
         super(HyperspectralScan, self).close_scan()
         self.data.file.flush()
         time.sleep(0.1)
@@ -130,11 +180,24 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
                 self.light_source.power = 0
 
     def scan_function(self, *indices):
+        self.process_data(self.acquire(*indices), *indices)
+
+    def acquire(self, *indices):
         time.sleep(self.delay)
-        raw_spectra = self.read_spectra()
+        return self.read_spectra()
+
+    def process_data(self, raw_spectra, *indices):
         spectra = self.process_spectra(raw_spectra)
-        self.data['raw_data/hs_image'+self._suffix(0)][indices] = raw_spectra
-        self.data['hs_image'+self._suffix(0)][indices] = spectra
+        if self.raw_only:
+            self._buffer_raw_spectra(raw_spectra, indices)
+        else:
+            self.data['raw_data/hs_image'+self._suffix(0)][indices] = raw_spectra
+            self.data['hs_image'+self._suffix(0)][indices] = spectra
+        self._acquired[indices] = True
+        for i, spectrum in enumerate(self._per_spectrometer(spectra)):
+            if self._live_view_indices[i] is not None:
+                self._live_views[i][indices] = spectrum[self._live_view_indices[i]]
+            self._latest_spectra[i] = spectrum
 #        for i, (spectrum, raw_spectrum) in enumerate(zip(spectra, raw_spectra)):
 #            try:
 #                suffix = self._suffix(i)
@@ -144,26 +207,85 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
 #                print e
         self.check_for_data_request(*self.set_latest_view(*indices))
 
+    def _per_spectrometer(self, spectra):
+        """Return a list with the spectrum from each spectrometer."""
+        return spectra if isinstance(self.spectrometer, Spectrometers) else [spectra]
+
+    def _buffer_raw_spectra(self, raw_spectra, indices):
+        """Store raw spectra until a row of the scan is complete, then save the row in one go."""
+        if self._row_indices != indices[:-1]:
+            self.flush_row_buffers()
+            self._row_indices = indices[:-1]
+        for i, spectrum in enumerate(self._per_spectrometer(raw_spectra)):
+            spectrum = np.asarray(spectrum)
+            if self._row_buffers[i] is None:
+                self._row_buffers[i] = np.zeros((self.grid_shape[-1],) + spectrum.shape, dtype=spectrum.dtype)
+            self._row_buffers[i][indices[-1]] = spectrum
+        self._row_filled[indices[-1]] = True
+        if np.all(self._row_filled):
+            self.flush_row_buffers()
+
+    def flush_row_buffers(self):
+        """Save the raw spectra of the current row (if raw_only is True)."""
+        if not self.raw_only or self._row_indices is None:
+            return
+        for i, buffer in enumerate(self._row_buffers):
+            dset = self._raw_dataset(i, buffer)
+            if np.all(self._row_filled):
+                dset[self._row_indices] = buffer  # a whole chunk, so it's compressed and written once
+            else:
+                for j in np.flatnonzero(self._row_filled):
+                    dset[self._row_indices + (j,)] = buffer[j]
+        self._row_filled[:] = False
+        self._row_indices = None
+
+    def _raw_dataset(self, i, row_buffer):
+        """The dataset for raw data from the i-th spectrometer, created with one chunk per scan row"""
+        name = 'raw_data/hs_image'+self._suffix(i)
+        if name not in self.data:
+            chunks = (1,) * (len(self.grid_shape) - 1) + row_buffer.shape
+            self.data.create_dataset(name, shape=self.grid_shape + row_buffer.shape[1:], dtype=row_buffer.dtype,
+                                     chunks=chunks, compression=self.compression,
+                                     compression_opts=self.compression_opts,
+                                     shuffle=self.compression is not None, attrs=self._metadata[i])
+        return self.data[name]
+
+    def _reload_live_view(self, i, w):
+        """Read the live view for a new wavelength from the file"""
+        suffix = self._suffix(i)
+        self._live_view_indices[i] = w
+        if self.raw_only:
+            self.flush_row_buffers()
+            if 'raw_data/hs_image'+suffix not in self.data:
+                return
+            view = process_hs_image(self.data['raw_data/hs_image'+suffix], wavelength_index=w)
+        else:
+            view = self.data['hs_image'+suffix][..., w]
+        view[np.logical_not(self._acquired)] = np.nan
+        self._live_views[i] = view
+
     def set_latest_view(self, *indices):
         view_data = []
         for i in range(self.num_spectrometers):
-            suffix = self._suffix(i)
             spectrometer = self.spectrometer.spectrometers[i]\
                 if isinstance(self.spectrometer, Spectrometers) else self.spectrometer
             w = abs(spectrometer.wavelengths - self.view_wavelength).argmin()
-            data = self.data['hs_image'+suffix]
+            if w != self._live_view_indices[i]:
+                self._reload_live_view(i, w)
+            data = self._live_views[i]
+            spectrum = self._latest_spectra[i]
+            if spectrum is None:
+                spectrum = np.full(spectrometer.wavelengths.shape, np.nan)
             if self.num_axes == 2:
-                latest_view = data[:, :, w]
-                spectrum = self.data['hs_image'+suffix][indices[-2], indices[-1], :]
+                latest_view = data
             elif self.num_axes == 3:
                 if self.override_view_layer:
                     k = self.view_layer
                 else:
-                    k = self.indices[0]
+                    k = indices[0]
                     if self.view_layer != k:
                         self.view_layer = k
-                latest_view = data[k, :, :, w]
-                spectrum = self.data['hs_image'+suffix][k, indices[-2], indices[-1], :]
+                latest_view = data[k, :, :]
             spectrum = spectrometer.mask_spectrum(spectrum, 0.05)
             view_data += [latest_view, spectrometer.wavelengths, spectrum]
         return tuple(view_data)
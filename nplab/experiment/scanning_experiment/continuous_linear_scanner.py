@@ -61,7 +61,16 @@ class ContinuousLinearScan(ScanningExperiment, TimedScan):
         self.status = 'acquiring data'
         self.acquiring.set()
         scan_start_time = time.time()
-        index = 0 if new else 1
+        self.acquisition_loop(0 if new else 1)
+        self.print_scan_time(time.time() - scan_start_time)
+        self.acquiring.clear()
+        # finish the scan
+        self.analyse_scan()
+        self.close_scan()
+        self.status = 'scan complete'
+
+    def acquisition_loop(self, index):
+        """Step the parameter and call scan_function (starting with index) until the scan is aborted."""
         while not self.abort_requested:
             if self.hold or self._num_measurements < self.num_repeats:
                 self._last_step = 0.  # used to prevent the incrementing of the displacement
@@ -80,12 +89,6 @@ class ContinuousLinearScan(ScanningExperiment, TimedScan):
                 self.update_parameter(self.direction*self.step)
             except NotImplementedError:
                 pass
-        self.print_scan_time(time.time() - scan_start_time)
-        self.acquiring.clear()
-        # finish the scan
-        self.analyse_scan()
-        self.close_scan()
-        self.status = 'scan complete'
 
     def calculate_feedback_input(self):
         """
@@ -4,17 +4,34 @@ from nplab.experiment.scanning_experiment import ContinuousLinearScan, Continuou
 from nplab.instrument.stage import Stage
 from nplab.utils.gui import *
 from nplab import inherit_docstring
+import numpy as np
+import time
+import warnings
 
 
 @inherit_docstring(ContinuousLinearScan)
 class ContinuousLinearStageScan(ContinuousLinearScan):
-    """Continuous linear scan that specifically spatially scans using a stage."""
+    """Continuous linear scan that specifically spatially scans using a stage.
+
+    If `fly_scan` is True, the stage is sent through `fly_points` steps as a
+    trajectory instead of being moved between measurements: it stays at each
+    point for `fly_dwell` seconds, and `scan_function` is called as each point
+    is reached, with its time and position in `fly_readback`.  Feedback and
+    `num_repeats` are ignored in a fly scan, as the steps are decided up front.
+    Points where the stage moved on before `scan_function` had finished are
+    counted in `fly_lagged_points`, with a warning at the end of the scan.
+    """
 
     @inherit_docstring(ContinuousLinearScan.__init__)
     def __init__(self):
         super(ContinuousLinearStageScan, self).__init__()
         self.stage = None
         self.axis = None
+        self.fly_scan = False
+        self.fly_points = 100
+        self.fly_dwell = 0.
+        self.fly_readback = None
+        self.fly_lagged_points = 0
 
     @inherit_docstring(ContinuousLinearScan.init_scan)
     def init_scan(self):
@@ -31,6 +48,34 @@ class ContinuousLinearStageScan(ContinuousLinearScan):
         """In this subclass the set parameter is the relative position. """
         self.stage.move(value, self.axis, relative=True)
 
+    @inherit_docstring(ContinuousLinearScan.acquisition_loop)
+    def acquisition_loop(self, index):
+        if not self.fly_scan:
+            return super(ContinuousLinearStageScan, self).acquisition_loop(index)
+        if self.fly_dwell <= 0:
+            raise ValueError("fly_dwell must be positive, or the stage won't wait for scan_function at each point")
+        self.fly_lagged_points = 0
+        start = self.stage.get_position(self.axis)
+        steps = self.direction*self.step*np.arange(self.fly_points)
+        self.stage.load_trajectory(start + steps, dwell=self.fly_dwell, axes=(self.axis,))
+        self.stage.start_trajectory()
+        try:
+            for n, reached, position in self.stage.iter_trajectory_readback():
+                if self.abort_requested:
+                    break
+                self._last_step = self.direction*self.step if n > 0 else 0.
+                self.fly_readback = (reached, position[0])
+                self.scan_function(index + n)
+                finished = time.time()
+                left = self.stage.trajectory_departure_time(n)
+                if left is not None and left < finished:
+                    self.fly_lagged_points += 1  # the stage left this point before scan_function had finished
+        finally:
+            self.stage.stop_trajectory()
+        if self.fly_lagged_points > 0:
+            warnings.warn("The stage moved on before scan_function had finished at {0} of {1} points of the fly "
+                          "scan, increase fly_dwell".format(self.fly_lagged_points, self.fly_points))
+
 
 @inherit_docstring(ContinuousLinearStageScan)
 class ContinuousLinearStageScanQt(ContinuousLinearStageScan, ContinuousLinearScanQt):
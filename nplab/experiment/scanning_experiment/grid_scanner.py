@@ -16,6 +16,8 @@ __author__ = 'alansanders'
 
 import numpy as np
 import threading
+import queue
+import warnings
 import time
 import operator
 from nplab.experiment.scanning_experiment import ScanningExperiment, TimedScan
@@ -48,6 +50,11 @@ class GridScan(ScanningExperiment, TimedScan):
         self._unit_conversion = {'nm': 1e-9, 'um': 1e-6, 'mm': 1e-3}
         self._size_unit, self._step_unit, self._init_unit = ('um', 'um', 'um')
         self.grid_shape = (0,0)
+        self.pipeline_depth = 0  # if > 0, process data in a separate thread (see scan)
+        self.fly_scan = False  # if True, run the grid as a stage trajectory (see scan)
+        self.fly_dwell = 0.  # the time (in seconds) the stage stays at each point of a fly scan
+        self.fly_readback = None  # (time, position) of the current point of a fly scan
+        self.fly_lagged_points = 0  # points of the last fly scan where the stage moved on during scan_function
         #self.init_grid(self.axes, self.size, self.step, self.init)
 
     def _update_axes(self, num_axes):
@@ -164,6 +171,19 @@ class GridScan(ScanningExperiment, TimedScan):
         """Move to a position along a given axis."""
         self.stage.move(old_div(position,self.stage_units), axis=axis)
 
+    def move_many(self, positions):
+        """Move to a position along several axes at once, given as {axis: position}.
+
+        This uses `Stage.move_many`, so the stage can usually make the move
+        with a single command.
+        """
+        if type(self).move is not GridScan.move:  # subclasses that customise move() still get their moves
+            for axis, position in positions.items():
+                self.move(position, axis)
+        else:
+            self.stage.move_many({axis: old_div(position, self.stage_units)
+                                  for axis, position in positions.items()})
+
     def get_position(self, axis):
         return self.stage.get_position(axis=axis) * self.stage_units
     
@@ -179,23 +199,32 @@ class GridScan(ScanningExperiment, TimedScan):
     def middle_loop_end(self):
         """This function is called after the scan happens, for each value of the second-outermost variable (usually Y)"""
         pass
-    def scan(self, axes, size, step, init):
-        """Scans a grid, applying a function at each position."""
-        self.abort_requested = False
-        axes, size, step, init = (axes[::-1], size[::-1], step[::-1], init[::-1])
-        scan_axes = self.init_grid(axes, size, step, init)
-        print(scan_axes)
-        self.open_scan()
-        # get the indices of points along each of the scan axes for use with snaking over array
-        pnts = [list(range(axis.size)) for axis in scan_axes]
+    def acquire(self, *indices):
+        """Acquire data at the current point of a pipelined scan (see `pipeline_depth`).
 
-        self.indices = [-1,] * len(axes)
-        self._index = 0
-        self._step_times = np.zeros(self.grid_shape)
-        self._step_times.fill(np.nan)
-        self.status = 'acquiring data'
-        self.acquiring.set()
-        scan_start_time = time.time()
+        The return value is passed to `process_data` in the processing thread, so
+        this should only do what must happen while the stage is at the point (e.g.
+        reading the detector).  By default, this just calls `scan_function`.
+        """
+        self.scan_function(*indices)
+
+    def process_data(self, data, *indices):
+        """Process and save the data acquired at a point of a pipelined scan.
+
+        In a pipelined scan, this runs in a separate thread while the stage moves
+        to the next point(s), so it must not move the stage or use `self.indices`.
+        """
+        pass
+
+    def grid_points(self, axes, scan_axes):
+        """Move the stage through the grid (snaking back and forth), yielding the indices of each point.
+
+        The loop start/end functions are called as the outer axes are scanned, and the
+        scan stops if `abort_requested` is set.  The stage moves all the axes that
+        change between one point and the next with a single `move_many`.
+        """
+        pnts = [list(range(axis.size)) for axis in scan_axes]
+        targets = dict()  # axes that need to move before the next point
         for k in pnts[0]:  # outer most axis
             self.indices = list(self.indices)
             self.indices[0] = k # Make sure indices is always up-to-date, for the drift compensation
@@ -203,44 +232,183 @@ class GridScan(ScanningExperiment, TimedScan):
                 break
             self.outer_loop_start()
             self.status = 'Scanning layer {0:d}/{1:d}'.format(k + 1, len(pnts[0]))
-            self.move(scan_axes[0][k], axes[0])
+            targets[axes[0]] = scan_axes[0][k]
             pnts[1] = pnts[1][::-1]  # reverse which way is iterated over each time
             for j in pnts[1]:
                 if self.abort_requested:
                     break
-                self.move(scan_axes[1][j], axes[1])
-                self.indices = list(self.indices)
-                self.indices[1] = j
+                targets[axes[1]] = scan_axes[1][j]
                 if len(axes) == 3:  # for 3d grid (volume) scans
+                    self._timed_move(targets)
+                    self.indices = list(self.indices)
+                    self.indices[1] = j
                     self.middle_loop_start()
                     pnts[2] = pnts[2][::-1]  # reverse which way is iterated over each time
                     for i in pnts[2]:
                         if self.abort_requested:
                             break
-                        self.move(scan_axes[2][i], axes[2])
+                        self._timed_move({axes[2]: scan_axes[2][i]})
                         self.indices[2] = i # These two lines are redundant.  TODO: pick one...
                         #self.indices = (k, j, i) # keeping it as a list allows index assignment
-                        self.scan_function(k, j, i)
-                        self._step_times[k,j,i] = time.time()
-                        self._index += 1
+                        yield (k, j, i)
                     self.middle_loop_end()
                 elif len(axes) == 2:  # for regular 2d grid scans ignore third axis i
+                    self._timed_move(targets)
                     self.indices = (k, j)
-                    self.scan_function(k, j)
-                    self._step_times[k,j] = time.time()
-                    self._index += 1
+                    yield (k, j)
+                targets = dict()
             self.outer_loop_end()
 
+    def snake_indices(self, scan_axes):
+        """Yield the indices of each point of the grid, in the (snaking) order grid_points visits them."""
+        pnts = [list(range(axis.size)) for axis in scan_axes]
+        for k in pnts[0]:
+            pnts[1] = pnts[1][::-1]
+            for j in pnts[1]:
+                if len(scan_axes) == 3:
+                    pnts[2] = pnts[2][::-1]
+                    for i in pnts[2]:
+                        yield (k, j, i)
+                else:
+                    yield (k, j)
+
+    def _timed_move(self, positions):
+        """Move several axes ({axis: position}), recording the time taken for the stage timings."""
+        t0 = time.time()
+        self.move_many(positions)
+        self.add_stage_time('move', time.time() - t0)
+
+    def scan(self, axes, size, step, init):
+        """Scans a grid, applying a function at each position.
+
+        If `pipeline_depth` is 0, `scan_function` is called at each point.  Otherwise,
+        `acquire` is called at each point, and its result is passed to `process_data`
+        in a separate thread, so that processing and saving the data overlap with
+        moving the stage and acquiring the next points.  Up to `pipeline_depth` points
+        may be waiting to be processed before the scan waits for them.
+
+        If `fly_scan` is True, the whole grid is loaded into the stage as a
+        trajectory, which runs without waiting for the scan, staying at each
+        point for `fly_dwell` seconds.  `scan_function` is called as each point
+        is reported by the stage, with the time and position it was reached in
+        `fly_readback`.  The loop start/end functions are not called in a fly
+        scan, as the stage doesn't wait for them.  `fly_dwell` must be long
+        enough for `scan_function` to finish before the stage moves on: points
+        where it isn't are counted in `fly_lagged_points`, with a warning at the
+        end of the scan.
+        """
+        self.abort_requested = False
+        axes, size, step, init = (axes[::-1], size[::-1], step[::-1], init[::-1])
+        scan_axes = self.init_grid(axes, size, step, init)
+        print(scan_axes)
+        self.open_scan()
+
+        self.indices = [-1,] * len(axes)
+        self._index = 0
+        self._step_times = np.zeros(self.grid_shape)
+        self._step_times.fill(np.nan)
+        self.reset_stage_timings()
+        self.status = 'acquiring data'
+        self.acquiring.set()
+        scan_start_time = time.time()
+        if self.fly_scan:
+            self._fly_scan(axes, scan_axes)
+        elif self.pipeline_depth > 0:
+            self._pipelined_scan(axes, scan_axes)
+        else:
+            for indices in self.grid_points(axes, scan_axes):
+                t0 = time.time()
+                self.scan_function(*indices)
+                self.add_stage_time('scan_function', time.time() - t0)
+                self._step_times[indices] = time.time()
+                self._index += 1
+
         self.print_scan_time(time.time() - scan_start_time)
+        self.print_stage_timings()
         self.acquiring.clear()
         # move back to initial positions
-        for i in range(len(axes)):
-            self.move(init[i]*self._unit_conversion[self._init_unit], axes[i])
+        self.move_many({axes[i]: init[i]*self._unit_conversion[self._init_unit] for i in range(len(axes))})
         # finish the scan
         self.analyse_scan()
         self.close_scan()
         self.status = 'scan complete'
 
+    def _fly_scan(self, axes, scan_axes):
+        """Run the grid as a stage trajectory, calling scan_function as each point is reached (see scan)."""
+        if self.fly_dwell <= 0:
+            raise ValueError("fly_dwell must be positive, or the stage won't wait for scan_function at each point")
+        self.fly_lagged_points = 0
+        grid_indices = list(self.snake_indices(scan_axes))
+        points = [[old_div(scan_axes[n][i], self.stage_units) for n, i in enumerate(indices)]
+                  for indices in grid_indices]
+        self.stage.load_trajectory(points, dwell=self.fly_dwell, axes=axes)
+        self.stage.start_trajectory()
+        try:
+            for n, reached, position in self.stage.iter_trajectory_readback():
+                if self.abort_requested:
+                    break
+                self.indices = grid_indices[n]
+                self.fly_readback = (reached, position * self.stage_units)
+                t0 = time.time()
+                self.scan_function(*self.indices)
+                finished = time.time()
+                self.add_stage_time('scan_function', finished - t0)
+                self._step_times[self.indices] = reached
+                self._index += 1
+                left = self.stage.trajectory_departure_time(n)
+                if left is not None and left < finished:
+                    self.fly_lagged_points += 1  # the stage left this point before scan_function had finished
+        finally:
+            self.stage.stop_trajectory()
+        if self.fly_lagged_points > 0:
+            warnings.warn("The stage moved on before scan_function had finished at {0} of {1} points of the fly "
+                          "scan, increase fly_dwell".format(self.fly_lagged_points, len(grid_indices)))
+
+    def _pipelined_scan(self, axes, scan_axes):
+        """Acquire data at each point, and process it in another thread (see scan)."""
+        points = queue.Queue(maxsize=self.pipeline_depth)
+        errors = []
+
+        def process_points():
+            while True:
+                item = points.get()
+                if item is None:
+                    return
+                indices, data = item
+                if errors:
+                    continue  # drain the queue, so the scan isn't blocked
+                t0 = time.time()
+                try:
+                    self.process_data(data, *indices)
+                except Exception as e:
+                    errors.append(e)
+                    self.abort_requested = True
+                self.add_stage_time('process', time.time() - t0)
+
+        processing_thread = threading.Thread(target=process_points)
+        processing_thread.daemon = True
+        processing_thread.start()
+        try:
+            for indices in self.grid_points(axes, scan_axes):
+                t0 = time.time()
+                data = self.acquire(*indices)
+                self.add_stage_time('acquire', time.time() - t0)
+                self._step_times[indices] = time.time()
+                self._index += 1
+                t0 = time.time()
+                points.put((indices, data))
+                self.add_stage_time('queue_wait', time.time() - t0)
+        finally:
+            points.put(None)
+            t0 = time.time()
+            processing_thread.join()
+            self.add_stage_time('queue_wait', time.time() - t0)
+        if errors:
+            try:
+                raise errors[0]
+            finally:
+                del errors[:]  # otherwise the traceback keeps the error, and this frame, in a reference cycle
+
     def vary_axes(self, name, multiplier=2.):
         if 'increase_size' in name:
             self.size *= multiplier
@@ -9,6 +9,7 @@ class TimedScan(object):
     def __init__(self):
         self._estimated_step_time = 0
         self.total_points = 0
+        self.stage_timings = {}
 
     @property
     def estimated_step_time(self):
@@ -56,4 +57,17 @@ class TimedScan(object):
 
     def print_scan_time(self, t):
         """Prints the duration of the scan."""
-        print('Scan took', self.format_time(t))
\ No newline at end of file
+        print('Scan took', self.format_time(t))
+
+    def reset_stage_timings(self):
+        """Set the time spent in each stage of the scan (e.g. moving, acquiring) to zero."""
+        self.stage_timings = {}
+
+    def add_stage_time(self, stage, t):
+        """Add to the time spent in one stage of the scan."""
+        self.stage_timings[stage] = self.stage_timings.get(stage, 0) + t
+
+    def print_stage_timings(self):
+        """Prints the time spent in each stage of the scan."""
+        for stage, t in sorted(self.stage_timings.items()):
+            print('  {0}: {1}'.format(stage, self.format_time(t)))
@@ -105,7 +105,7 @@ class Instrument(ShowGUIMixin):
             name = name + '_%d'
         df = cls.get_root_data_folder()
         dset = df.create_dataset(name, *args, **kwargs)
-        if 'data' in kwargs and flush:
+        if 'data' in kwargs and flush and not isinstance(dset, nplab.datafile.DatasetFuture):
             dset.file.flush() #make sure it's in the file if we wrote data
         return dset
 
@@ -38,6 +38,10 @@ class CameraParameter(NotifiedProperty):
     (otherwise we'd send them the value that was requested, even if it was
     not valid).  This behaviour can be disabled by setting read_back to False
     in the constructor.
+
+    Every value that's read is stored in the camera's parameter cache, which
+    is used for metadata so saving data doesn't query the hardware (see
+    `Camera.cached_camera_parameters`).
     """
     def __init__(self, parameter_name, doc=None, read_back=True):
         """Create a property that reads and writes the given parameter.
@@ -53,6 +57,17 @@ class CameraParameter(NotifiedProperty):
                                                       read_back=read_back)
         self.parameter_name = parameter_name
         
+    def __get__(self, obj, objtype=None):
+        value = super(CameraParameter, self).__get__(obj, objtype)
+        if obj is not None and hasattr(obj, "_cache_camera_parameter"):
+            obj._cache_camera_parameter(self.parameter_name, value)
+        return value
+
+    def __set__(self, obj, value):
+        if hasattr(obj, "invalidate_parameter_cache"):
+            obj.invalidate_parameter_cache([self.parameter_name])
+        super(CameraParameter, self).__set__(obj, value)
+
     def fget(self, obj):
         return obj.get_camera_parameter(self.parameter_name)
             
@@ -60,6 +75,287 @@ class CameraParameter(NotifiedProperty):
         obj.set_camera_parameter(self.parameter_name, value)
 
 
+_camera_parameters_by_class = dict()
+
+
+def camera_parameters(cls):
+    """Return a dictionary of the CameraParameter properties of a class, by name.
+
+    This is worked out once per class, without reading any of the parameters.
+    Parameters must be added to the class before it is first used.
+    """
+    if cls not in _camera_parameters_by_class:
+        parameters = dict()
+        for name in dir(cls):
+            try:
+                p = getattr(cls, name)
+            except AttributeError:
+                continue
+            if isinstance(p, CameraParameter):
+                parameters[name] = p
+        _camera_parameters_by_class[cls] = parameters
+    return _camera_parameters_by_class[cls]
+
+
+class FrameOverrunError(IOError):
+    """Frames were overwritten in a FrameRingBuffer before they were read."""
+    def __init__(self, missed):
+        super(FrameOverrunError, self).__init__("{0} frames were overwritten before they were read".format(missed))
+        self.missed = missed
+
+
+class FrameRingBuffer(object):
+    """A ring buffer of preallocated frames, each with a sequence number and timestamp.
+
+    Sequence numbers start at 1 and always increase, so consumers can keep track of which frames they have seen
+    (0 means "no frame").  Frames are returned as views into the buffer, without copying: they will be overwritten
+    once another `n_frames` frames have arrived, so copy them if you need to keep them (`is_valid` will tell you if
+    a frame has been overwritten).
+
+    Producers either `push` a frame (which copies it into the buffer) or fill a slot in place, by calling
+    `start_frame` and then `commit_frame` once the slot contains the new frame.
+    """
+    def __init__(self, n_frames=16):
+        self.n_frames = n_frames
+        self.condition = threading.Condition()
+        self._frames = None
+        self.sequences = np.zeros(n_frames, dtype=np.int64)  # the sequence number in each slot (0 if empty)
+        self.timestamps = np.full(n_frames, np.nan)
+        self.latest_sequence = 0
+        self._next_sequence = 1
+
+    @property
+    def frame_shape(self):
+        """The shape of the frames in the buffer (None if nothing has been allocated yet)"""
+        return None if self._frames is None else self._frames.shape[1:]
+
+    @property
+    def dtype(self):
+        """The data type of the frames in the buffer (None if nothing has been allocated yet)"""
+        return None if self._frames is None else self._frames.dtype
+
+    def allocate(self, shape, dtype):
+        """Make sure the buffer holds frames of the given shape and dtype (discarding old frames if it changes)."""
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        with self.condition:
+            if self._frames is None or self._frames.shape[1:] != shape or self._frames.dtype != dtype:
+                self._frames = np.zeros((self.n_frames,) + shape, dtype=dtype)
+                self.sequences[:] = 0
+
+    def start_frame(self, shape, dtype):
+        """Return a sequence number and a slot in the buffer to put a new frame into.
+
+        Call commit_frame with the sequence number once the slot has been filled.
+        """
+        self.allocate(shape, dtype)
+        with self.condition:
+            seq = self._next_sequence
+            self._next_sequence += 1
+            i = seq % self.n_frames
+            self.sequences[i] = 0  # the slot isn't valid until it's been committed
+            return seq, self._frames[i]
+
+    def commit_frame(self, seq, timestamp=None):
+        """Mark the slot for a sequence number as containing a new frame, and notify anyone waiting for it."""
+        with self.condition:
+            i = seq % self.n_frames
+            self.sequences[i] = seq
+            self.timestamps[i] = time.time() if timestamp is None else timestamp
+            self.latest_sequence = max(self.latest_sequence, seq)
+            self.condition.notify_all()
+
+    def push(self, frame, timestamp=None):
+        """Copy a frame into the buffer, returning its sequence number."""
+        frame = np.asarray(frame)
+        seq, slot = self.start_frame(frame.shape, frame.dtype)
+        slot[...] = frame
+        self.commit_frame(seq, timestamp)
+        return seq
+
+    def is_valid(self, seq):
+        """Whether the frame with a given sequence number is still in the buffer."""
+        return seq > 0 and self.sequences[seq % self.n_frames] == seq
+
+    @property
+    def oldest_sequence(self):
+        """The sequence number of the oldest frame in the buffer (0 if it's empty)."""
+        valid = self.sequences[self.sequences > 0]
+        return int(valid.min()) if len(valid) > 0 else 0
+
+    def get_frame(self, seq):
+        """Return (timestamp, frame) for a sequence number, raising a FrameOverrunError if it's been overwritten."""
+        with self.condition:
+            if not self.is_valid(seq):
+                if seq > self.latest_sequence:
+                    raise ValueError("Frame {0} hasn't been acquired yet".format(seq))
+                raise FrameOverrunError(max(self.oldest_sequence - seq, 1))
+            i = seq % self.n_frames
+            return self.timestamps[i], self._frames[i]
+
+    def _frames_between(self, first, last, allow_overrun):
+        """Return a list of (sequence, timestamp, frame) for frames first to last (inclusive) that are still here."""
+        oldest = self.oldest_sequence
+        if first < oldest and not allow_overrun:
+            raise FrameOverrunError(oldest - first)
+        frames = []
+        for seq in range(max(first, oldest, 1), last + 1):
+            if self.is_valid(seq):  # NB frames that were started but never committed are skipped
+                i = seq % self.n_frames
+                frames.append((seq, self.timestamps[i], self._frames[i]))
+        return frames
+
+    def frame_after(self, seq, timeout=60, allow_overrun=True):
+        """Wait for a frame after the given sequence number, and return (sequence, timestamp, frame).
+
+        This returns the oldest frame in the buffer that is newer than `seq`.  If the frames immediately after
+        `seq` have been overwritten, we return the oldest frame that's left, unless allow_overrun is False, in
+        which case a FrameOverrunError is raised.  If no new frame arrives within `timeout` seconds, an IOError is
+        raised.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.latest_sequence > seq, timeout):
+                raise IOError("Timed out waiting for a fresh frame from the video stream.")
+            return self._frames_between(seq + 1, self.latest_sequence, allow_overrun)[0]
+
+    def frames_since(self, seq, allow_overrun=True):
+        """Return a list of (sequence, timestamp, frame) for all the frames after the given sequence number."""
+        with self.condition:
+            return self._frames_between(seq + 1, self.latest_sequence, allow_overrun)
+
+    def last_frames(self, n):
+        """Return a list of (sequence, timestamp, frame) for the last n frames (or fewer if they're not there)."""
+        with self.condition:
+            return self._frames_between(self.latest_sequence - n + 1, self.latest_sequence, True)
+
+
+class CameraRecording(object):
+    """A burst of frames from a camera's video stream, saved to one group in the data file by a writer thread.
+
+    This is returned by `Camera.record`.  Frames are read from the camera's frame_buffer, so they are saved without
+    interrupting the video stream, and appended in blocks to three datasets in `group`:
+
+    * "frames": an (N, height, width[, 3]) array of raw frames, stored one frame per chunk
+    * "timestamps": the time each frame was acquired (seconds since the epoch)
+    * "sequence_numbers": each frame's sequence number in the frame buffer, so gaps show where frames were dropped
+
+    The camera's metadata are saved once, as attributes of the group.  When the recording finishes, the group's
+    attributes also record the number of frames saved and dropped, and the sustained frame rate.  Frames are dropped
+    if they are overwritten in the frame buffer before the writer thread gets to them; increasing the camera's
+    `frame_buffer_size` gives the writer thread more slack.
+    """
+    def __init__(self, camera, group, n_frames=None, duration=None, chunk_frames=16, crash_safe=False,
+                 timeout=10, stop_live_view=False):
+        if n_frames is None and duration is None:
+            raise ValueError("A recording needs a number of frames, a duration, or both.")
+        self.camera = camera
+        self.group = group
+        self.target_frames = n_frames
+        self.duration = duration
+        self.chunk_frames = chunk_frames
+        self.crash_safe = crash_safe
+        self.timeout = timeout
+        self.stop_live_view = stop_live_view
+        self.n_frames = 0
+        self.dropped_frames = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.error = None
+        self._stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._write_frames)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start saving frames in the background."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop recording now, and wait for the frames received so far to be written."""
+        self._stop_event.set()
+        return self.wait()
+
+    def wait(self, timeout=None):
+        """Wait for the recording to finish, and return the group it was saved in.
+
+        If the writer thread failed, its exception is re-raised here.
+        """
+        self.thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.group
+
+    @property
+    def finished(self):
+        """Whether all the frames have been written to the file."""
+        return not self.thread.is_alive()
+
+    @property
+    def frames_per_second(self):
+        """The rate at which frames were saved, from their timestamps."""
+        if self.n_frames < 2 or self.last_timestamp == self.first_timestamp:
+            return 0.0
+        return (self.n_frames - 1) / (self.last_timestamp - self.first_timestamp)
+
+    def _finished_recording(self, start_time):
+        """Whether we have enough frames, or have run out of time."""
+        if self._stop_event.is_set():
+            return True
+        if self.target_frames is not None and self.n_frames >= self.target_frames:
+            return True
+        return self.duration is not None and time.time() - start_time >= self.duration
+
+    def _write_frames(self):
+        """Copy frames out of the camera's frame buffer, and append them to the datasets (writer thread)."""
+        from nplab.datafile import AppendBuffer
+        buffer = self.camera.frame_buffer
+        last_seq = buffer.latest_sequence  # we only save frames that arrive after we start
+        frame = None
+        start_time = time.time()
+        last_frame_time = start_time
+        options = dict(buffer_rows=self.chunk_frames, crash_safe=self.crash_safe)
+        frames = AppendBuffer(self.group, "frames", chunk_rows=1, **options)
+        timestamps = AppendBuffer(self.group, "timestamps", dtype=np.float64, chunk_rows=1024, **options)
+        sequences = AppendBuffer(self.group, "sequence_numbers", dtype=np.int64, chunk_rows=1024, **options)
+        try:
+            while not self._finished_recording(start_time):
+                with buffer.condition:
+                    new_frame = buffer.condition.wait_for(lambda: buffer.latest_sequence > last_seq, 0.1)
+                    if new_frame:
+                        seq, timestamp, slot = buffer.frame_after(last_seq)
+                        # copy the frame while we hold the lock, so it can't be overwritten half way through
+                        if frame is None or frame.shape != slot.shape or frame.dtype != slot.dtype:
+                            if frame is not None:
+                                raise ValueError("The frame size changed during a recording.")
+                            frame = np.empty_like(slot)
+                        np.copyto(frame, slot)
+                now = time.time()
+                if not new_frame:
+                    if now - last_frame_time > self.timeout:
+                        raise IOError("Timed out waiting for frames from the camera.")
+                    continue
+                last_frame_time = now
+                self.dropped_frames += seq - last_seq - 1
+                last_seq = seq
+                frames.append(frame)
+                timestamps.append(timestamp)
+                sequences.append(seq)
+                if self.first_timestamp is None:
+                    self.first_timestamp = timestamp
+                self.last_timestamp = timestamp
+                self.n_frames += 1
+        except Exception as e:
+            self.error = e
+        finally:
+            for b in (frames, timestamps, sequences):
+                b.close()
+            self.group.attrs.update({'n_frames': self.n_frames,
+                                     'dropped_frames': self.dropped_frames,
+                                     'frames_per_second': self.frames_per_second})
+            self.group.file.flush()
+            if self.stop_live_view:
+                self.camera.live_view = False
+
+
 class Camera(Instrument):
     """Generic class for representing cameras.
     
@@ -82,11 +378,27 @@ class Camera(Instrument):
     filter_function = None 
     """This function is run on the image before it's displayed in live view.  
     It should accept, and return, an RGB image as its argument."""
+
+    frame_buffer_size = 16
+    """The number of recent frames kept in frame_buffer."""
+
+    live_view_interval = 0.1
+    """The time (in seconds) to wait between snapshots in the default live view."""
+
+    parameter_cache_ttl = None
+    """How long (in seconds) a cached camera parameter is trusted for metadata.
+
+    None means cached values are used until the parameter is set, or until
+    refresh_parameters or invalidate_parameter_cache is called.  Set a time
+    if parameters change by themselves (e.g. the sensor temperature)."""
+    _parameter_cache = None
+    _unsupported_parameters = frozenset()
     
     def __init__(self):
         super(Camera,self).__init__()
         self.acquisition_lock = threading.Lock()    
-        self._latest_frame_update_condition = threading.Condition()
+        self.frame_buffer = FrameRingBuffer(self.frame_buffer_size)
+        self._latest_frame_update_condition = self.frame_buffer.condition
         self._live_view = False
         self._frame_counter = 0
         # Ensure camera parameters get saved in the metadata.  You may want to override this in subclasses
@@ -126,27 +438,20 @@ class Camera(Instrument):
         when that is the case.
         @param: raw: The default (True) returns a raw frame - False returns the
         frame after processing by the filter function if any.
+        
+        The frame is copied out of frame_buffer - use that directly if you
+        want to avoid copying frames, or to get several recent frames.
         """
         if assert_live_view:
             assert self.live_view, """Can't wait for the next frame if live view is not enabled!"""
-        with self._latest_frame_update_condition:
-            # We use the Condition object to block until a new frame appears
-            # However we need to check that a new frame has actually been taken
-            # so we use the frame counter.
-            # NB the current implementation may be vulnerable to dropped frames
-            # which will probably cause a timeout error.
-            # Checking for frame_counter being >= target_frame is vulnerable to
-            # overflow.
-            target_frame = self._frame_counter + 1 + discard_frames
-            expiry_time = time.time() + timeout
-            while self._frame_counter != target_frame and time.time() < expiry_time:
-                self._latest_frame_update_condition.wait(timeout) #wait for a new frame
-            if time.time() >= expiry_time:
-                raise IOError("Timed out waiting for a fresh frame from the video stream.")
-            if raw:
-                return self.latest_raw_frame
-            else:
-                return self.latest_frame
+        # Sequence numbers only ever increase, so dropped frames don't cause us to wait forever.
+        target_frame = self.frame_buffer.latest_sequence + discard_frames
+        seq, timestamp, frame = self.frame_buffer.frame_after(target_frame, timeout=timeout)
+        frame = frame.copy()
+        if raw or self.filter_function is None:
+            return frame
+        else:
+            return self.filter_function(frame)
         
     def raw_snapshot(self):
         """Take a snapshot and return it.  No filtering or conversion."""
@@ -215,8 +520,43 @@ class Camera(Instrument):
                                   bundle_metadata=True,
                                   update_latest_frame=update_latest_frame))
         d.attrs.update(attrs)
+
+    def record(self, n_frames=None, duration=None, name='recording_%d', attrs={}, block=True,
+               chunk_frames=16, crash_safe=False, timeout=10):
+        """Save a burst of frames from the video stream to one group in the data file.
+
+        Frames are taken from frame_buffer as they arrive and written by a
+        background thread, so this is much faster than calling
+        save_raw_image in a loop.  The camera's metadata are read once, at
+        the start.  Live view is started if it isn't running (and stopped
+        again afterwards).  See CameraRecording for how the data are saved.
+
+        :param n_frames: the number of frames to record
+        :param duration: the maximum length of the recording, in seconds
+        :param name: the name of the group to save the recording in
+        :param attrs: extra metadata to save with the recording
+        :param block: if True (default), wait for the recording to finish and
+            return the group.  Otherwise, return a CameraRecording straight
+            away, which can be stopped with its stop() method.
+        :param chunk_frames: the number of frames written to the file at once
+        :param crash_safe: flush the file after each block of frames (slower)
+        :param timeout: give up if no frame arrives for this many seconds
+        """
+        group_attrs = dict(self.metadata)
+        group_attrs.update(attrs)
+        group = self.create_data_group(name, attrs=group_attrs)
+        stop_live_view = not self.live_view
+        self.live_view = True
+        recording = CameraRecording(self, group, n_frames=n_frames, duration=duration,
+                                    chunk_frames=chunk_frames, crash_safe=crash_safe,
+                                    timeout=timeout, stop_live_view=stop_live_view)
+        recording.start()
+        if block:
+            return recording.wait()
+        return recording
     
     _latest_raw_frame = None
+    _latest_raw_sequence = None  # set if the latest frame was written in place, and not yet copied out
     @NotifiedProperty
     def latest_raw_frame(self):
         """The last frame acquired by the camera.  
@@ -226,35 +566,88 @@ class Camera(Instrument):
         that may be in effect.  May be NxMx3 or NxM for monochrome.  To get a
         fresh frame, use raw_image().  Setting this property will update any
         preview widgets that are in use."""
-        return self._latest_raw_frame
+        with self.frame_buffer.condition:
+            if self._latest_raw_frame is None and self._latest_raw_sequence is not None:
+                # frames written in place are only copied out of frame_buffer when they're needed, so that we don't
+                # hand out a view of a slot that will be overwritten when the buffer wraps around
+                if self.frame_buffer.is_valid(self._latest_raw_sequence):
+                    self._latest_raw_frame = self.frame_buffer.get_frame(self._latest_raw_sequence)[1].copy()
+            return self._latest_raw_frame
     @latest_raw_frame.setter
     def latest_raw_frame(self, frame):
         """Set the latest raw frame, and update the preview widget if any."""
-        with self._latest_frame_update_condition:
+        with self.frame_buffer.condition:
             self._latest_raw_frame = frame
-            self._frame_counter += 1
-            self._latest_frame_update_condition.notify_all()
+            self._latest_raw_sequence = None
+        self._filtered_frame = None
+        if frame is not None:
+            self._frame_counter = self.frame_buffer.push(frame)
         
         # TODO: use the NotifiedProperty to do this with less code?
         self.update_widgets()
+
+    def write_frame_in_place(self, fill_function, shape=None, dtype=None):
+        """Acquire a frame straight into the next slot of frame_buffer, avoiding a copy.
+
+        This is intended for subclasses, e.g. to call from an SDK's callback.
+        `fill_function(out)` should fill the array `out` with the new frame,
+        and return True if it succeeded.  If shape and dtype aren't given, the
+        frame must match the frames already in the buffer.  Returns the new
+        frame's sequence number, or None if fill_function failed.  The frame
+        is only copied out of the buffer if latest_raw_frame is read.
+        """
+        if shape is None:
+            shape, dtype = self.frame_buffer.frame_shape, self.frame_buffer.dtype
+        seq, slot = self.frame_buffer.start_frame(shape, dtype)
+        if not fill_function(slot):
+            return None
+        with self.frame_buffer.condition:
+            self.frame_buffer.commit_frame(seq)
+            self._latest_raw_frame = None
+            self._latest_raw_sequence = seq
+        self._filtered_frame = None
+        self._frame_counter = seq
+        self.update_widgets()
+        return seq
+
+    def raw_snapshot_into(self, out):
+        """Take a snapshot, writing it into the array `out`, and return True if successful.
+
+        Override this if your camera can acquire into an existing array: live
+        view will then fill frame_buffer in place rather than allocating a new
+        array for every frame.
+        """
+        raise NotImplementedError("This camera can't take snapshots into an existing array.")
     
     def update_widgets(self):
         """Iterates over the preview widgets and updates them. It's a good method to override in subclasses"""
         if self._preview_widgets is not None:
             for w in self._preview_widgets:
                 try:
-                    w.update_image(self.latest_frame)
+                    if isinstance(w, CameraPreviewWidget):
+                        # the widget fetches latest_frame when it's ready to draw, so frames it skips aren't filtered
+                        w.new_frame_available(self)
+                    else:
+                        w.update_image(self.latest_frame)
                 except Exception as e:
                     print("something went wrong updating the preview widget")
                     print(e)
 
+    _filtered_frame = None
     @property
     def latest_frame(self):
-        """The last frame acquired (in live view/from GUI), after filtering."""
-        if self.filter_function is not None:
-            return self.filter_function(self.latest_raw_frame)
-        else:
+        """The last frame acquired (in live view/from GUI), after filtering.
+
+        The filtered frame is cached, so filter_function runs at most once per frame."""
+        if self.filter_function is None:
             return self.latest_raw_frame
+        cached = self._filtered_frame
+        if cached is not None and cached[0] == self._frame_counter and cached[1] is self.filter_function:
+            return cached[2]
+        frame_counter, filter_function = self._frame_counter, self.filter_function
+        frame = filter_function(self.latest_raw_frame)
+        self._filtered_frame = (frame_counter, filter_function, frame)
+        return frame
     
     
     def update_latest_frame(self, frame=None):
@@ -289,25 +682,84 @@ class Camera(Instrument):
         factory, and add CameraParameters at runtime.  You could do this from
         within the class, but that's a courageous move.
         
-        If you need more sophisticated control, I suggest subclassing
-        `CameraParameter`, though I can't currently see how that would help...
+        The list is worked out once per class, without talking to the camera.
+        Parameters that have failed to read on this camera are left out.
+        """
+        return [p for p in sorted(camera_parameters(self.__class__))
+                if p not in self._unsupported_parameters]
+
+    def _cache_camera_parameter(self, parameter_name, value):
+        """Store a value that's just been read from the camera."""
+        if self._parameter_cache is None:
+            self._parameter_cache = dict()
+        self._parameter_cache[parameter_name] = (value, time.time())
+
+    def invalidate_parameter_cache(self, parameter_names=None):
+        """Forget cached values of the given parameters (or all of them), so they're read from the camera next time.
+
+        NB the names here are those passed to get_camera_parameter, which may
+        not be the same as the names of the properties.
+        """
+        if self._parameter_cache is None:
+            return
+        if parameter_names is None:
+            self._parameter_cache.clear()
+        else:
+            for name in parameter_names:
+                self._parameter_cache.pop(name, None)
+
+    def cached_camera_parameters(self, names=None):
+        """Return a dictionary of camera parameter values, reading the camera only if they're not cached.
+
+        Values that are older than parameter_cache_ttl are read again.
+        Parameters that can't be read are left out, and not tried again.
         """
-        # first, identify all the CameraParameter properties we've got
-        p_list = []
-        for p in dir(self.__class__):
+        parameters = camera_parameters(self.__class__)
+        if names is None:
+            names = self.camera_parameter_names()
+        cache = self._parameter_cache if self._parameter_cache is not None else dict()
+        now = time.time()
+        values = dict()
+        for name in names:
             try:
-                if isinstance(getattr(self.__class__, p), CameraParameter):
-                    getattr(self,p)
-                    p_list.append(p)
-            except:
-                try:
-                    delattr(self.__class__,p)
-                except:
-                    pass
+                value, read_time = cache[parameters[name].parameter_name]
+                if self.parameter_cache_ttl is None or now - read_time < self.parameter_cache_ttl:
+                    values[name] = value
+                    continue
+            except KeyError:
                 pass
-        return p_list
-   #     return [p for p in dir(self.__class__)
-    #              if isinstance(getattr(self.__class__, p), CameraParameter)]
+            try:
+                values[name] = getattr(self, name)  # this updates the cache
+            except Exception:
+                self._unsupported_parameters = self._unsupported_parameters | {name}
+        return values
+
+    def refresh_parameters(self):
+        """Read all the camera parameters from the camera, update the cache, and return them as a dictionary."""
+        self.invalidate_parameter_cache()
+        self._unsupported_parameters = frozenset()
+        return self.cached_camera_parameters()
+
+    def get_metadata(self, property_names=[], include_default_names=True, exclude=None):
+        """A dictionary of settings, properties, etc. to save along with data.
+
+        This works as Instrument.get_metadata, except that camera parameters
+        are taken from the parameter cache rather than read from the camera
+        every time (see cached_camera_parameters).
+        """
+        parameters = camera_parameters(self.__class__)
+        keys = list(property_names)
+        if include_default_names:
+            keys += list(self.metadata_property_names)
+        exclude = list(exclude) if exclude is not None else []
+        parameter_names = [k for k in keys if k in parameters and k not in exclude]
+        metadata = super(Camera, self).get_metadata(property_names, include_default_names,
+                                                    exclude + parameter_names)
+        metadata.update(self.cached_camera_parameters(
+            [k for k in parameter_names if k not in self._unsupported_parameters]))
+        return metadata
+
+    metadata = property(get_metadata)
     
     def get_camera_parameter(self, parameter_name):
         """Return the named property from the camera"""
@@ -359,7 +811,12 @@ class Camera(Instrument):
         Ideally you should override live_view to start and stop streaming
         from the camera, using a callback function to update latest_raw_frame.
         """
-        while not self._live_view_stop_event.wait(timeout=0.1):
+        snapshot_into = type(self).raw_snapshot_into is not Camera.raw_snapshot_into
+        while not self._live_view_stop_event.wait(timeout=self.live_view_interval):
+            if snapshot_into and self.frame_buffer.frame_shape is not None:
+                if self.write_frame_in_place(self.raw_snapshot_into) is not None:
+                    continue
+            # fall back to raw_snapshot (e.g. for the first frame, or if the frame size has changed)
             success, frame = self.raw_snapshot()
             if success:
                 self.update_latest_frame(frame)
@@ -577,10 +1034,11 @@ class PreviewViewBox(pg.ViewBox):
 class PreviewImageItem(pg.ImageItem):
     legacy_click_callback = None
     click_callback_signal = QtCore.Signal(np.ndarray)
+    downsampling = 1  # the displayed image has one pixel for every N pixels of the frame
     def mouseClickEvent(self, ev):
         """Handle a mouse click on the image."""
         if ev.button() == QtCore.Qt.LeftButton:
-            pos = np.array(ev.pos())
+            pos = np.array(ev.pos()) * self.downsampling
             if self.legacy_click_callback is not None:
         #        size = np.array(self.image.shape[:2])
      #           point = pos/size
@@ -595,11 +1053,29 @@ class PreviewImageItem(pg.ImageItem):
     
 
 class CameraPreviewWidget(pg.GraphicsView):
-    """A Qt Widget to display the live feed from a camera."""
+    """A Qt Widget to display the live feed from a camera.
+
+    New frames may arrive faster than they can be drawn, so the widget only
+    ever keeps the most recent one, and draws it at most `max_fps` times per
+    second - frames that arrive in between are dropped.  Frames are
+    downsampled to roughly the resolution they'll appear on screen before
+    they are drawn.  `display_fps` and `dropped_frames` show how the widget
+    is keeping up.
+    """
     update_data_signal = QtCore.Signal(np.ndarray)
+    draw_requested = QtCore.Signal()
     
-    def __init__(self):
+    def __init__(self, max_fps=30):
         super(CameraPreviewWidget, self).__init__()
+        self.max_fps = max_fps
+        self.frames_received = 0
+        self.frames_displayed = 0
+        self.dropped_frames = 0
+        self.display_fps = 0.0
+        self._pending_frame = None  # an image, or a camera to take latest_frame from
+        self._draw_scheduled = False
+        self._pending_lock = threading.Lock()
+        self._last_draw_time = 0
         
         self.image_item = PreviewImageItem()
         self.view_box = PreviewViewBox(lockAspect=1.0, invertY=True)
@@ -615,15 +1091,30 @@ class CameraPreviewWidget(pg.GraphicsView):
         # We want to make sure we always update the data in the GUI thread.
         # This is done using the signal/slot mechanism
         self.update_data_signal.connect(self.update_widget, type=QtCore.Qt.QueuedConnection)
+        self.draw_requested.connect(self._draw_pending_frame, type=QtCore.Qt.QueuedConnection)
+
+    def downsampling_for(self, shape):
+        """The step to take through the frame's pixels so we draw about one pixel per pixel on the screen."""
+        (x_min, x_max), (y_min, y_max) = self.view_box.viewRange()
+        width, height = self.view_box.width(), self.view_box.height()
+        if len(shape) < 2 or width < 1 or height < 1:
+            return 1
+        visible = min(x_max - x_min, shape[1]) / width, min(y_max - y_min, shape[0]) / height
+        return max(int(min(visible)), 1)
 
     def update_widget(self, newimage):
         """Set the image, but do so in the Qt main loop to avoid threading nasties."""
-        # I've explicitly dealt with the datatype of the source image, to avoid
-        # a bug in the way pyqtgraph interacts with numpy 1.10.  This means
-        # scaling the display values will fail for integer data.  I've thus
-        # forced floating-point for anything that isn't a u8, and assumed u8
-        # wants to be displayed raw.  You can always use filter_function to
-        # tweak the brightness/contrast.
+        # uint8 images are displayed raw, and other types are scaled by
+        # pyqtgraph.  You can always use filter_function to tweak the
+        # brightness/contrast.  The image is never converted to another
+        # dtype, but it is downsampled to the size it appears on screen.
+        shape = newimage.shape
+        step = self.downsampling_for(shape)
+        if step > 1:
+            newimage = newimage[::step, ::step, ...]
+        if step != self.image_item.downsampling:
+            self.image_item.downsampling = step
+            self.image_item.setTransform(QtGui.QTransform.fromScale(step, step))
         if len(newimage.shape)==2:
             newimage = newimage.transpose()
         elif len(newimage.shape)==3:
@@ -631,15 +1122,55 @@ class CameraPreviewWidget(pg.GraphicsView):
         if newimage.dtype =="uint8":
             self.image_item.setImage(newimage, autoLevels=False)
         else:
-            self.image_item.setImage(newimage.astype(float))
-        if newimage.shape != self._image_shape:
-            self._image_shape = newimage.shape
-            self.set_crosshair_centre((newimage.shape[1]/2.0, newimage.shape[0]/2.0))
+            self.image_item.setImage(newimage)
+        if shape != self._image_shape:
+            self._image_shape = shape
+            self.set_crosshair_centre((shape[0]/2.0, shape[1]/2.0))
+
+    def _frame_arrived(self, frame):
+        """Store a frame (or a camera) to draw next, dropping any that's waiting, and make sure a draw is scheduled."""
+        with self._pending_lock:
+            self.frames_received += 1
+            if self._pending_frame is not None:
+                self.dropped_frames += 1
+            self._pending_frame = frame
+            if self._draw_scheduled:
+                return
+            self._draw_scheduled = True
+        self.draw_requested.emit()
+
+    def _draw_pending_frame(self):
+        """Draw the most recent frame, waiting if we've drawn one less than 1/max_fps seconds ago (GUI thread)."""
+        wait = self._last_draw_time + 1.0 / self.max_fps - time.time()
+        if wait > 0:
+            QtCore.QTimer.singleShot(int(np.ceil(wait * 1000)), self._draw_pending_frame)
+            return
+        with self._pending_lock:
+            frame, self._pending_frame = self._pending_frame, None
+            self._draw_scheduled = False
+        if isinstance(frame, Camera):
+            frame = frame.latest_frame
+        if frame is None:
+            return
+        self.update_widget(frame)
+        now = time.time()
+        if self.frames_displayed > 0:
+            fps = 1.0 / max(now - self._last_draw_time, 1e-6)
+            self.display_fps = fps if self.display_fps == 0 else 0.9 * self.display_fps + 0.1 * fps
+        self._last_draw_time = now
+        self.frames_displayed += 1
+
     def update_image(self, newimage):
-        """Update the image displayed in the preview widget."""
-        # NB compared to previous versions, pyqtgraph flips in y, hence the
-        # funny slice on the next line.
-        self.update_data_signal.emit(newimage) # ToDo: understand 
+        """Update the image displayed in the preview widget.
+
+        This may be called from any thread.  If the widget is still waiting
+        to draw a previous image, that image is dropped.
+        """
+        self._frame_arrived(newimage)
+
+    def new_frame_available(self, camera):
+        """Tell the widget a camera has a new frame: its latest_frame is drawn when the widget is next ready."""
+        self._frame_arrived(camera)
         
     def add_legacy_click_callback(self, function):
         """Add an old-style (coordinates in fractions-of-an-image) callback."""
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Autofocus
+=========
+
+Search-based autofocus for `CameraWithLocation`.
+
+`CameraWithLocation.autofocus` images a fixed list of Z positions, which costs the same number of exposures every
+time however close we start to focus.  The engine here instead searches for the peak of the focus merit function:
+
+1. Starting from a predicted Z (from a `FocusMap` of previous results nearby, if there are any), it steps up or down
+   hill with increasing step sizes until the peak is bracketed, i.e. it has a point that's better than the points
+   either side of it.  While the merit of one image is being calculated, the stage is already moving to the next
+   position, as during this phase we know where we'll go next unless the peak has just been bracketed.
+2. The bracket is then narrowed by parabolic interpolation, falling back to golden-section steps when the parabola is
+   not trustworthy, until it's smaller than `tolerance`.
+
+The merit function is calculated on a region in the middle of the image (`roi_size`), as the full frame is rarely
+needed and is slow to process.  Engines are pluggable: subclass `AutofocusEngine` and set
+`CameraWithLocation.autofocus_engine` to use a different search.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+GOLDEN_RATIO = (1 + 5 ** 0.5) / 2
+
+
+def af_merit_squared_laplacian(image):
+    """Return the mean squared Laplacian of an image - a sharpness metric.
+
+    The image will be converted to grayscale if its shape is MxNx3"""
+    if len(image.shape) == 3:
+        image = np.mean(image, axis=2, dtype=image.dtype)
+    assert len(image.shape) == 2, "The image is the wrong shape - must be 2D or 3D"
+    return np.sum(cv2.Laplacian(image, ddepth=cv2.CV_32F) ** 2)
+
+
+def crop_centered(image, size=(100, 100)):
+    """Return the middle of an image (or the whole image if size is None)."""
+    if size is None:
+        return image
+    return image[image.shape[0]//2-size[0]//2:image.shape[0]//2+size[0]//2,
+                 image.shape[1]//2-size[1]//2:image.shape[1]//2+size[1]//2]
+
+
+def parabola_vertex(z, merit):
+    """Return the Z of the turning point of the parabola through three points (None if they're in a line)."""
+    (z1, z2, z3), (f1, f2, f3) = z, merit
+    denominator = (z2 - z1) * (f2 - f3) - (z2 - z3) * (f2 - f1)
+    if denominator == 0:
+        return None
+    return z2 - 0.5 * ((z2 - z1) ** 2 * (f2 - f3) - (z2 - z3) ** 2 * (f2 - f1)) / denominator
+
+
+class FocusMap(object):
+    """Remember where the focus was found, so nearby autofocus searches can start from a predicted Z.
+
+    Positions are binned into square regions of side `region_size` (in stage units).  The prediction for a position
+    is the most recent focus found in its region or, failing that, the mean of those found in the neighbouring regions.
+    """
+    def __init__(self, region_size=10.0):
+        self.region_size = region_size
+        self.focus_by_region = dict()
+
+    def region(self, position):
+        """The indices of the region containing an XY(Z) position."""
+        return tuple(np.floor(np.asarray(position[:2], dtype=float) / self.region_size).astype(int))
+
+    def add(self, position):
+        """Record that the sample was in focus at an XYZ position."""
+        self.focus_by_region[self.region(position)] = float(position[2])
+
+    def predict(self, position):
+        """Return the predicted Z of best focus at an XY position, or None if we've not focused nearby."""
+        i, j = self.region(position)
+        if (i, j) in self.focus_by_region:
+            return self.focus_by_region[(i, j)]
+        neighbours = [self.focus_by_region[(i + di, j + dj)] for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                      if (i + di, j + dj) in self.focus_by_region]
+        if len(neighbours) == 0:
+            return None
+        return float(np.mean(neighbours))
+
+    def clear(self):
+        """Forget all the focus positions."""
+        self.focus_by_region.clear()
+
+
+class AutofocusEngine(object):
+    """Base class for ways of finding the focus with a CameraWithLocation.
+
+    Subclasses should override `search`, and may use `measure` to take an image at a given Z and score it.
+    """
+    def __init__(self, merit_function=af_merit_squared_laplacian, roi_size=None, focus_map=None):
+        """Set up the engine.
+
+        :param merit_function: takes an image and returns a focus score, which we maximise
+        :param roi_size: the (height, width) in pixels of the region in the middle of the image that's scored, or None
+            to score the whole image
+        :param focus_map: a FocusMap, used to predict where the focus will be (None to disable prediction)
+        """
+        self.merit_function = merit_function
+        self.roi_size = roi_size
+        self.focus_map = focus_map
+
+    def merit(self, image):
+        """Score an image, using the region of interest."""
+        return self.merit_function(crop_centered(image, self.roi_size))
+
+    def move_z(self, cwl, z):
+        """Move the stage to a given Z, without moving in XY."""
+        position = np.array(cwl.stage.position, dtype=float)
+        position[2] = z
+        cwl.stage.move(position)
+
+    def acquire(self, cwl, z):
+        """Move to z, wait for the stage to settle, and return the position and an image."""
+        self.move_z(cwl, z)
+        cwl.settle()
+        return np.array(cwl.stage.position, dtype=float), cwl.color_image(update_latest_frame=True)
+
+    def measure(self, cwl, z):
+        """Move to z and return the position and the focus merit there."""
+        position, image = self.acquire(cwl, z)
+        return position, self.merit(image)
+
+    def focus(self, cwl, update_progress=lambda p: p):
+        """Find the focus and move there, returning (shift, positions, merits) like CameraWithLocation.autofocus.
+
+        The prediction from focus_map, if any, is used as the starting point, and the result is added to it.
+        """
+        here = np.array(cwl.stage.position, dtype=float)
+        camera_live_view = cwl.camera.live_view
+        if cwl.disable_live_view:
+            cwl.camera.live_view = False
+        try:
+            predicted_z = self.focus_map.predict(here) if self.focus_map is not None else None
+            best_z, positions, merits = self.search(cwl, here[2] if predicted_z is None else predicted_z,
+                                                    predicted=predicted_z is not None,
+                                                    update_progress=update_progress)
+            self.move_z(cwl, best_z)
+        finally:
+            cwl.camera.live_view = camera_live_view
+        new_position = np.array(cwl.stage.position, dtype=float)
+        if self.focus_map is not None and len(merits) > 0 and np.ptp(merits) > 0:
+            self.focus_map.add(new_position)
+        return new_position - here, np.array(positions), np.array(merits)
+
+    def search(self, cwl, start_z, predicted=False, update_progress=lambda p: p):
+        """Look for the focus, starting at start_z, and return (best_z, positions, merits).
+
+        positions and merits should list every image that was taken.  If predicted is True, start_z came from the
+        focus map, so the focus is probably close by.
+        """
+        raise NotImplementedError("Autofocus engines must implement search()")
+
+
+class CoarseToFineAutofocus(AutofocusEngine):
+    """Bracket the peak of the focus merit, then refine it with parabolic/golden-section steps.
+
+    See the module documentation for how the search works.  Each focus typically takes 5 or 6 images from a cold
+    start, and fewer when starting from a good prediction.
+    """
+    def __init__(self, step=1.0, tolerance=0.1, max_bracket_steps=8, max_refine_steps=4,
+                 predicted_step_factor=0.5, **kwargs):
+        """Set up the search.
+
+        :param step: the first step size (in stage units) when bracketing the focus
+        :param tolerance: stop refining once the bracket is smaller than this
+        :param max_bracket_steps: give up, and go to the best point so far, if the peak isn't bracketed in this many
+            steps
+        :param max_refine_steps: the maximum number of extra images to take while refining the bracket
+        :param predicted_step_factor: scale the first step by this when starting from a predicted focus
+
+        Further arguments are passed to AutofocusEngine.
+        """
+        super(CoarseToFineAutofocus, self).__init__(**kwargs)
+        self.step = step
+        self.tolerance = tolerance
+        self.max_bracket_steps = max_bracket_steps
+        self.max_refine_steps = max_refine_steps
+        self.predicted_step_factor = predicted_step_factor
+
+    def search(self, cwl, start_z, predicted=False, update_progress=lambda p: p):
+        positions, merits = [], []
+        samples = dict()  # merit at each Z we've imaged
+
+        def record(position, merit):
+            positions.append(position)
+            merits.append(merit)
+            samples[position[2]] = merit
+            update_progress(len(merits))
+            return merit
+
+        step = self.step * (self.predicted_step_factor if predicted else 1.0)
+        bracket = self._bracket(cwl, start_z, step, record)
+        if bracket is None:  # no peak in range: use the best point we saw
+            return max(samples, key=samples.get), positions, merits
+        a, b, c = bracket
+        for i in range(self.max_refine_steps):
+            if abs(c - a) < self.tolerance:
+                break
+            z = self._next_refinement(a, b, c, samples)
+            position, merit = self.measure(cwl, z)
+            z = position[2]
+            record(position, merit)
+            converged = abs(z - b) < self.tolerance  # the new point agrees with the best one so far
+            # keep the best point in the middle, with a point either side of it that's worse
+            if merit > samples[b]:
+                a, b, c = (b, z, c) if z > b else (a, z, b)
+            elif z > b:
+                c = z
+            else:
+                a = z
+            if converged:
+                break
+        vertex = parabola_vertex((a, b, c), (samples[a], samples[b], samples[c]))
+        if vertex is not None and a < vertex < c:
+            return vertex, positions, merits
+        return b, positions, merits
+
+    def _bracket(self, cwl, start_z, step, record):
+        """Step uphill from start_z until the merit drops, returning (a, b, c) in ascending Z order, or None."""
+        position, image = self.acquire(cwl, start_z)
+        z0, f0 = position[2], record(position, self.merit(image))
+        position, image = self.acquire(cwl, start_z + step)
+        z1, f1 = position[2], record(position, self.merit(image))
+        if f1 < f0:  # go downhill in Z instead
+            step = -step
+            z0, f0, z1, f1 = z1, f1, z0, f0
+        step *= GOLDEN_RATIO
+        position, image = self.acquire(cwl, z1 + step)
+        with ThreadPoolExecutor(max_workers=1) as merit_executor:  # shut down at the end of each search
+            for i in range(self.max_bracket_steps):
+                last_step = i + 1 == self.max_bracket_steps
+                merit = merit_executor.submit(self.merit, image)
+                step *= GOLDEN_RATIO
+                if not last_step:
+                    self.move_z(cwl, position[2] + step)  # the stage moves while the merit is calculated
+                z2, f2 = position[2], record(position, merit.result())
+                if f2 < f1:
+                    return tuple(sorted((z0, z1, z2)))
+                z0, f0, z1, f1 = z1, f1, z2, f2
+                if not last_step:
+                    cwl.settle()
+                    position = np.array(cwl.stage.position, dtype=float)
+                    image = cwl.color_image(update_latest_frame=True)
+        return None
+
+    def _next_refinement(self, a, b, c, samples):
+        """Pick the next Z to measure inside the bracket a < b < c, where b is the best so far."""
+        vertex = parabola_vertex((a, b, c), (samples[a], samples[b], samples[c]))
+        minimum_gap = self.tolerance / 4
+        if vertex is not None and a + minimum_gap < vertex < c - minimum_gap and abs(vertex - b) > minimum_gap:
+            return vertex
+        # golden section step into the larger of the two intervals
+        if c - b > b - a:
+            return b + (c - b) / GOLDEN_RATIO ** 2
+        return b - (b - a) / GOLDEN_RATIO ** 2
@@ -21,7 +21,8 @@ import nplab.instrument.camera
 from nplab.instrument.stage import Stage
 from nplab.instrument import Instrument
 import numpy as np
-from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, ensure_2d, locate_feature_in_image, datum_pixel
+from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, ensure_2d, locate_feature_in_image, datum_pixel, \
+    FeatureTracker
 from nplab.experiment import Experiment, ExperimentStopped
 from nplab.experiment.gui import ExperimentWithProgressBar, run_function_modally
 from nplab.utils.gui import QtCore, QtGui, QtWidgets
@@ -31,6 +32,8 @@ from scipy import ndimage
 from scipy.signal import argrelextrema
 from nplab.ui.ui_tools import QuickControlBox, UiTools
 from nplab.utils.notified_property import DumbNotifiedProperty
+from nplab.instrument.camera.autofocus import (af_merit_squared_laplacian, crop_centered, CoarseToFineAutofocus,
+                                               FocusMap)
 import time
 
 
@@ -38,17 +41,6 @@ def distance(p1, p2): # between two ndarrays
     return  ((p1-p2)**2).sum()
 
 
-# Autofocus merit functions
-def af_merit_squared_laplacian(image):
-    """Return the mean squared Laplacian of an image - a sharpness metric.
-
-    The image will be converted to grayscale if its shape is MxNx3"""
-    if len(image.shape) == 3:
-        image = np.mean(image, axis=2, dtype=image.dtype)
-    assert len(image.shape) == 2, "The image is the wrong shape - must be 2D or 3D"
-    return np.sum(cv2.Laplacian(image, ddepth=cv2.CV_32F) ** 2)
-
-
 class CameraWithLocation(Instrument):
     """
     A class wrapping a camera and a stage, allowing them to work together.
@@ -76,6 +68,8 @@ class CameraWithLocation(Instrument):
         self.camera = camera
         self.stage = stage
         self.filter_images = False
+        # search_autofocus uses this, and remembers where it found the focus so nearby searches are quicker
+        self.autofocus_engine = CoarseToFineAutofocus(step=self.af_step_size, focus_map=FocusMap())
         Instrument.__init__(self)
 
         shape = self.camera.color_image().shape
@@ -126,11 +120,7 @@ class CameraWithLocation(Instrument):
             image = self.camera.filter_function(image)
         return self._add_position_metadata(image)
     
-    @staticmethod
-    def crop_centered(image, size=(100,100)):
-        if size is None: return image
-        return image[image.shape[0]//2-size[0]//2:image.shape[0]//2+size[0]//2,
-                     image.shape[1]//2-size[1]//2:image.shape[1]//2+size[1]//2]
+    crop_centered = staticmethod(crop_centered)
     
     def thumb_image(self, size=(100,100)):
         """Return a cropped "thumb" from the CWL with size  """
@@ -222,6 +212,7 @@ class CameraWithLocation(Instrument):
         if autofocus_first: self.autofocus(**autofocus_args)
         image = self.color_image()
         assert isinstance(image, ImageWithLocation), "CameraWithLocation should return an ImageWithLocation...?"
+        tracker = FeatureTracker(feature, margin=margin)  # prepares the feature once, for all the iterations
 
         last_move = np.infty
         for i in range(max_iterations):
@@ -229,11 +220,8 @@ class CameraWithLocation(Instrument):
                 self.settle()
                 image = self.color_image(update_latest_frame=True)
                # , image_size
-                pixel_position = locate_feature_in_image(image,
-                                                         feature,
-                                                         margin=margin,
-                                                         restrict=(margin > 0))
-             #   pixel_position = locate_feature_in_image(image, feature,margin=margin)
+                # after each move, the feature should be on our datum pixel, so search around there
+                pixel_position = tracker.locate(image, predicted_position=datum_pixel(image))
                 
                 new_position = image.pixel_to_location(pixel_position)
                 dist = distance(image.datum_location, new_position)
@@ -342,6 +330,20 @@ class CameraWithLocation(Instrument):
         else:
             return shift, pos, powers
 
+    def search_autofocus(self, update_progress=lambda p:p):
+        """Find the focus by searching for the peak of the merit function, and move there.
+
+        Rather than imaging a fixed range of Z positions, this uses
+        `autofocus_engine` (by default a CoarseToFineAutofocus) to bracket the
+        peak and then refine it, starting from the focus found nearby last
+        time if there is one.  It usually needs fewer exposures than
+        `autofocus`.  Returns (shift, positions, merits) like `autofocus`.
+        The first step of the search is `af_step_size`, as for `autofocus`.
+        """
+        if hasattr(self.autofocus_engine, 'step'):
+            self.autofocus_engine.step = self.af_step_size  # it may have been changed in the GUI
+        return self.autofocus_engine.focus(self, update_progress=update_progress)
+
     def autofocus_gui(self):
         """Run an autofocus using default parameters, with a GUI progress bar."""
         run_function_modally(self.autofocus, progress_maximum=self.af_steps+1)
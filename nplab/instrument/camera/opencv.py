@@ -60,6 +60,20 @@ class OpenCVCamera(Camera):
         else:
             return False, None
         
+    def raw_snapshot_into(self, out):
+        """Take a snapshot straight into an existing array (used by live view)."""
+        with self.acquisition_lock:
+            ret, frame = self.cap.read(out)
+            if not ret:
+                return False
+            if frame is not out:  # OpenCV couldn't use our array, e.g. the size has changed
+                if frame.shape != out.shape:
+                    return False
+                out[...] = frame
+            if len(out.shape) == 3:
+                cv2.cvtColor(out, cv2.COLOR_BGR2RGB, dst=out)
+            return True
+
     def get_camera_parameter(self, parameter_name):
         """Get the value of a camera parameter (though you should really use the property)"""
         return self.cap.get(getattr(cv2,parameter_name))
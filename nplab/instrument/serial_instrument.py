@@ -81,7 +81,9 @@ class SerialInstrument(MessageBusInstrument):
                 return
             if port is None: port = self.find_port()
             assert port is not None, "We don't have a serial port to open, meaning you didn't specify a valid port and autodetection failed.  Are you sure the instrument is connected?"
-            self.ser = serial.Serial(port, **self.port_settings)
+            # serial_for_url also accepts pyserial URLs, e.g. loop:// for testing
+            self.ser = serial.serial_for_url(port, **self.port_settings)
+            self._read_buffer = bytearray()  # bytes received after the end of the last line we read
             # self.ser_io = io.TextIOWrapper(io.BufferedRWPair(self.ser, self.ser,1),
             #                                newline = self.termination_character,
             #                                line_buffering = True)
@@ -119,6 +121,7 @@ class SerialInstrument(MessageBusInstrument):
         """Make sure there's nothing waiting to be read, and clear the buffer if there is."""
         with self.communications_lock:
             self.ser.reset_input_buffer()
+            del self._read_buffer[:]
             # if self.ser.inWaiting() > 0: self.ser.flushInput()
     def flush_output_buffer(self):
         """Make sure there's nothing waiting to be written, and clear the buffer if there is."""
@@ -126,23 +129,40 @@ class SerialInstrument(MessageBusInstrument):
             self.ser.reset_output_buffer()
 
     def readline(self, timeout=None):
+        """Read one line (up to and including termination_character) from the serial port.
+
+        Rather than reading one byte at a time, we read everything that's
+        waiting.  Any bytes after the end of the line are kept for the next
+        call, so several replies can be read back one after another (they are
+        discarded by `flush_input_buffer`).  If the port times out, or there's
+        no complete line after `timeout` seconds, whatever was received is
+        returned.  termination_read is replaced with a newline.
+        """
         with self.communications_lock:
             if hasattr(self, 'timeout') and timeout is None:
                 timeout = self.timeout
             elif timeout is None:
                 timeout = 10
             eol = str.encode(self.termination_character)
-            leneol = len(eol)
-            line = bytearray()
+            buffer = self._read_buffer
             start = time.time()
-            while time.time() - start < timeout:
-                c = self.ser.read(1)
-                if c:
-                    line += c
-                    if line[-leneol:] == eol:
-                        break
-                else:
+            searched = 0  # the line can't end before this point in the buffer
+            while True:
+                end = buffer.find(eol, searched) if eol else -1  # with no EOL, read until the port times out
+                if end >= 0:
+                    end += len(eol)
+                    break
+                searched = max(len(buffer) - len(eol) + 1, 0)
+                if time.time() - start >= timeout:
+                    end = len(buffer)
+                    break
+                received = self.ser.read(max(self.ser.in_waiting, 1))  # block for the first byte, if need be
+                if not received:
+                    end = len(buffer)
                     break
+                buffer += received
+            line = bytes(buffer[:end])
+            del buffer[:end]
             return line.decode().replace(self.termination_read, '\n')
 
     def test_communications(self):
@@ -15,6 +15,16 @@ instance.
 For TCP messaging we use repr and ast.literal_eval instead of json.dumps and json.loads because they allow us to easily
 send Python lists/tuples
 
+Arrays are expensive to send as text (a 2048x2048 frame becomes hundreds of MB of repr), so clients and servers can also
+talk a binary framing: a request that starts with binary_magic gets its reply as a length-prefixed header (a repr'd dict
+with the dtype, shape and attrs) followed by the raw ndarray buffer. The client negotiates this on every connection by
+sending its request framed in this way; a server that does not understand it replies with a text error, and the client
+falls back to the text protocol.
+
+Binary connections are persistent: clients keep one pooled connection per server address, and every request carries a
+request ID, so several calls can be in flight at once (see client.call_async) and replies can arrive out of order. The
+server serves each connection in its own thread.
+
 NOTE: class.__dict__ does not contain superclass attributes or methods, so by default we only override the class methods
     but not any of the base classes. If you want to also send the superclass methods to the server, you need to
     explicitly list which methods you want to send
@@ -54,9 +64,14 @@ import inspect
 import numpy as np
 import sys
 import re
+import struct
+import itertools
+from concurrent.futures import Future
 
 BUFFER_SIZE = 3131894
 message_end = 'tcp_termination'.encode()
+binary_magic = b'NPLB'
+binary_header = struct.Struct('!qIQ')  # request ID (-1 if none), header length, payload length
 
 
 def parse_arrays(value):
@@ -91,6 +106,119 @@ def parse_strings(value):
         return value
 
 
+def to_literal(value):
+    """Utility function to make numpy values representable with repr/ast.literal_eval
+
+    :param value: python or numpy object (dictionaries, lists and tuples are converted recursively)
+    :return:
+    """
+    if isinstance(value, dict):
+        return dict((k, to_literal(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return type(value)(to_literal(v) for v in value)
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, bytes):
+        return value
+    elif isinstance(value, Exception):
+        return str(value)
+    return value
+
+
+def encode_binary(value, request_id=None):
+    """Utility function to frame a value for the binary protocol
+
+    Arrays are sent as their raw buffer, with the dtype, shape and (if present) attrs in the header, so that they do not
+    need to be converted to text. Anything else is sent as repr in the header, with an empty payload.
+
+    :param value: object to be sent
+    :param request_id: int or None. Sent in the fixed-size part of the frame, so that replies can be matched to requests
+    :return: 2-tuple of bytes-like objects (header frame, payload) to be sent one after the other
+    """
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        array = np.ascontiguousarray(value)
+        header = dict(dtype=array.dtype.str, shape=array.shape)
+        if isinstance(value, ArrayWithAttrs):
+            header['attrs'] = to_literal(dict(value.attrs))
+        payload = array.view(np.uint8).reshape(-1) if array.size else b''
+    else:
+        header = dict(value=to_literal(value))
+        payload = b''
+    header = repr(header).encode()
+    request_id = -1 if request_id is None else request_id
+    return binary_magic + binary_header.pack(request_id, len(header), len(payload)) + header, payload
+
+
+def decode_binary(header, payload):
+    """Utility function to convert a binary frame back into the value that was sent
+
+    :param header: bytes. The header of the frame (without the magic or the lengths)
+    :param payload: bytearray. The raw buffer of the frame
+    :return:
+    """
+    header = ast.literal_eval(header.decode())
+    if 'dtype' in header:
+        array = np.frombuffer(payload, dtype=np.dtype(header['dtype'])).reshape(header['shape'])
+        if 'attrs' in header:
+            return ArrayWithAttrs(array, header['attrs'])
+        return array
+    return header['value']
+
+
+def recv_exactly(sock, size, initial=b''):
+    """Utility function to read a given number of bytes from a socket
+
+    :param sock: socket to read from
+    :param size: number of bytes to read
+    :param initial: bytes that have already been read from the socket
+    :return: (bytearray of the requested size, any extra bytes in initial)
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    n_initial = min(len(initial), size)
+    view[:n_initial] = initial[:n_initial]
+    received = n_initial
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError('Socket closed after %d of %d bytes' % (received, size))
+        received += n
+    return buf, initial[n_initial:]
+
+
+def recv_binary(sock, initial=b''):
+    """Utility function to read a binary frame from a socket
+
+    :param sock: socket to read from
+    :param initial: bytes that have already been read from the socket (including the binary_magic)
+    :return: (request ID or None, header bytes, payload bytearray, any bytes read beyond the frame)
+    """
+    prefix, initial = recv_exactly(sock, len(binary_magic) + binary_header.size, initial)
+    if not prefix.startswith(binary_magic):
+        raise ValueError('Expected a binary frame, received %s' % subselect(bytes(prefix)))
+    request_id, header_length, payload_length = binary_header.unpack(bytes(prefix[len(binary_magic):]))
+    header, initial = recv_exactly(sock, header_length, initial)
+    payload, initial = recv_exactly(sock, payload_length, initial)
+    return (None if request_id < 0 else request_id), header, payload, initial
+
+
+def send_binary(sock, value, request_id=None):
+    """Utility function to send a value as a binary frame
+
+    :param sock: socket to send on
+    :param value: object to be sent
+    :param request_id: int or None. ID of the request this frame belongs to
+    :return: number of bytes sent
+    """
+    frame, payload = encode_binary(value, request_id)
+    sock.sendall(frame)
+    if len(payload):
+        sock.sendall(payload)
+    return len(frame) + len(payload)
+
+
 def subselect(string, size=100):
     """Utility function to create a shortened version of strings for logging
 
@@ -105,12 +233,89 @@ def subselect(string, size=100):
 
 
 class ServerHandler(socketserver.BaseRequestHandler):
+    """Serves the requests on one connection
+
+    Text requests are answered once, and the connection is closed. Binary requests are answered in the same framing,
+    and the connection is kept open so that the client can send any number of them. Binary requests can carry a request
+    ID, which is sent back with the reply; if server.concurrent_requests is set, each of them is run in its own thread,
+    so replies can come back out of order.
+    """
+    def setup(self):
+        self.send_lock = threading.Lock()
+
     def handle(self):
+        leftover = b''
+        while True:
+            try:
+                raw_data = leftover if len(leftover) else self.request.recv(BUFFER_SIZE)
+                while 0 < len(raw_data) < len(binary_magic) and binary_magic.startswith(raw_data):
+                    raw_data += self.request.recv(BUFFER_SIZE)
+                if len(raw_data) == 0:
+                    return  # the client closed the connection
+                if not raw_data.startswith(binary_magic):
+                    return self.handle_text(raw_data)
+                request_id, header, payload, leftover = recv_binary(self.request, raw_data)
+                _, leftover = recv_exactly(self.request, len(message_end), leftover)  # consume the text terminator
+                request = decode_binary(header, payload)
+            except Exception as e:
+                self.server._logger.debug("Closing connection: %s" % e)
+                return
+
+            if self.server.concurrent_requests and request_id is not None:
+                thread = threading.Thread(target=self.reply_binary, args=(request, request_id))
+                thread.daemon = True
+                thread.start()
+            else:
+                self.reply_binary(request, request_id)
+
+    def handle_text(self, raw_data):
+        raw_data = raw_data.strip()
+        while message_end not in raw_data:
+            raw_data += self.request.recv(BUFFER_SIZE).strip()
+        raw_data = re.sub(re.escape(message_end) + b'$', b'', raw_data)
+        instr_reply = self.run_request(raw_data)
+
+        try:
+            if type(instr_reply) == ArrayWithAttrs:
+                reply = repr(dict(array=instr_reply.tolist(), attrs=instr_reply.attrs))
+            elif type(instr_reply) == np.ndarray:
+                reply = repr(dict(array=instr_reply.tolist()))
+            else:
+                reply = repr(instr_reply)
+        except Exception as e:
+            self.server._logger.warn(e)
+            reply = repr(dict(error=str(e)))
+        self.request.sendall(reply.encode() + message_end)
+        self.server._logger.debug(
+            "Server replied %s %s: %s" % (len(reply), sys.getsizeof(reply), subselect(reply)))
+
+    def reply_binary(self, request, request_id=None):
+        if isinstance(request, str):
+            request = request.encode()
+        instr_reply = self.run_request(request)
+        try:
+            frame, payload = encode_binary(instr_reply, request_id)
+        except Exception as e:
+            self.server._logger.warn(e)
+            frame, payload = encode_binary(dict(error=str(e)), request_id)
+        try:
+            with self.send_lock:
+                self.request.sendall(frame)
+                if len(payload):
+                    self.request.sendall(payload)
+        except socket.error as e:
+            self.server._logger.debug("Could not reply: %s" % e)
+            return
+        size = len(frame) + len(payload)
+        self.server._logger.debug("Server replied %s bytes (binary)" % size)
+
+    def run_request(self, raw_data):
+        """Pass a request on to the instrument, and return the instrument's reply
+
+        :param raw_data: bytes. Either b"list_attributes" or a repr'd command dictionary
+        :return: reply, or dict(error=...) if the request failed
+        """
         try:
-            raw_data = self.request.recv(BUFFER_SIZE).strip()
-            while message_end not in raw_data:
-                raw_data += self.request.recv(BUFFER_SIZE).strip()
-            raw_data = re.sub(re.escape(message_end) + b'$', b'', raw_data)
             self.server._logger.debug("Server received: %s" % subselect(raw_data))
 
             if raw_data == b"list_attributes":
@@ -139,31 +344,143 @@ class ServerHandler(socketserver.BaseRequestHandler):
             self.server._logger.warn(e)
             instr_reply = dict(error=e)
         self.server._logger.debug("Instrument reply: %s" % subselect(str(instr_reply)))
+        return instr_reply
+
+
+class _TextReply(Exception):
+    """Raised by a client when a binary request gets a text reply, i.e. the server only speaks the text protocol"""
+
 
+class PersistentConnection(object):
+    """A TCP connection to an instrument server that is kept open and shared between calls
+
+    Requests are sent with a request ID and return a Future straight away, so several of them can be in flight at once.
+    A reader thread collects the replies, in whatever order the server sends them, and resolves the matching Futures.
+    """
+    def __init__(self, address):
+        self.address = address
+        self._logger = create_logger('TCP connection')
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self._pending = dict()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_replies)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def request(self, message):
+        """Send a request string to the server
+
+        :param message: string to be sent over TCP
+        :return: concurrent.futures.Future that resolves to the reply, or raises RuntimeError if the server had an error
+        """
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError('Connection to %s is closed' % (self.address,))
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            frame, _ = encode_binary(message, request_id)
+            try:
+                # the message_end lets servers that only understand text know the request is over
+                self.sock.sendall(frame + message_end)
+            except socket.error as e:
+                del self._pending[request_id]
+                self._close(e)
+                raise
+        return future
+
+    def _read_replies(self):
+        received = b''
         try:
-            if type(instr_reply) == ArrayWithAttrs:
-                reply = repr(dict(array=instr_reply.tolist(), attrs=instr_reply.attrs))
-            elif type(instr_reply) == np.ndarray:
-                reply = repr(dict(array=instr_reply.tolist()))
-            else:
-                reply = repr(instr_reply)
+            while True:
+                while len(received) < len(binary_magic):
+                    data = self.sock.recv(BUFFER_SIZE)
+                    if len(data) == 0:
+                        raise ConnectionError('Connection to %s closed by the server' % (self.address,))
+                    received += data
+                if not received.startswith(binary_magic):
+                    raise _TextReply(received)
+                request_id, header, payload, received = recv_binary(self.sock, received)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is None:
+                    self._logger.warn('Received a reply to an unknown request %s' % request_id)
+                    continue
+                try:
+                    reply = decode_binary(header, payload)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                if isinstance(reply, dict) and 'error' in reply:
+                    future.set_exception(RuntimeError('Server error: %s' % reply['error']))
+                else:
+                    future.set_result(reply)
         except Exception as e:
-            self.server._logger.warn(e)
-            reply = repr(dict(error=str(e)))
-        self.request.sendall(reply.encode() + message_end)
-        self.server._logger.debug(
-            "Server replied %s %s: %s" % (len(reply), sys.getsizeof(reply), subselect(reply)))
+            self._close(e)
+
+    def _close(self, exception):
+        """Close the socket and fail any requests that are still waiting for a reply"""
+        with self._lock:
+            self.closed = True
+            pending, self._pending = self._pending, dict()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+    def close(self):
+        self._close(ConnectionError('Connection to %s was closed' % (self.address,)))
+
+
+_connection_pool = dict()
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection(address):
+    """Return the pooled PersistentConnection to address, opening a new one if there isn't an open one already
+
+    :param address: 2-tuple of IP and port
+    :return: PersistentConnection
+    """
+    address = tuple(address)
+    with _connection_pool_lock:
+        connection = _connection_pool.get(address)
+        if connection is None or connection.closed:
+            connection = PersistentConnection(address)
+            _connection_pool[address] = connection
+        return connection
+
+
+def close_connections():
+    """Close all the pooled connections"""
+    with _connection_pool_lock:
+        for connection in _connection_pool.values():
+            connection.close()
+        _connection_pool.clear()
 
 
 def create_server_class(original_class):
     """
     Given an nplab instrument class, returns a class that acts as a TCP server for that instrument.
 
+    Each client connection is served in a separate thread, and a binary connection can be used for any number of
+    requests. If server.concurrent_requests is True, several requests on one connection can also run at the same time,
+    so only set it for instruments that are safe to call from several threads.
+
     :param original_class: an nplab instrument class
     :return: server class
     """
 
-    class Server(socketserver.TCPServer):
+    class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True  # each connection is served in its own thread
+        concurrent_requests = False  # set to True to run the pipelined requests on a connection in parallel
+
         def __init__(self, server_address, *args, **kwargs):
             """
             To instantiate the server class, the TCP address needs to be given first, and then the arguments that would
@@ -238,7 +555,7 @@ def create_client_class(original_class,
             if len(list(kwargs.keys())) > 0:
                 command_dict["kwargs"] = kwargs
             reply = obj.send_to_server(repr(command_dict))
-            if type(reply) == dict:
+            if type(reply) == dict and not isinstance(reply, np.ndarray):
                 if "array" in reply:
                     if "attrs" in reply:
                         reply = ArrayWithAttrs(np.array(reply["array"]), reply["attrs"])
@@ -249,14 +566,17 @@ def create_client_class(original_class,
         return method
 
     class NewClass(original_class):
-        def __init__(self, address):
+        def __init__(self, address, binary_transport=True):
             """
             The client instantiation also gets a list of attributes present in the server instrument instance
 
             :param address: 2-tuple of IP and port to connect to
+            :param binary_transport: bool. Whether to try the binary protocol (arrays are sent as raw buffers). If the
+                    server does not support it, the client falls back to the text protocol.
             """
             self.address = address
             self._logger = create_logger(original_class.__name__ + '_client')
+            self.binary_transport = binary_transport
             self.instance_attributes = self.send_to_server("list_attributes", address)
 
         def __setattr__(self, item, value):
@@ -272,7 +592,7 @@ def create_client_class(original_class,
             if item in self.method_list:
                 super(NewClass, self).__setattr__(item, value)
             # If the item is a local attribute, set it locally
-            elif item in ['instance_attributes', 'address', '_logger'] + excluded_attributes:
+            elif item in local_attributes + excluded_attributes:
                 original_class.__setattr__(self, item, value)
             # If the item is an attribute of the server instrument, send it over TCP. Note this if needs to happen after
             # the previous one, since it needs to use the self.instance_attributes
@@ -283,8 +603,9 @@ def create_client_class(original_class,
 
         def send_to_server(self, tcp_string, address=None):
             """
-            Opens a TCP port, connects it to address, sends the tcp_string, collects the reply, and returns it after
-            literal_eval
+            Sends the tcp_string to address, collects the reply, and returns it after literal_eval. With the binary
+            protocol the pooled persistent connection to address is used; with the text protocol a new TCP connection
+            is opened for every call
 
             :param tcp_string: string to be sent over TCP
             :param address: address to send to
@@ -292,6 +613,12 @@ def create_client_class(original_class,
             """
             if address is None:
                 address = self.address
+            if self.binary_transport:
+                try:
+                    return self.send_to_server_async(tcp_string, address).result()
+                except _TextReply:
+                    self._logger.info("Server does not support binary transport, falling back to text")
+                    self.binary_transport = False
             if isinstance(tcp_string, str):
                 tcp_string = tcp_string.encode()
             self._logger.debug("Client sending: %s" % subselect(tcp_string))
@@ -312,6 +639,38 @@ def create_client_class(original_class,
                 raise e
             return ast.literal_eval(received.decode())
 
+        def send_to_server_async(self, tcp_string, address=None):
+            """
+            Sends tcp_string over the pooled persistent connection to the server, without waiting for the reply. Only
+            available with the binary protocol.
+
+            :param tcp_string: string to be sent over TCP
+            :param address: address to send to
+            :return: concurrent.futures.Future that resolves to the reply
+            """
+            if address is None:
+                address = self.address
+            if isinstance(tcp_string, bytes):
+                tcp_string = tcp_string.decode()
+            self._logger.debug("Client sending (binary): %s" % subselect(tcp_string))
+            return get_connection(address).request(tcp_string)
+
+        def call_async(self, method_name, *args, **kwargs):
+            """
+            Calls a method on the server instrument without waiting for it to finish, e.g. to pipeline many calls
+
+            :param method_name: name of the instrument method
+            :return: concurrent.futures.Future that resolves to the method's reply
+            """
+            command_dict = dict(command=method_name)
+            if len(args) > 0:
+                command_dict["args"] = args
+            if len(list(kwargs.keys())) > 0:
+                command_dict["kwargs"] = kwargs
+            return self.send_to_server_async(repr(command_dict))
+
+    local_attributes = ['instance_attributes', 'address', '_logger', 'binary_transport']
+
     if tcp_methods is None:
         tcp_methods = list(original_class.__dict__.keys())
     excluded_methods = list(excluded_methods)
@@ -330,7 +689,7 @@ def create_client_class(original_class,
 
     def my_getattr(self, item):
         # print("Getting: ", item, item in ["address", "instance_attributes"])
-        if item in ["address", "instance_attributes", "method_list", "_logger", "__init__"] + excluded_attributes:
+        if item in local_attributes + ["method_list", "__init__"] + excluded_attributes:
             # print('Excluded attribute: %s' % item)
             return object.__getattribute__(self, item)
             # return object.__getattr__(self, item)
@@ -4,8 +4,6 @@ import numpy as np
 import numpy.ma as ma
 from nplab.utils.gui import QtCore, QtGui, QtWidgets, get_qt_app, uic
 
-from collections import deque
-
 from nplab.ui.ui_tools import UiTools
 import nplab.datafile as df
 from nplab.datafile import DataFile
@@ -21,11 +19,90 @@ import os
 import inspect
 import datetime
 from nplab.instrument import Instrument
+from nplab.instrument.spectrometer.time_series import TimeSeries
+from nplab.instrument.spectrometer.accumulators import BoxcarAccumulator
+from nplab.instrument.spectrometer.group_acquisition import GroupAcquisition
 import warnings
 import pyqtgraph as pg
 from weakref import WeakSet
 
 
+def spectrum_corrections(settings, integration_time=None):
+    """Work out the offset and gain that background-subtract and reference spectra.
+
+    `settings` is anything with the attributes of a `Spectrometer` that are
+    used for processing (background, reference, background_constant, etc.).
+    Processed spectra are (spectrum - offset)*gain; offset is None if there's
+    no background, and gain is None if there's no reference.  Pixels where the
+    reference is the same as the background have a gain of NaN.
+
+    :param integration_time: the integration time of the spectra, which is
+        needed if `settings.variable_int_enabled` is True (default: that of
+        `settings`)
+    """
+    if settings.background is None:
+        return None, None
+    variable_int = settings.variable_int_enabled == True
+    if variable_int:
+        if integration_time is None:
+            integration_time = settings.integration_time
+        offset = settings.background_constant + settings.background_gradient*integration_time
+    else:
+        offset = settings.background
+    offset = np.array(offset, dtype=np.float64)
+    if settings.reference is None:
+        return offset, None
+    if variable_int:
+        denominator = ((settings.reference - (settings.background_constant
+                                              + settings.background_gradient*settings.reference_int))
+                       * integration_time/settings.reference_int)
+    else:
+        denominator = settings.reference - settings.background
+    with np.errstate(divide='ignore'):
+        gain = 1.0/np.asarray(denominator, dtype=np.float64)
+    gain[np.isinf(gain)] = np.NaN  # if the reference is nearly 0, we get infinities - just make them all NaNs.
+    return offset, gain
+
+
+def apply_spectrum_corrections(spectra, offset, gain, absorption=False, out=None):
+    """Compute (spectra - offset)*gain in one pass, as returned by `spectrum_corrections`.
+
+    `spectra` may be a single spectrum or an array of them, with wavelength
+    as the last axis.  If `out` is given, the result is written there (it may
+    be `spectra` itself, if that's a float array).  If `absorption` is True,
+    the result is converted to absorbance, log10(1/processed).
+    """
+    if offset is None:
+        if out is None:
+            processed = spectra
+        else:
+            out[...] = spectra
+            processed = out
+    else:
+        processed = np.subtract(spectra, offset, out=out)
+        if gain is not None:
+            np.multiply(processed, gain, out=processed)
+    if absorption == True:
+        if out is None:
+            return np.log10(1/processed)
+        np.reciprocal(processed, out=processed)
+        np.log10(processed, out=processed)
+    return processed
+
+
+def _correction_setting(name, doc):
+    """A Spectrometer attribute that's used to process spectra, so setting it discards the cached corrections."""
+    attribute = '_' + name
+
+    def get_setting(self):
+        return getattr(self, attribute, None)
+
+    def set_setting(self, value):
+        setattr(self, attribute, value)
+        self._corrections = None
+    return property(get_setting, set_setting, doc=doc)
+
+
 class Spectrometer(Instrument):
 
     metadata_property_names = ('model_name', 'serial_number', 'integration_time',
@@ -37,6 +114,15 @@ class Spectrometer(Instrument):
     variable_int_enabled = DumbNotifiedProperty(False)
     filename = DumbNotifiedProperty("spectrum")
     dark = False
+    background = _correction_setting('background', "The background spectrum, or None")
+    reference = _correction_setting('reference', "The reference spectrum, or None")
+    background_constant = _correction_setting('background_constant',
+                                              "The background at zero integration time (see read_background)")
+    background_gradient = _correction_setting('background_gradient',
+                                              "The rate the background increases with integration time")
+    background_int = _correction_setting('background_int', "The integration time of the background")
+    reference_int = _correction_setting('reference_int', "The integration time of the reference")
+
     def __init__(self):
         super(Spectrometer, self).__init__()
         self._model_name = None
@@ -52,7 +138,7 @@ class Spectrometer(Instrument):
         self.latest_raw_spectrum = None
         self.latest_spectrum = None
         self.averaging_enabled = False
-        self.spectra_deque = deque(maxlen = 1)
+        self.accumulator = BoxcarAccumulator(1)  # any SpectrumAccumulator, see accumulators.py
         self.absorption_enabled = False
         self._config_file = None
 
@@ -65,6 +151,7 @@ class Spectrometer(Instrument):
         self.num_spectra = 1
         self.delay = 0
         self.time_series_name = 'time_series_%d'
+        self.current_time_series = None
 
 
     def __del__(self):
@@ -143,16 +230,32 @@ class Spectrometer(Instrument):
         self.latest_raw_spectrum = np.zeros(0)
         return self.bundle_metadata(self.latest_raw_spectrum, enable=bundle_metadata)
 
+    def arm_acquisition(self, external_trigger=False):
+        """Get ready for a synchronised acquisition with other spectrometers (see group_acquisition.py).
+
+        If external_trigger is True, the spectrometer should be left waiting
+        for its hardware trigger, so that read_spectrum returns the spectrum
+        taken when the trigger arrives.  This default implementation can't do
+        that, so it raises NotImplementedError; spectrometers with a trigger
+        input should override it (and disarm_acquisition).
+        """
+        if external_trigger:
+            raise NotImplementedError("{} doesn't support external triggering".format(type(self).__name__))
+
+    def disarm_acquisition(self):
+        """Return to normal (software triggered) acquisition after arm_acquisition."""
+        pass
+
     def read_background(self):
         """Acquire a new spectrum and use it as a background measurement.
         This background should be less than 50% of the spectrometer saturation"""
         if self.averaging_enabled == True:
-            background_1 = np.average(self.read_averaged_spectrum(True,True),axis=0)
+            background_1 = self.read_averaged_spectrum(new_deque=True)
         else:
             background_1 = self.read_spectrum()
         self.integration_time = 2.0*self.integration_time
         if self.averaging_enabled == True:
-            background_2 = np.average(self.read_averaged_spectrum(True,True),axis=0)
+            background_2 = self.read_averaged_spectrum(new_deque=True)
         else:
             background_2 = self.read_spectrum()
         self.integration_time = self.integration_time/2.0
@@ -179,7 +282,7 @@ class Spectrometer(Instrument):
     def read_reference(self):
         """Acquire a new spectrum and use it as a reference."""
         if self.averaging_enabled == True:
-            self.reference = np.average(self.read_averaged_spectrum(True,True),axis=0)
+            self.reference = self.read_averaged_spectrum(new_deque=True)
         else:
             self.reference = self.read_spectrum() 
         self.reference_int = self.integration_time
@@ -212,29 +315,35 @@ class Spectrometer(Instrument):
         except TypeError:
             return False
 
-    def process_spectrum(self, spectrum):
-        """Subtract the background and divide by the reference, if possible"""
-        if self.background is not None:
-            if self.reference is not None:
-                old_error_settings = np.seterr(all='ignore')
-           #     new_spectrum = (spectrum - (self.background-np.min(self.background))*self.integration_time/self.background_int+np.min(self.background))/(((self.reference-np.min(self.background))*self.integration_time/self.reference_int - (self.background-np.min(self.background))*self.integration_time/self.background_int)+np.min(self.background))
-                if self.variable_int_enabled == True:
-                    new_spectrum = ((spectrum-(self.background_constant+self.background_gradient*self.integration_time))/((self.reference-(self.background_constant+self.background_gradient*self.reference_int))*self.integration_time/self.reference_int))
-                else:
-                    new_spectrum = (spectrum-self.background)/(self.reference-self.background)
-                np.seterr(**old_error_settings)
-                new_spectrum[np.isinf(new_spectrum)] = np.NaN #if the reference is nearly 0, we get infinities - just make them all NaNs.
-            else:
-                if self.variable_int_enabled == True:
-                    new_spectrum = spectrum-(self.background_constant+self.background_gradient*self.integration_time)
-                else:
-                    new_spectrum = spectrum-self.background
-                
-        else:
-            new_spectrum = spectrum
-        if self.absorption_enabled == True:
-            return np.log10(1/new_spectrum)
-        return new_spectrum
+    def get_correction_coefficients(self):
+        """Return the (offset, gain) used by process_spectrum (see spectrum_corrections).
+
+        These are cached, and only worked out again when the background or
+        reference settings are replaced or (if variable_int_enabled) when the
+        integration time changes.  If you modify the background or reference
+        arrays in place, call invalidate_corrections.
+        """
+        variable_int = self.variable_int_enabled == True
+        integration_time = self.integration_time if variable_int and self.background is not None else None
+        key = (variable_int, integration_time)
+        corrections = getattr(self, '_corrections', None)
+        if corrections is None or corrections[0] != key:
+            corrections = self._corrections = (key,) + spectrum_corrections(self, integration_time)
+        return corrections[1:]
+
+    def invalidate_corrections(self):
+        """Make process_spectrum work out the background/reference corrections again."""
+        self._corrections = None
+
+    def process_spectrum(self, spectrum, out=None):
+        """Subtract the background and divide by the reference, if possible.
+
+        `spectrum` may also be an (N, n_pixels) array of spectra (or a whole
+        hyperspectral image, with wavelength as the last axis), which are all
+        processed in one go.  If `out` is given, the result is written into it.
+        """
+        offset, gain = self.get_correction_coefficients()
+        return apply_spectrum_corrections(spectrum, offset, gain, self.absorption_enabled, out=out)
 
     def read_processed_spectrum(self):
         """Acquire a new spectrum and return a processed (referenced/background-subtracted) spectrum.
@@ -242,7 +351,7 @@ class Spectrometer(Instrument):
         NB if saving data to file, it's best to save raw spectra along with metadata - this is a
         convenience method for display purposes."""
         if self.averaging_enabled == True:
-            spectrum = np.average(self.read_averaged_spectrum(fresh = True),axis=0)
+            spectrum = self.read_averaged_spectrum(fresh=True)
         else:
             spectrum = self.read_spectrum()
         self.latest_spectrum = self.process_spectrum(spectrum)
@@ -292,23 +401,49 @@ class Spectrometer(Instrument):
         is to save raw spectra only, along with reference/background to allow
         later processing.
         
-        The attrs dictionary allows extra metadata to be saved in the HDF5 file."""
+        The attrs dictionary allows extra metadata to be saved in the HDF5 file.
+        
+        If averaging is enabled, the spectra in the current average are saved
+        (see SpectrumAccumulator.spectra), with the per-pixel standard error
+        of their mean in the "noise" attribute."""
+        metadata = self.metadata
         if self.averaging_enabled == True:
-            spectrum = self.read_averaged_spectrum(new_deque = new_deque)
+            self.read_averaged_spectrum(new_deque = new_deque)
+            average = self.accumulator.snapshot()
+            spectrum = average['spectra']
+            metadata.update({'averaging mode': type(self.accumulator).__name__,
+                             'number of averages': average['count'],
+                             'noise': average['standard_error']})
         else:
             spectrum = self.read_spectrum() if spectrum is None else spectrum
-        metadata = self.metadata
         metadata.update(attrs) #allow extra metadata to be passed in
         self.create_dataset(self.filename, data=spectrum, attrs=metadata) 
         #save data in the default place (see nplab.instrument.Instrument)
-    def read_averaged_spectrum(self,new_deque = False,fresh = False):
-            if fresh == True:
-                self.spectra_deque.append(self.read_spectrum())
-            if new_deque == True:
-                self.spectra_deque.clear()
-            while len(self.spectra_deque) < self.spectra_deque.maxlen:
-                self.spectra_deque.append(self.read_spectrum())
-            return self.spectra_deque
+
+    def read_averaged_spectrum(self, new_deque=False, fresh=False):
+        """Return the average of number_of_averages raw spectra, taking as many as are needed.
+
+        Spectra are added to `accumulator`, which keeps a running average, so
+        only new spectra have to be read.  If new_deque is True, the average
+        is started again; if fresh is True, at least one new spectrum is
+        added to it (e.g. to update a rolling average for display).
+        """
+        if new_deque == True:
+            self.accumulator.reset()
+        if fresh == True:
+            self.accumulator.add(self.read_spectrum())
+        while not self.accumulator.full:
+            self.accumulator.add(self.read_spectrum())
+        return self.accumulator.mean.copy()
+
+    def get_number_of_averages(self):
+        return self.accumulator.window
+
+    def set_number_of_averages(self, value):
+        self.accumulator.window = value
+
+    number_of_averages = property(get_number_of_averages, set_number_of_averages,
+                                  doc="The number of spectra averaged when averaging_enabled is True")
         
     def save_reference_to_file(self):
         pass
@@ -316,32 +451,37 @@ class Spectrometer(Instrument):
     def load_reference_from_file(self):
         pass
     
-    def time_series(self, num_spectra = None, delay = None, update_progress = lambda p:p):# delay in ms
+    def time_series(self, num_spectra=None, delay=None, update_progress=lambda p: p, interval=None,
+                    stop_event=None):
+        """Take a series of spectra, saving them to the current datafile as they're taken.
+
+        Spectra are started on a fixed schedule, every integration_time + delay
+        ms (or every `interval` ms, if it's given), so the rate doesn't drift.
+        If num_spectra is 0, spectra are taken until `stop_time_series` is
+        called (or stop_event is set).  While it's running,
+        `current_time_series.statistics` has the per-pixel mean, minimum and
+        maximum so far.  Returns the dataset the spectra are saved in - see
+        `nplab.instrument.spectrometer.time_series.TimeSeries`.
+        """
         if num_spectra is None:
             num_spectra = self.num_spectra
         if delay is None:
             delay = self.delay
-        delay/=1000
-        update_progress(0)
-        metadata = self.metadata
-        extra_metadata = {'number of spectra' : num_spectra,
-                          'spectrum end-to-start delay' : delay
-                           }
-        metadata.update(extra_metadata) 
-        to_save = []
-        times = []
-        start = time.time()
-        for spectrum_number in range(num_spectra):
-            times.append(time.time() - start)
-            to_save.append(self.read_spectrum()) # should be a numpy array
-            time.sleep(delay)
-            update_progress(spectrum_number)
-        metadata.update({'start times' : times})
-        self.create_dataset(self.time_series_name, data=to_save, attrs=metadata)
-        to_return = ArrayWithAttrs(to_save, attrs = metadata)
-        return to_return
+        if interval is None:
+            interval = self.integration_time + delay
+        self.current_time_series = TimeSeries(self, num_spectra, interval, name=self.time_series_name,
+                                              attrs={'spectrum end-to-start delay': delay / 1000.},
+                                              stop_event=stop_event)
+        return self.current_time_series.run(update_progress)
+
+    def stop_time_series(self):
+        """Stop the running time series after the current spectrum."""
+        if self.current_time_series is not None:
+            self.current_time_series.stop()
 
 class Spectrometers(Instrument):
+    filename = DumbNotifiedProperty('spectra')
+
     def __init__(self, spectrometer_list):
         assert False not in [isinstance(s, Spectrometer) for s in spectrometer_list],\
             'an invalid spectrometer was supplied'
@@ -350,7 +490,7 @@ class Spectrometers(Instrument):
         self.num_spectrometers = len(spectrometer_list)
         self._pool = ThreadPool(processes=self.num_spectrometers)
         self._wavelengths = None
-        filename = DumbNotifiedProperty('spectra')
+        self.current_acquisition = None
 
     def __del__(self):
         self._pool.close()
@@ -377,8 +517,9 @@ class Spectrometers(Instrument):
         return self._pool.map(lambda s: s.read_processed_spectrum(), self.spectrometers)
 
     def process_spectra(self, spectra):
-        pairs = list(zip(self.spectrometers, spectra))
-        return self._pool.map(lambda s_spectrum: s_spectrum[0].process_spectrum(s_spectrum[1]), pairs)
+        """Process a list of spectra, one from each spectrometer (this is quick, so it's not done in threads)."""
+        return [spectrometer.process_spectrum(spectrum)
+                for spectrometer, spectrum in zip(self.spectrometers, spectra)]
 
     def get_metadata_list(self):
         """Return a list of metadata for each spectrometer."""
@@ -403,6 +544,35 @@ class Spectrometers(Instrument):
         for spectrum,metadata in zip(spectra,metadata_list):
             g.create_dataset('spectrum_%d',data=spectrum,attrs=metadata)
             
+    def synchronised_acquisition(self, trigger=None, timeout=None, processed=False):
+        """Return a GroupAcquisition, to take spectra on all the spectrometers in lock step.
+
+        Use it as a context manager, calling its acquire method for each set
+        of spectra (e.g. at each point of a hyperspectral map); each one is
+        returned as a single record, with the start and end time of each
+        spectrum.  If trigger is given, the spectrometers are armed for an
+        external trigger, and trigger() is called to fire it.  See
+        group_acquisition.py for details.
+        """
+        return GroupAcquisition(self, trigger=trigger, timeout=timeout, processed=processed)
+
+    def read_synchronised_spectra(self, trigger=None, timeout=None):
+        """Acquire spectra from all spectrometers at the same time, and return them as a record."""
+        with self.synchronised_acquisition(trigger=trigger, timeout=timeout) as acquisition:
+            return acquisition.acquire()
+
+    def save_synchronised_spectra(self, num_acquisitions=1, trigger=None, timeout=None, attrs={},
+                                  update_progress=lambda p: p):
+        """Take spectra in lock step and save them in a new folder in the current datafile, as they're taken.
+
+        Metadata is only read once for the whole run, and the folder's
+        attributes record the throughput and the skew between spectrometers.
+        While it's running, current_acquisition.statistics is kept up to date.
+        """
+        group = self.create_data_group(self.filename, attrs=attrs)
+        self.current_acquisition = self.synchronised_acquisition(trigger=trigger, timeout=timeout)
+        return self.current_acquisition.run(num_acquisitions, group, update_progress=update_progress)
+
     def get_metadata(self):
         """
         Returns a list of dictionaries containing relevant spectrometer properties
@@ -474,7 +644,7 @@ class SpectrometerControlUI(QtWidgets.QWidget,UiTools):
                 pass
             
     def update_averages(self,*args,**kwargs):
-        self.spectrometer.spectra_deque = deque(maxlen = args[0])
+        self.spectrometer.number_of_averages = args[0]
 
     def button_pressed(self, *args, **kwargs):
         sender = self.sender()
@@ -0,0 +1,229 @@
+"""
+Spectrum Accumulators
+=====================
+
+Running averages of spectra, for `Spectrometer` averaging.
+
+Each accumulator is updated one spectrum at a time in O(pixels) time and memory (plus, for the boxcar, a ring
+buffer of the spectra in the window), so the average is always ready without going back over all the spectra that
+went into it.  As well as the mean, each one keeps a per-pixel variance, which gives an estimate of the noise in the
+spectra and in their average:
+
+`BoxcarAccumulator`
+    The mean of the last `window` spectra, kept as a running sum that's updated as spectra enter and leave the window.
+`ExponentialAccumulator`
+    An exponentially weighted moving average, with a smoothing factor of 2/(window + 1) so its memory is comparable
+    to a boxcar of the same window.  It doesn't need to store any spectra.
+`WelfordAccumulator`
+    The mean and variance of every spectrum since the last `reset`, using Welford's algorithm.
+
+Accumulators are pluggable: set `Spectrometer.accumulator` to any `SpectrumAccumulator` to change how spectra are
+averaged.
+"""
+import threading
+
+import numpy as np
+
+
+class SpectrumAccumulator(object):
+    """Base class for running averages of spectra.
+
+    Subclasses should override `reset` and `add`, keeping `count`, `mean` and `variance` up to date.  `window` is the
+    number of spectra needed for a full average (see `full`); setting it forgets the spectra accumulated so far.  Use
+    `snapshot` to get a consistent set of values from another thread.
+    """
+    def __init__(self, window=1):
+        self._lock = threading.RLock()
+        self._window = 1
+        self.window = window
+
+    def get_window(self):
+        return self._window
+
+    def set_window(self, window):
+        window = int(window)
+        if window < 1:
+            raise ValueError("The averaging window must be at least 1 spectrum")
+        with self._lock:
+            self._window = window
+            self.reset()
+
+    window = property(get_window, set_window, doc="The number of spectra in a full average")
+
+    def reset(self):
+        """Forget all the spectra."""
+        with self._lock:
+            self.count = 0
+            self.mean = None
+            self.variance = None
+
+    def add(self, spectrum):
+        """Add a spectrum to the average."""
+        raise NotImplementedError("Accumulators must implement add()")
+
+    @property
+    def full(self):
+        """Whether enough spectra have been added for a full average."""
+        return self.count >= self.window
+
+    @property
+    def effective_count(self):
+        """The number of independent spectra the mean is equivalent to, for working out its standard error."""
+        return self.count
+
+    @property
+    def standard_deviation(self):
+        """The per-pixel standard deviation of the spectra (an estimate of the noise in a single spectrum)."""
+        with self._lock:
+            return None if self.variance is None else np.sqrt(self.variance)
+
+    @property
+    def standard_error(self):
+        """The per-pixel standard error of the mean (an estimate of the noise in the average)."""
+        with self._lock:
+            if self.variance is None:
+                return None
+            return np.sqrt(self.variance / self.effective_count)
+
+    def spectra(self):
+        """Return the spectra to save for this average, as an (N, n_pixels) array.
+
+        Saved spectra are averaged over the first axis when they're displayed or analysed, so by default this is
+        just the mean.
+        """
+        with self._lock:
+            return None if self.mean is None else self.mean[np.newaxis, :].copy()
+
+    def snapshot(self):
+        """Return a dictionary of copies of the count, mean, variance, standard error and spectra."""
+        with self._lock:
+            return {'count': self.count,
+                    'mean': None if self.mean is None else self.mean.copy(),
+                    'variance': None if self.variance is None else self.variance.copy(),
+                    'standard_error': self.standard_error,
+                    'spectra': self.spectra()}
+
+    def _first_spectrum(self, spectrum):
+        """Start accumulating with a spectrum (the common part of `add` for the first spectrum)."""
+        self.count = 1
+        self.mean = spectrum.copy()
+        self.variance = np.zeros_like(spectrum)
+
+
+class BoxcarAccumulator(SpectrumAccumulator):
+    """The mean of the last `window` spectra (see module documentation).
+
+    The sums are taken relative to the first spectrum after a reset, to avoid losing precision when the variance is
+    small compared to the signal, and are recalculated from the stored spectra each time the ring buffer wraps around
+    so rounding errors can't build up.
+    """
+    def reset(self):
+        with self._lock:
+            super(BoxcarAccumulator, self).reset()
+            self._ring = None
+            self._next = 0
+            self._shift = None
+            self._sum = None
+            self._sum_of_squares = None
+
+    def add(self, spectrum):
+        spectrum = np.array(spectrum, dtype=np.float64)
+        with self._lock:
+            if self._ring is None or self._ring.shape[1:] != spectrum.shape:
+                self._ring = np.empty((self.window,) + spectrum.shape)
+                self._next = 0
+                self._shift = spectrum.copy()
+                self._sum = np.zeros_like(spectrum)
+                self._sum_of_squares = np.zeros_like(spectrum)
+                self.count = 0
+            if self.count == self.window:  # the oldest spectrum leaves the window
+                leaving = self._ring[self._next] - self._shift
+                self._sum -= leaving
+                self._sum_of_squares -= leaving**2
+            else:
+                self.count += 1
+            self._ring[self._next] = spectrum
+            entering = spectrum - self._shift
+            self._sum += entering
+            self._sum_of_squares += entering**2
+            self._next = (self._next + 1) % self.window
+            if self._next == 0 and self.count == self.window:
+                deviations = self._ring - self._shift
+                self._sum = np.sum(deviations, axis=0)
+                self._sum_of_squares = np.sum(deviations**2, axis=0)
+            mean_deviation = self._sum / self.count
+            self.mean = self._shift + mean_deviation
+            if self.count > 1:
+                self.variance = np.maximum(self._sum_of_squares - self.count*mean_deviation**2, 0) / (self.count - 1)
+            else:
+                self.variance = np.zeros_like(spectrum)
+
+    def spectra(self):
+        """Return the spectra in the window, oldest first."""
+        with self._lock:
+            if self._ring is None:
+                return None
+            if self.count < self.window:
+                return self._ring[:self.count].copy()
+            return np.roll(self._ring, -self._next, axis=0)
+
+
+class ExponentialAccumulator(SpectrumAccumulator):
+    """An exponentially weighted moving average of the spectra (see module documentation).
+
+    The smoothing factor, `alpha`, is the weight given to each new spectrum.  By default it's 2/(window + 1); set it
+    explicitly to override that.  The average counts as `full` once `window` spectra have been added.
+    """
+    def __init__(self, window=1, alpha=None):
+        self._alpha = alpha
+        super(ExponentialAccumulator, self).__init__(window)
+
+    def get_alpha(self):
+        return 2.0/(self.window + 1) if self._alpha is None else self._alpha
+
+    def set_alpha(self, alpha):
+        self._alpha = alpha
+
+    alpha = property(get_alpha, set_alpha, doc="The weight of each new spectrum in the average")
+
+    @property
+    def effective_count(self):
+        return min(self.count, (2 - self.alpha)/self.alpha)
+
+    def add(self, spectrum):
+        spectrum = np.array(spectrum, dtype=np.float64)
+        with self._lock:
+            if self.count == 0 or self.mean.shape != spectrum.shape:
+                self._first_spectrum(spectrum)
+                return
+            # until there are enough spectra, weight them equally so the first one doesn't dominate
+            alpha = max(self.alpha, 1.0/(self.count + 1))
+            deviation = spectrum - self.mean
+            self.mean += alpha*deviation
+            self.variance = (1 - alpha)*(self.variance + alpha*deviation**2)
+            self.count += 1
+
+
+class WelfordAccumulator(SpectrumAccumulator):
+    """The mean and variance of all the spectra since the last reset, using Welford's algorithm.
+
+    The average counts as `full` once `window` spectra have been added, but spectra added after that are still
+    included; call `reset` to start again.
+    """
+    def reset(self):
+        with self._lock:
+            super(WelfordAccumulator, self).reset()
+            self._m2 = None
+
+    def add(self, spectrum):
+        spectrum = np.array(spectrum, dtype=np.float64)
+        with self._lock:
+            if self.count == 0 or self.mean.shape != spectrum.shape:
+                self._first_spectrum(spectrum)
+                self._m2 = np.zeros_like(spectrum)
+                return
+            self.count += 1
+            deviation = spectrum - self.mean
+            self.mean += deviation/self.count
+            self._m2 += deviation*(spectrum - self.mean)
+            self.variance = self._m2/(self.count - 1)
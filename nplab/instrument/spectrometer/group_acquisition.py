@@ -0,0 +1,266 @@
+"""
+Synchronised Group Acquisition
+==============================
+
+Take spectra on several spectrometers at once (e.g. a VIS and an NIR spectrometer in a hyperspectral map), in lock
+step, recording when each one was started and finished.
+
+`Spectrometers.read_spectra` hands each `read_spectrum` call to a thread pool, so the spectrometers start whenever
+their thread happens to get going.  Here, each spectrometer has its own thread, started once when the group is armed.
+For each acquisition, all the threads wait at a barrier and are released together, so the only difference in start
+times is the time it takes each thread to wake up.  If a `trigger` function is given, the spectrometers are armed
+for an external (hardware) trigger instead (see `Spectrometer.arm_acquisition`), and the trigger is fired once they
+are all waiting for it.
+
+Each acquisition returns one record (a numpy structured array), with fields:
+
+``time``
+    when the spectrometers were released (or triggered), in seconds since the group was armed
+``skew``
+    the spread of the start times of the spectrometers, in seconds.  With a trigger, this is the spread of the times
+    the threads called `read_spectrum`, i.e. how long they took to wake up, not the spread of the trigger arriving
+    at the spectrometers (which are already armed for it, so start together in hardware)
+``spectrum_N``, ``start_N``, ``end_N``
+    the spectrum from spectrometer N and when it was started and returned, in seconds since the group was armed
+
+Metadata is read from the spectrometers once, when the group is armed, rather than with every spectrum.
+
+If the spectrometers time out, the group is disarmed, but the threads may still be waiting for `read_spectrum` to
+return.  The group won't be armed again until they have finished, so each spectrometer only ever has one
+acquisition going at a time.
+"""
+import threading
+import time
+
+import numpy as np
+
+
+class GroupAcquisitionStatistics(object):
+    """The number of acquisitions, their rate, and the skew between spectrometers, updated after each acquisition."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all the acquisitions."""
+        with self._lock:
+            self.count = 0
+            self.first_time = None
+            self.last_time = None
+            self.mean_skew = 0.0
+            self.max_skew = 0.0
+            self.mean_durations = None
+
+    def update(self, record, num_spectrometers):
+        """Add an acquisition record to the statistics."""
+        durations = np.array([record['end_%d' % i] - record['start_%d' % i] for i in range(num_spectrometers)])
+        skew = float(record['skew'])
+        with self._lock:
+            self.count += 1
+            if self.first_time is None:
+                self.first_time = float(record['time'])
+                self.mean_durations = durations
+            else:
+                self.mean_durations = self.mean_durations + (durations - self.mean_durations) / self.count
+            self.last_time = float(record['end_%d' % int(np.argmax(durations))])
+            self.mean_skew += (skew - self.mean_skew) / self.count
+            self.max_skew = max(self.max_skew, skew)
+
+    def snapshot(self):
+        """Return a dictionary of the statistics, including the throughput in acquisitions per second."""
+        with self._lock:
+            elapsed = None if self.first_time is None else self.last_time - self.first_time
+            return {'count': self.count,
+                    'throughput': self.count / elapsed if elapsed else None,
+                    'mean skew': self.mean_skew,
+                    'max skew': self.max_skew,
+                    'mean durations': None if self.mean_durations is None else self.mean_durations.copy()}
+
+
+class GroupAcquisition(object):
+    """Take spectra from a group of spectrometers in lock step (see module documentation).
+
+    Call `arm` to start the threads (and arm the spectrometers), `acquire` for each set of spectra, and `disarm`
+    when finished - or use the object as a context manager.  `run` does all of this, saving the spectra to the data
+    file as they're taken.  `statistics` is a `GroupAcquisitionStatistics` of the acquisitions since the group was
+    armed.
+    """
+    def __init__(self, spectrometers, trigger=None, timeout=None, processed=False):
+        """Set up the acquisition.
+
+        :param spectrometers: a `Spectrometers` group, or a list of `Spectrometer` objects
+        :param trigger: a function that fires the external trigger, or None to start the spectrometers in software
+        :param timeout: give up (raising IOError) if the spectrometers take longer than this (in seconds)
+        :param processed: if True, record processed (background subtracted/referenced) spectra rather than raw ones
+        """
+        self.spectrometers = list(getattr(spectrometers, 'spectrometers', spectrometers))
+        self.trigger = trigger
+        self.timeout = timeout
+        self.processed = processed
+        self.statistics = GroupAcquisitionStatistics()
+        self.metadata = None
+        self.armed_at = None
+        self.record_dtype = None
+        self._threads = None
+        self._old_threads = []  # threads from before the group was last disarmed, which may not have finished
+
+    @property
+    def armed(self):
+        """Whether the spectrometers are armed and their threads are running."""
+        return self._threads is not None
+
+    def arm(self):
+        """Arm the spectrometers, snapshot their metadata, and start a thread for each one."""
+        if self.armed:
+            return
+        self._join_old_threads()
+        n = len(self.spectrometers)
+        for spectrometer in self.spectrometers:
+            spectrometer.arm_acquisition(external_trigger=self.trigger is not None)
+        self.metadata = [spectrometer.metadata for spectrometer in self.spectrometers]
+        self.statistics.reset()
+        self._results = [None] * n
+        self._start_barrier = threading.Barrier(n + 1)
+        self._end_barrier = threading.Barrier(n + 1)
+        self._threads = [threading.Thread(target=self._acquisition_thread, args=(i, spectrometer), daemon=True)
+                         for i, spectrometer in enumerate(self.spectrometers)]
+        self.armed_at = time.time()
+        self._t0 = time.monotonic()
+        for thread in self._threads:
+            thread.start()
+
+    def disarm(self):
+        """Stop the threads and disarm the spectrometers."""
+        if not self.armed:
+            return
+        self._start_barrier.abort()
+        self._end_barrier.abort()
+        self._old_threads += self._threads
+        self._threads = None
+        for spectrometer in self.spectrometers:
+            spectrometer.disarm_acquisition()
+
+    def __enter__(self):
+        self.arm()
+        return self
+
+    def __exit__(self, *args):
+        self.disarm()
+
+    def _join_old_threads(self):
+        """Wait (up to the timeout) for the threads from before the last disarm, raising IOError if they don't stop.
+
+        They may still be in the middle of `read_spectrum`, after a timeout, and we mustn't start another
+        acquisition on the same spectrometers until they've finished.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        for thread in self._old_threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        self._old_threads = [thread for thread in self._old_threads if thread.is_alive()]
+        if self._old_threads:
+            raise IOError("The spectrometers are still busy with an acquisition that timed out")
+
+    def _acquisition_thread(self, index, spectrometer):
+        """Take a spectrum each time the start barrier is passed, until the barriers are aborted."""
+        read = spectrometer.read_processed_spectrum if self.processed else spectrometer.read_spectrum
+        start_barrier, end_barrier = self._start_barrier, self._end_barrier
+        while True:
+            try:
+                start_barrier.wait()
+            except threading.BrokenBarrierError:
+                return
+            try:
+                start = time.monotonic()
+                spectrum = read()
+                self._results[index] = (spectrum, start, time.monotonic())
+            except Exception as e:
+                self._results[index] = e
+            try:
+                end_barrier.wait()
+            except threading.BrokenBarrierError:
+                return
+
+    def _wait(self, barrier):
+        """Wait at one of the barriers, disarming and raising an IOError if the timeout expires."""
+        try:
+            barrier.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            self.disarm()
+            raise IOError("The spectrometers didn't finish acquiring within the timeout")
+
+    def acquire(self):
+        """Take a spectrum on each spectrometer at the same time, and return them as a record.
+
+        The group is armed first if it isn't already.
+        """
+        self.arm()
+        self._results = [None] * len(self.spectrometers)
+        self._wait(self._start_barrier)
+        released = time.monotonic()
+        if self.trigger is not None:
+            self.trigger()
+        self._wait(self._end_barrier)
+        for result in self._results:
+            if isinstance(result, Exception):
+                raise result
+        if self.record_dtype is None:
+            self.record_dtype = self.make_record_dtype([np.shape(spectrum) for spectrum, start, end in self._results])
+        record = np.zeros((), dtype=self.record_dtype)
+        record['time'] = released - self._t0
+        for i, (spectrum, start, end) in enumerate(self._results):
+            record['spectrum_%d' % i] = spectrum
+            record['start_%d' % i] = start - self._t0
+            record['end_%d' % i] = end - self._t0
+        starts = [start for spectrum, start, end in self._results]
+        record['skew'] = max(starts) - min(starts)
+        self.statistics.update(record, len(self.spectrometers))
+        return record
+
+    @staticmethod
+    def make_record_dtype(spectrum_shapes):
+        """The numpy dtype of a record, given the shapes of the spectra from each spectrometer."""
+        fields = [('time', np.float64), ('skew', np.float64)]
+        for i, shape in enumerate(spectrum_shapes):
+            fields += [('spectrum_%d' % i, np.float64, shape), ('start_%d' % i, np.float64),
+                       ('end_%d' % i, np.float64)]
+        return np.dtype(fields)
+
+    def timing(self, record):
+        """Return the fields of a record that aren't spectra, as a smaller record."""
+        names = [name for name in record.dtype.names if not name.startswith('spectrum_')]
+        timing = np.zeros((), dtype=[(name, np.float64) for name in names])
+        for name in names:
+            timing[name] = record[name]
+        return timing
+
+    def run(self, num_acquisitions, group, update_progress=lambda p: p, buffer_rows=64, flush_interval=1.0):
+        """Take num_acquisitions sets of spectra, saving them in `group` as they're taken, and return the group.
+
+        Spectra from spectrometer N are appended to the dataset "spectrum_N", which has that spectrometer's
+        metadata (snapshotted once, when the group is armed).  The times and skew of each acquisition are saved
+        in the "timing" dataset, and the statistics are saved as attributes of the group at the end.
+        """
+        buffers = []
+        update_progress(0)
+        try:
+            with self:
+                for n in range(num_acquisitions):
+                    record = self.acquire()
+                    if len(buffers) == 0:
+                        buffers = [group.append_buffer('spectrum_%d' % i, attrs=metadata, buffer_rows=buffer_rows,
+                                                       flush_interval=flush_interval)
+                                   for i, metadata in enumerate(self.metadata)]
+                        buffers.append(group.append_buffer('timing', buffer_rows=buffer_rows,
+                                                           flush_interval=flush_interval,
+                                                           attrs={'units': 's', 'armed at': self.armed_at}))
+                    for i, buffer in enumerate(buffers[:-1]):
+                        buffer.append(record['spectrum_%d' % i])
+                    buffers[-1].append(self.timing(record))
+                    update_progress(n + 1)
+        finally:
+            for buffer in buffers:
+                buffer.close()
+        for name, value in self.statistics.snapshot().items():
+            if value is not None:
+                group.attrs[name] = value
+        return group
@@ -0,0 +1,155 @@
+"""
+Spectrometer Time Series
+========================
+
+Record spectra at a fixed rate, streaming them to the data file as they are taken.
+
+Each reading is started against an absolute deadline, ``start + n*interval``, rather than after a fixed delay, so
+the rate doesn't drift by the time taken to read and save each spectrum.  If a reading overruns its slot, the next
+one starts straight away, and any slots that passed entirely during the reading are skipped (and counted) rather
+than being caught up in a burst.  Spectra are appended to a chunked,
+resizable dataset as they arrive, with a parallel dataset of time stamps, so long runs don't fill up the memory and
+a crash loses at most the last few spectra (see `nplab.datafile.AppendBuffer`).  A run can be indefinite, finishing
+when `TimeSeries.stop` is called, and per-pixel statistics are kept up to date as each spectrum arrives.
+"""
+import threading
+import time
+
+import numpy as np
+
+
+class TimeSeriesStatistics(object):
+    """The per-pixel mean, minimum and maximum of a series of spectra, updated as each one arrives.
+
+    This lets a display follow a long run without reading the spectra back from the file.  Use `snapshot` to get a
+    consistent set of values from another thread.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all the spectra."""
+        with self._lock:
+            self.count = 0
+            self.mean = None
+            self.minimum = None
+            self.maximum = None
+            self.latest = None
+
+    def update(self, spectrum):
+        """Add a spectrum to the statistics, in O(pixels) time."""
+        spectrum = np.array(spectrum, dtype=np.float64)
+        with self._lock:
+            if self.count == 0:
+                self.mean = spectrum.copy()
+                self.minimum = spectrum.copy()
+                self.maximum = spectrum.copy()
+            else:
+                self.mean += (spectrum - self.mean) / (self.count + 1)
+                np.minimum(self.minimum, spectrum, out=self.minimum)
+                np.maximum(self.maximum, spectrum, out=self.maximum)
+            self.count += 1
+            self.latest = spectrum
+
+    def snapshot(self):
+        """Return a dictionary of copies of the statistics (count, mean, minimum, maximum and latest)."""
+        with self._lock:
+            return {name: getattr(self, name) if name == 'count' or getattr(self, name) is None
+                    else getattr(self, name).copy()
+                    for name in ('count', 'mean', 'minimum', 'maximum', 'latest')}
+
+
+class TimeSeries(object):
+    """Take a series of spectra at a fixed rate, saving them as they are taken (see module documentation).
+
+    Call `run` to take the spectra (which blocks until the series is finished), and `stop` from another thread to
+    finish early.  While it's running, `statistics` is a `TimeSeriesStatistics` of the spectra so far.
+    """
+    start_times_attribute_limit = 4096  # write a "start times" attribute (as older files have) for series this long
+
+    def __init__(self, spectrometer, num_spectra=0, interval=0, name='time_series_%d', group=None, attrs=None,
+                 buffer_rows=64, flush_interval=1.0, stop_event=None):
+        """Set up the time series.
+
+        :param spectrometer: the `Spectrometer` to read from
+        :param num_spectra: the number of spectra to take, or 0 to keep going until `stop` is called
+        :param interval: the time (in ms) between the starts of successive spectra, or 0 to go as fast as possible
+        :param name: the name of the dataset (made unique if it contains %d)
+        :param group: the group to save in (default: the spectrometer's data folder)
+        :param attrs: extra metadata to save with the spectra
+        :param buffer_rows: the number of spectra to write to the file at a time
+        :param flush_interval: also write buffered spectra after this many seconds
+        :param stop_event: a `threading.Event` that stops the series when set (by default, a new one is made)
+        """
+        self.spectrometer = spectrometer
+        self.num_spectra = num_spectra
+        self.interval = interval
+        self.name = name
+        self.group = group
+        self.attrs = attrs
+        self.buffer_rows = buffer_rows
+        self.flush_interval = flush_interval
+        self.stop_event = threading.Event() if stop_event is None else stop_event
+        self.statistics = TimeSeriesStatistics()
+        self.missed_deadlines = 0
+
+    def stop(self):
+        """Finish the time series after the current spectrum."""
+        self.stop_event.set()
+
+    def run(self, update_progress=lambda p: p):
+        """Take the spectra, returning the dataset they were saved in (or None if none were taken).
+
+        update_progress is called with the number of spectra taken so far after each one.  The time stamps (in
+        seconds from the start of the series) are saved in a dataset named in the "times" attribute of the spectra.
+        """
+        group = self.spectrometer.get_root_data_folder() if self.group is None else self.group
+        name = group.find_unique_name(self.name)
+        metadata = self.spectrometer.metadata  # metadata is only read once, at the start of the run
+        metadata.update({'number of spectra': self.num_spectra,
+                         'spectrum start-to-start interval': self.interval / 1000.,
+                         'times': name + '_times'})
+        if self.attrs is not None:
+            metadata.update(self.attrs)
+        spectra = group.append_buffer(name, attrs=metadata, buffer_rows=self.buffer_rows,
+                                      flush_interval=self.flush_interval)
+        times = group.append_buffer(name + '_times', dtype=np.float64, buffer_rows=self.buffer_rows,
+                                    flush_interval=self.flush_interval,
+                                    attrs={'units': 's', 'start time': time.time(), 'spectra': name})
+        interval = self.interval / 1000.
+        self.statistics.reset()
+        self.missed_deadlines = 0
+        update_progress(0)
+        start = time.monotonic()
+        taken, slot = 0, 0
+        try:
+            while (self.num_spectra <= 0 or taken < self.num_spectra) and not self.stop_event.is_set():
+                if interval > 0:
+                    wait = start + slot * interval - time.monotonic()
+                    if wait > 0 and self.stop_event.wait(wait):
+                        break
+                started = time.monotonic() - start
+                spectrum = self.spectrometer.read_spectrum()
+                spectra.append(spectrum)
+                times.append(started)
+                self.statistics.update(spectrum)
+                taken += 1
+                update_progress(taken)
+                if interval > 0:
+                    # if we've overrun into the next slot, start straight away; only skip the slots that passed
+                    # entirely while we were reading, rather than trying to catch up on them
+                    next_slot = max(slot + 1, int(np.floor((time.monotonic() - start) / interval)))
+                    self.missed_deadlines += next_slot - slot - 1
+                    slot = next_slot
+        finally:
+            spectra.close()
+            times.close()
+        dataset = spectra.dataset
+        if dataset is None:
+            return None
+        dataset.attrs['number of spectra'] = taken
+        dataset.attrs['missed deadlines'] = self.missed_deadlines
+        if taken <= self.start_times_attribute_limit:
+            dataset.attrs['start times'] = times.dataset[()]
+        return dataset
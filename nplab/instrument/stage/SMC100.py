@@ -368,6 +368,12 @@ class SMC100(SerialInstrument, Stage):
             # is included.
             self._wait_states((STATE_READY_FROM_MOVING, STATE_READY_FROM_HOMING))
 
+    def move_many(self, positions, relative=False, waitStop=True):
+        """Move several axes, only sending commands to the axes that move (see Stage.move_many)."""
+        axes = list(positions.keys())
+        self._move_to_targets(positions, relative, self.move, [positions[ax] for ax in axes],
+                              axis=axes, relative=relative, waitStop=waitStop)
+
     def move_referenced(self, position_mm, **kwargs):
         """
         Moves to an absolute position referenced from the software home
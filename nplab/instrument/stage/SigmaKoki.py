@@ -340,6 +340,15 @@ class SHOT(VisaInstrument, Stage):
         self._write_check(command, wait=wait)
         self._go(wait=wait)
 
+    def move_many(self, positions, relative=False, wait=True):
+        """Move one or both axes with a single command (see Stage.move_many)."""
+        if len(positions) == len(self.axis_names):
+            counts, axis = tuple(positions[ax] for ax in self.axis_names), self.axis_names
+        else:
+            (axis, counts), = positions.items()
+            axis = int(axis)  # move() takes the axis number, or 'W' for both
+        self._move_to_targets(positions, relative, self.move, counts, axis=axis, relative=relative, wait=wait)
+
     def get_position(self, axis=None):
         status = self.status()
         counts = list(map(int, status.split(',')[:2]))
@@ -529,6 +538,12 @@ class HIT(SerialInstrument, Stage):
 
         # TODO: add checking for Stage limits using status +-LS
 
+    def move_many(self, positions, relative=False, wait=True):
+        """Move several axes with a single command (see Stage.move_many)."""
+        axes = list(positions.keys())
+        self._move_to_targets(positions, relative, self.move, [positions[ax] for ax in axes],
+                              axes=axes, relative=relative, wait=wait)
+
     def get_position(self, axes=None):
         axes = self._axes_iterable(axes)
         all_positions = self.query("Q:").split(",")
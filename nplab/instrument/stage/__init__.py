@@ -15,9 +15,10 @@ from nplab.ui.ui_tools import UiTools
 import nplab.ui
 from nplab.ui.widgets.position_widgets import XYZPositionWidget
 import inspect
+import functools
 from functools import partial
 from nplab.utils.formatting import engineering_format
-import collections
+import collections.abc
 
 
 class Stage(Instrument):
@@ -37,12 +38,62 @@ class Stage(Instrument):
     
     In the future, a class factory method might be available, that will 
     simplify the emulation of various features.
+
+    Position Cache
+    --------------
+    Moves made with `move_many` (or `move_axis`, which uses it) remember the
+    target of each axis, so that later moves don't need to ask the hardware
+    where the axes that aren't moving are (see `cached_position`).  Calling
+    `move` directly (or an overridden `move_axis`) forgets the cached
+    positions, as we can't tell what it did, and so do the methods named in
+    `position_changing_methods` (homing, referencing, jogging etc.) that
+    move the stage without going through `move`.  Cached positions are only
+    trusted for `position_cache_max_age` seconds, so moves the stage can't
+    know about (e.g. with a joystick) are picked up.  Stages that can move several axes with one command should override
+    `move_many` (calling `_move_to_targets`); the default calls `move` once
+    with a full position.
+
+    `wait_until_stopped` polls `is_moving`, unless the subclass sets
+    `stop_notification = True` and calls `notify_stopped` when the hardware
+    reports that a move has finished (e.g. from a callback or a thread reading
+    the controller's messages), in which case it waits for that.
+
+    Trajectories
+    ------------
+    A list of points can be loaded with `load_trajectory` and run in the
+    background with `start_trajectory`.  As each point is reached, it is added
+    (with a time stamp) to the readback, which can be followed with
+    `iter_trajectory_readback` (e.g. to trigger acquisition in a fly scan) or
+    read afterwards with `get_trajectory_readback`.  By default, trajectories
+    are emulated with one `move_many` per point; stages whose controllers can
+    buffer a trajectory should override `_run_trajectory`.
     """
     axis_names = ('x', 'y', 'z')
+    stop_notification = False  # set to True if the subclass calls notify_stopped when moves finish
+    confirm_position_on_settle = False  # if True, wait_until_stopped reads the position once the stage stops
+    poll_interval = 0.01  # seconds between calls to is_moving in wait_until_stopped
+    trajectory_readback = False  # if True, emulated trajectories read the position at each point
+    position_cache_max_age = 1.0  # seconds before a cached position is read from the hardware again (None: never)
+    # methods of subclasses that may move the stage (or redefine its position) without calling move
+    position_changing_methods = ('home', 'home_all', 'find_references', 'find_references_ch', 'reset',
+                                 'reset_and_configure', 'initialise', 'calibrate', 'calibrate_system', 'zero',
+                                 'zero_all_axes', 'set_zero', 'set_origin', 'set_position', 'jog', 'jog_forward',
+                                 'jog_backward', 'stop', 'stop_motion', 'stop_stage', 'stop_all_stages')
+
     def __init__(self, unit='m'):
         Instrument.__init__(self)
         self.unit = unit
 
+    def __init_subclass__(cls, **kwargs):
+        """Make sure moves that bypass move_many invalidate the position cache."""
+        super(Stage, cls).__init_subclass__(**kwargs)
+        for name in ('move', 'move_axis'):
+            if name in cls.__dict__:
+                setattr(cls, name, _invalidating_move(cls.__dict__[name]))
+        for name in cls.position_changing_methods:
+            if inspect.isfunction(cls.__dict__.get(name)):
+                setattr(cls, name, _invalidating_method(cls.__dict__[name]))
+
     def move(self, pos, axis=None, relative=False):
         raise NotImplementedError("You must override move() in a Stage subclass")
 
@@ -55,15 +106,98 @@ class Stage(Instrument):
         
         This function moves only in one axis, by calling self.move with 
         appropriately generated values (i.e. it supplies all axes with position
-        instructions, but those not moving just get the current position).
+        instructions, but those not moving just get the current position, from
+        the position cache if possible - see move_many).
         
         It's intended for use in stages that don't support single-axis moves."""
-        if axis not in self.axis_names:
-            raise ValueError("{0} is not a valid axis, must be one of {1}".format(axis, self.axis_names))
+        self.move_many({axis: pos}, relative=relative, **kwargs)
 
-        full_position = np.zeros((len(self.axis_names))) if relative else self.position
-        full_position[self.axis_names.index(axis)] = pos
-        self.move(full_position, relative=relative, **kwargs)
+    def move_many(self, positions, relative=False, **kwargs):
+        """Move several axes at once.
+
+        :param positions: a dictionary of {axis name: position}
+        :param relative: if True, the positions are displacements from where
+            the axes are now
+
+        The default implementation makes one call to `move` with a position for
+        every axis, using the position cache for the axes that aren't moving
+        (so usually no query is needed).  Stages that can move some of their
+        axes in a single command should override this, and send the command
+        with `_move_to_targets` so the cache is kept up to date.  Further
+        arguments are passed to `move`.
+        """
+        for axis in positions:
+            if axis not in self.axis_names:
+                raise ValueError("{0} is not a valid axis, must be one of {1}".format(axis, self.axis_names))
+        if relative:
+            full_position = np.zeros(len(self.axis_names))
+        else:
+            full_position = np.array(self.cached_position(), dtype=float)
+        for axis, pos in positions.items():
+            full_position[self.axis_names.index(axis)] = pos
+        self._move_to_targets(positions, relative, self.move, full_position, relative=relative, **kwargs)
+
+    def _position_cache(self):
+        """The dictionary of {axis name: last known position} (subclasses may not call Stage.__init__)."""
+        try:
+            return self._cached_positions
+        except AttributeError:
+            self._cached_positions = _PositionCache()
+            self._moving_to_targets = False
+            self._stopped_event = threading.Event()
+            return self._cached_positions
+
+    def _move_to_targets(self, positions, relative, move_function, /, *args, **kwargs):
+        """Call move_function(*args, **kwargs) to move to positions, and update the cache to match.
+
+        This is for use in implementations of `move_many`.
+        """
+        cache = self._position_cache()
+        self._stopped_event.clear()
+        moving_to_targets, self._moving_to_targets = self._moving_to_targets, True
+        try:
+            move_function(*args, **kwargs)
+        except:
+            self.invalidate_position_cache()
+            raise
+        finally:
+            self._moving_to_targets = moving_to_targets
+        for axis, pos in positions.items():
+            if not relative:
+                cache[axis] = pos
+            elif cache.is_fresh(axis, self.position_cache_max_age):
+                cache[axis] += pos
+            else:
+                cache.pop(axis, None)
+
+    def cached_position(self, axis=None):
+        """Return the position of the stage, using the positions we last moved to where possible.
+
+        This is like `get_position`, but the hardware is only queried (once,
+        for all the axes) if some of the axes we need have not been moved with
+        `move_many` since the cache was last invalidated, or were last moved
+        more than `position_cache_max_age` seconds ago.
+        """
+        cache = self._position_cache()
+        axes = self.axis_names if axis is None else axis
+        if isinstance(axes, str) or not isinstance(axes, collections.abc.Sequence):
+            axes = (axes,)
+        if not all(cache.is_fresh(ax, self.position_cache_max_age) for ax in axes):
+            cache.update((ax, pos) for ax, pos in zip(self.axis_names, self.get_position()))
+        if axis is None:
+            return np.array([cache[ax] for ax in self.axis_names])
+        elif len(axes) == 1 and axes[0] == axis:
+            return cache[axis]
+        return tuple(cache[ax] for ax in axes)
+
+    def invalidate_position_cache(self, axes=None):
+        """Forget the cached position of some axes (all axes if axes is None)."""
+        cache = self._position_cache()
+        if axes is None:
+            cache.clear()
+        else:
+            for axis in axes:
+                cache.pop(axis, None)
 
     def get_position(self, axis=None):
         raise NotImplementedError("You must override get_position in a Stage subclass.")
@@ -84,10 +218,228 @@ class Stage(Instrument):
         """Returns True if any of the specified axes are in motion."""
         raise NotImplementedError("The is_moving method must be subclassed and implemented before it's any use!")
 
-    def wait_until_stopped(self, axes=None):
-        """Block until the stage is no longer moving."""
-        while self.is_moving(axes=axes):
-            time.sleep(0.01)
+    def wait_until_stopped(self, axes=None, timeout=None):
+        """Block until the stage is no longer moving.
+
+        If the stage supports stop notification (see `notify_stopped`) we wait
+        for that, otherwise we poll `is_moving` every `poll_interval` seconds.
+        An IOError is raised if the stage is still moving after `timeout`
+        seconds (if specified).  If `confirm_position_on_settle` is set, the
+        position cache is updated from the hardware once the stage has stopped.
+        """
+        self._position_cache()
+        if self.stop_notification:
+            if not self._stopped_event.wait(timeout):
+                raise IOError("Timed out waiting for the stage to stop")
+        else:
+            start = time.time()
+            while self.is_moving(axes=axes):
+                if timeout is not None and time.time() - start > timeout:
+                    raise IOError("Timed out waiting for the stage to stop")
+                time.sleep(self.poll_interval)
+        if self.confirm_position_on_settle:
+            self._cached_positions.update(zip(self.axis_names, self.get_position()))
+
+    def notify_stopped(self, positions=None):
+        """Tell the stage a move has finished (for stages with `stop_notification`).
+
+        :param positions: optionally, a dictionary of {axis: position}
+            reported by the hardware, which will update the position cache.
+        """
+        self._position_cache()
+        if positions is not None:
+            self._cached_positions.update(positions)
+        self._stopped_event.set()
+
+    def load_trajectory(self, points, dwell=0, axes=None):
+        """Load a list of points for the stage to visit with `start_trajectory`.
+
+        :param points: an array of absolute positions, with one row per point
+            and one column per axis
+        :param dwell: the time (in seconds) to stay at each point, either a
+            single value or one value per point
+        :param axes: the axes the columns of points refer to (default: all)
+        """
+        if self.trajectory_running:
+            raise IOError("Can't load a trajectory while one is running")
+        axes = tuple(self.axis_names if axes is None else axes)
+        for axis in axes:
+            if axis not in self.axis_names:
+                raise ValueError("{0} is not a valid axis, must be one of {1}".format(axis, self.axis_names))
+        points = np.asarray(points, dtype=float)
+        if points.ndim == 1 and len(axes) == 1:
+            points = points[:, np.newaxis]
+        if points.ndim != 2 or points.shape[1] != len(axes):
+            raise ValueError("points must have one column per axis, i.e. shape (N, {0})".format(len(axes)))
+        dwell = np.broadcast_to(np.asarray(dwell, dtype=float), (points.shape[0],))
+        self._trajectory = (axes, points, dwell)
+
+    def start_trajectory(self):
+        """Start moving through the loaded trajectory, and return immediately.
+
+        The trajectory runs in a background thread; use
+        `iter_trajectory_readback` to follow it, `wait_for_trajectory` to wait
+        for it to finish, or `stop_trajectory` to stop it early.
+        """
+        if getattr(self, '_trajectory', None) is None:
+            raise ValueError("No trajectory has been loaded, see load_trajectory")
+        if self.trajectory_running:
+            raise IOError("A trajectory is already running")
+        self._trajectory_readback = []
+        self._trajectory_departures = {}
+        self._trajectory_error = None
+        self._trajectory_finished = False
+        self._trajectory_stop = threading.Event()
+        self._trajectory_condition = threading.Condition()
+        self._trajectory_thread = threading.Thread(target=self._trajectory_thread_function, args=self._trajectory)
+        self._trajectory_thread.daemon = True
+        self._trajectory_thread.start()
+
+    def _trajectory_thread_function(self, axes, points, dwell):
+        """Run the trajectory, making sure anyone following it is told when it stops."""
+        try:
+            self._run_trajectory(axes, points, dwell)
+        except Exception as e:
+            self._trajectory_error = e
+        finally:
+            with self._trajectory_condition:
+                self._trajectory_finished = True
+                self._trajectory_condition.notify_all()
+
+    def _run_trajectory(self, axes, points, dwell):
+        """Move through a trajectory, calling `_record_trajectory_point` as each point is reached.
+
+        `_record_trajectory_departure` should be called as the stage leaves
+        each point, if that's known (otherwise the time the next point is
+        reached is used instead).  This runs in a background thread, and should return early if
+        `trajectory_stop_requested` is set.  The default emulates the
+        trajectory with one `move_many` per point, reporting the target (or the
+        position read from the stage, if `trajectory_readback` is True).
+        Stages that can buffer a trajectory should override this to send the
+        points to the controller, start it, and report its progress.
+        """
+        indices = [self.axis_names.index(axis) for axis in axes]
+        for index, point in enumerate(points):
+            if self.trajectory_stop_requested:
+                break
+            if index > 0:
+                self._record_trajectory_departure(index - 1)
+            self.move_many(dict(zip(axes, point)))
+            if self.trajectory_readback:
+                position = np.array(self.get_position(), dtype=float)
+                self._cached_positions.update(zip(self.axis_names, position))
+                point = position[indices]
+            self._record_trajectory_point(index, point)
+            if dwell[index] > 0:
+                self._trajectory_stop.wait(dwell[index])
+
+    def _record_trajectory_point(self, index, position, timestamp=None):
+        """Add a point to the trajectory readback (the time defaults to now)."""
+        with self._trajectory_condition:
+            self._trajectory_readback.append((index, time.time() if timestamp is None else timestamp,
+                                              np.array(position, dtype=float)))
+            self._trajectory_condition.notify_all()
+
+    def _record_trajectory_departure(self, index, timestamp=None):
+        """Note that the stage has left a point of the trajectory (the time defaults to now)."""
+        with self._trajectory_condition:
+            self._trajectory_departures[index] = time.time() if timestamp is None else timestamp
+
+    def trajectory_departure_time(self, index):
+        """The time the stage left a point of the current trajectory, or None if it's still there.
+
+        Anything that must happen while the stage is at a point (e.g. an
+        acquisition during a fly scan) should have finished before this.
+        """
+        departures = getattr(self, '_trajectory_departures', {})
+        if index in departures:
+            return departures[index]
+        for n, reached, position in list(getattr(self, '_trajectory_readback', [])):
+            if n > index:
+                return reached  # the stage didn't say when it left, but it's reached a later point
+        return None
+
+    @property
+    def trajectory_running(self):
+        """Whether a trajectory is running in the background."""
+        thread = getattr(self, '_trajectory_thread', None)
+        return thread is not None and thread.is_alive()
+
+    @property
+    def trajectory_points_reached(self):
+        """The number of points of the current (or last) trajectory that have been reached so far."""
+        return len(getattr(self, '_trajectory_readback', []))
+
+    @property
+    def trajectory_stop_requested(self):
+        """Whether `stop_trajectory` has been called on the running trajectory."""
+        stop = getattr(self, '_trajectory_stop', None)
+        return stop is not None and stop.is_set()
+
+    def stop_trajectory(self, timeout=None):
+        """Stop the trajectory after the current point, and wait for it to stop."""
+        if getattr(self, '_trajectory_stop', None) is not None:
+            self._trajectory_stop.set()
+            self.wait_for_trajectory(timeout)
+
+    def wait_for_trajectory(self, timeout=None):
+        """Block until the trajectory has finished.
+
+        An IOError is raised if it's still running after `timeout` seconds (if
+        specified), and any error raised while running it is raised here.
+        """
+        thread = getattr(self, '_trajectory_thread', None)
+        if thread is None:
+            return
+        thread.join(timeout)
+        if thread.is_alive():
+            raise IOError("Timed out waiting for the trajectory to finish")
+        if self._trajectory_error is not None:
+            raise self._trajectory_error
+
+    def iter_trajectory_readback(self, timeout=None):
+        """Yield (index, time, position) for each point of the trajectory as it's reached.
+
+        The generator finishes when the trajectory does, and raises an IOError
+        if no point is reached within `timeout` seconds (if specified).  This
+        is the way to trigger acquisition at each point of a fly scan.
+        """
+        if getattr(self, '_trajectory_thread', None) is None:
+            raise ValueError("No trajectory has been started")
+        n = 0
+        while True:
+            with self._trajectory_condition:
+                if not self._trajectory_condition.wait_for(
+                        lambda: len(self._trajectory_readback) > n or self._trajectory_finished, timeout):
+                    raise IOError("Timed out waiting for the next point of the trajectory")
+                new_points = self._trajectory_readback[n:]
+                finished = self._trajectory_finished
+            for point in new_points:
+                yield point
+            n += len(new_points)
+            if finished and n == len(self._trajectory_readback):
+                break
+        if self._trajectory_error is not None:
+            raise self._trajectory_error
+
+    def get_trajectory_readback(self):
+        """Return the indices, times and positions of the trajectory points reached so far, as arrays."""
+        readback = list(getattr(self, '_trajectory_readback', []))
+        if len(readback) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, len(self._trajectory[0])))
+        indices, times, positions = zip(*readback)
+        return np.array(indices), np.array(times), np.array(positions)
+
+    def trajectory_position_at(self, times):
+        """Interpolate the trajectory readback to find where the stage was at the given time(s).
+
+        This lets data acquired at any time during a fly scan be placed on
+        the sample.  Returns an array with one column per trajectory axis.
+        """
+        indices, readback_times, positions = self.get_trajectory_readback()
+        times = np.asarray(times, dtype=float)
+        return np.stack([np.interp(times, readback_times, positions[:, i])
+                         for i in range(positions.shape[1])], axis=-1)
 
     def get_qt_ui(self):
         if self.unit == 'm':
@@ -104,19 +456,19 @@ class Stage(Instrument):
     def get_axis_param(self, get_func, axis=None):
         if axis is None:
             return tuple(get_func(axis) for axis in self.axis_names)
-        elif isinstance(axis, collections.Sequence) and not isinstance(axis, str):
+        elif isinstance(axis, collections.abc.Sequence) and not isinstance(axis, str):
             return tuple(get_func(ax) for ax in axis)
         else:
             return get_func(axis)
 
     def set_axis_param(self, set_func, value, axis=None):
         if axis is None:
-            if isinstance(value, collections.Sequence):
+            if isinstance(value, (collections.abc.Sequence, np.ndarray)):
                 tuple(set_func(v, axis) for v,axis in zip(value, self.axis_names))
             else:
                 tuple(set_func(value, axis) for axis in self.axis_names)
-        elif isinstance(axis, collections.Sequence) and not isinstance(axis, str):
-            if isinstance(value, collections.Sequence):
+        elif isinstance(axis, collections.abc.Sequence) and not isinstance(axis, str):
+            if isinstance(value, (collections.abc.Sequence, np.ndarray)):
                 tuple(set_func(v, ax) for v,ax in zip(value, axis))
             else:
                 tuple(set_func(value, ax) for ax in axis)
@@ -126,6 +478,65 @@ class Stage(Instrument):
     # TODO: stored dictionary of 'bookmarked' locations for fast travel
 
 
+class _PositionCache(dict):
+    """A dictionary of {axis name: position}, which remembers when each position was set."""
+    def __init__(self):
+        super(_PositionCache, self).__init__()
+        self.times = dict()
+
+    def __setitem__(self, axis, position):
+        super(_PositionCache, self).__setitem__(axis, position)
+        self.times[axis] = time.monotonic()
+
+    def update(self, *args, **kwargs):
+        for axis, position in dict(*args, **kwargs).items():
+            self[axis] = position
+
+    def pop(self, axis, *default):
+        self.times.pop(axis, None)
+        return super(_PositionCache, self).pop(axis, *default)
+
+    def clear(self):
+        super(_PositionCache, self).clear()
+        self.times.clear()
+
+    def is_fresh(self, axis, max_age):
+        """Whether the position of axis is cached, and was set less than max_age seconds ago (if not None)."""
+        return axis in self and (max_age is None or time.monotonic() - self.times[axis] <= max_age)
+
+
+def _invalidating_method(method):
+    """Wrap a Stage subclass's method that may move the stage, so it invalidates the position cache."""
+    if getattr(method, '_invalidates_position_cache', False):
+        return method
+
+    @functools.wraps(method)
+    def wrapped_method(self, *args, **kwargs):
+        self.invalidate_position_cache()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.invalidate_position_cache()  # e.g. the stage may have finished homing while we waited
+    wrapped_method._invalidates_position_cache = True
+    return wrapped_method
+
+
+def _invalidating_move(move):
+    """Wrap a Stage subclass's move method, so calling it directly invalidates the position cache."""
+    if getattr(move, '_invalidates_position_cache', False):
+        return move
+
+    @functools.wraps(move)
+    def wrapped_move(self, *args, **kwargs):
+        self._position_cache()
+        if not self._moving_to_targets:  # we can't tell which axes have moved, or where to
+            self.invalidate_position_cache()
+            self._stopped_event.clear()
+        return move(self, *args, **kwargs)
+    wrapped_move._invalidates_position_cache = True
+    return wrapped_move
+
+
 class PiezoStage(Stage):
 
     def __init__(self):
@@ -37,6 +37,18 @@ class PIStage(VisaInstrument, Stage):
             self.write('mov {0}{1}'.format(axis, 1e6*pos))
         self.wait_until_stopped(axis)
 
+    def move_many(self, positions, relative=False):
+        """Move several axes with a single command, then wait for them to stop (see Stage.move_many)."""
+        for axis in positions:
+            if axis not in self.axis_names:
+                raise ValueError("{0} is not a valid axis, must be one of {1}".format(axis, self.axis_names))
+
+        def send_move():
+            targets = ' '.join('{0}{1}'.format(axis, 1e6*pos) for axis, pos in positions.items())
+            self.write('{0} {1}'.format('mvr' if relative else 'mov', targets))
+            self.wait_until_stopped(list(positions))
+        self._move_to_targets(positions, relative, send_move)
+
     def get_position(self, axis=None):
         return self.get_axis_param(lambda axis: 1e-6*float(self.query('pos? {0}'.format(axis))), axis)
     position = property(fget=get_position, doc="Current position of the stage")
@@ -463,7 +463,7 @@ class SmaractMCS(PiezoStage):
     def multi_move(self, positions, axes, relative=False): #?? doesn't this method include the simple move() method??
         self.check_open_status()
 
-        positions = [c_int(1e9 * p) for p in positions]
+        positions = [c_int(int(1e9 * p)) for p in positions]
         channels = [c_int(int(axis)) for axis in axes]
 
         for i in range(len(axes)):
@@ -471,13 +471,22 @@ class SmaractMCS(PiezoStage):
                 self.check_status(mcsc.SA_GotoPositionRelative_S(self.handle, channels[i], positions[i], c_int(0)))
             else:
                 self.check_status(mcsc.SA_GotoPositionAbsolute_S(self.handle, channels[i], positions[i], c_int(0)))
-        for axis in axes:
-            self.wait_until_stopped(axis)
+        for ch in channels:
+            self.wait_until_stopped(ch)
 
     def multi_move_rel(self, step, axes):
-        steps = [1e9 * step for axis in axes]
+        steps = [step for axis in axes]
         self.multi_move(steps, axes, relative=True)
 
+    def move_many(self, positions, relative=False):
+        """Start all the axes moving at once, then wait for them to stop (see Stage.move_many)."""
+        for axis in positions:
+            if axis not in self.axis_names:
+                raise ValueError("{0} is not a valid axis, must be one of {1}".format(axis, self.axis_names))
+        axes = list(positions.keys())
+        self._move_to_targets(positions, relative, self.multi_move, [positions[axis] for axis in axes], axes,
+                              relative=relative)
+
 
     ### ==================================== ###
     ### Method to control slip-stick motion ###
@@ -18,6 +18,9 @@ import nplab.datafile as df
 import operator
 import h5py
 import os
+import hashlib
+import threading
+import uuid
 
 
 """
@@ -52,20 +55,81 @@ renderers = set()
 def add_renderer(renderer_class):
     """Add a renderer to the list of available renderers"""
     renderers.add(renderer_class)
+    _suitability_cache.clear()
     
 group_renders = set()
 
 def add_group_renderer(renderer_class):
     """Add a renderer to the list of available renderers"""
     group_renders.add(renderer_class)
-    
+    _suitability_cache.clear()
+
+
+_suitability_cache = {}  # see suitability_cache_key
+SUITABILITY_CACHE_SIZE = 10000
+
+
+def _attrs_digest(attrs):
+    """Return a hash of an attributes dictionary, so we notice if the metadata change"""
+    digest = hashlib.sha1()
+    for key in sorted(attrs.keys()):
+        value = attrs[key]
+        digest.update(key.encode())
+        if isinstance(value, np.ndarray):
+            digest.update(str((value.shape, value.dtype)).encode())
+            digest.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else repr(value).encode())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+
+def suitability_cache_key(h5object):
+    """The key used to cache the result of suitable_renderers for an object.
+
+    Datasets are identified by (file, path, shape, dtype, attrs hash), so that the cache is invalidated if the data
+    are resized or their metadata change; groups use their number of members rather than shape and dtype.
+    Selections of several objects use a tuple of the keys of their members.  Returns None if the object can't
+    be identified (in which case it isn't cached).
+    """
+    try:
+        if isinstance(h5object, h5py.Dataset):
+            return (h5object.file.filename, h5object.name, h5object.shape, h5object.dtype.str,
+                    _attrs_digest(h5object.attrs))
+        elif isinstance(h5object, h5py.Group):
+            return (h5object.file.filename, h5object.name, len(h5object), None, _attrs_digest(h5object.attrs))
+        elif isinstance(h5object, dict):
+            keys = tuple(suitability_cache_key(v) for v in h5object.values())
+            return None if None in keys else keys
+    except Exception:
+        pass
+    return None
+
+
 def suitable_renderers(h5object, return_scores=False):
     """Find renderers that can render a given object, in order of suitability.
     If the selected group contains more than 100 elements, consider only the
     group_renderers and not the rest, which are very time consuming.
+
+    The scores are cached (see suitability_cache_key), as some renderers read the data to decide.
     """
+    cache_key = suitability_cache_key(h5object)
+    renderers_and_scores = _suitability_cache.get(cache_key) if cache_key is not None else None
+    if renderers_and_scores is None:
+        renderers_and_scores = _score_renderers(h5object)
+        if cache_key is not None:
+            if len(_suitability_cache) >= SUITABILITY_CACHE_SIZE:
+                _suitability_cache.clear()
+            _suitability_cache[cache_key] = renderers_and_scores
+    if return_scores:
+        return [(score, r) for score, r in renderers_and_scores if score >= 0]
+    else:
+        return [r for score, r in renderers_and_scores if score >= 0]
+
+
+def _score_renderers(h5object):
+    """Ask each renderer how suitable it is for an object, returning (score, renderer) best first"""
     renderers_and_scores = []
-    if isinstance(h5object, h5py.Group) and len(list(h5object.values()))>100:
+    if isinstance(h5object, h5py.Group) and len(h5object) > 100:
         for r in group_renders:
             try:
                 renderers_and_scores.append((r.is_suitable(h5object), r))
@@ -82,10 +146,132 @@ def suitable_renderers(h5object, return_scores=False):
                 pass # renderers that cause exceptions shouldn't be used!
         
     renderers_and_scores.sort(key=lambda score_r: score_r[0], reverse=True)
-    if return_scores:
-        return [(score, r) for score, r in renderers_and_scores if score >= 0]
+    return renderers_and_scores
+
+
+class PreloadedDataset(h5py.Dataset):
+    """A copy of an HDF5 dataset, held in an in-memory HDF5 file so it can be rendered without touching the disk.
+
+    It has the same name and attributes as the original, and its `file` and `parent` are those of the original,
+    so renderers can use it exactly as they would the original dataset.
+    """
+    def __init__(self, memory_dataset, source):
+        super(PreloadedDataset, self).__init__(memory_dataset.id)
+        self.source = source
+        self.memory_file = memory_dataset.file  # keep the in-memory file open as long as we need it
+        self.is_preview = False
+
+    @property
+    def file(self):
+        return self.source.file
+
+    @property
+    def parent(self):
+        return self.source.parent
+
+
+def preload_dataset(dataset, step=1, block_bytes=2**23):
+    """Read a dataset into memory, returning a PreloadedDataset
+
+    The data are read in blocks along the first axis, so that other threads get a chance to use the (locked) HDF5
+    library while a big dataset is loading.
+
+    :param dataset: the h5py.Dataset to copy
+    :param step: if > 1, take only every step-th element along every axis but the last, to make a preview.  The
+        last axis is usually the one described by the attributes (e.g. wavelengths), so it is always kept whole.
+    :param block_bytes: the approximate size of each read
+    """
+    step = max(int(step), 1)
+    shape = dataset.shape
+    if len(shape) > 1:
+        index = tuple(slice(None, None, step) for _ in shape[:-1]) + (slice(None),)
+        out_shape = tuple((n + step - 1) // step for n in shape[:-1]) + shape[-1:]
     else:
-        return [r for score, r in renderers_and_scores if score >= 0]
+        index = ()
+        out_shape = shape
+    memory_file = h5py.File("preloaded_{}.h5".format(uuid.uuid4().hex), "w", driver="core", backing_store=False)
+    copy = memory_file.create_dataset(dataset.name, shape=out_shape, dtype=dataset.dtype)
+    for key, value in dataset.attrs.items():
+        try:
+            copy.attrs[key] = value
+        except Exception:
+            pass  # attributes that can't be copied won't be shown
+    if len(shape) == 0:
+        copy[()] = dataset[()]
+    elif len(shape) == 1:
+        copy[...] = dataset[...]
+    else:
+        row_bytes = max(int(np.prod(out_shape[1:])) * dataset.dtype.itemsize, 1)
+        rows_per_block = max(block_bytes // row_bytes, 1)
+        for i in range(0, out_shape[0], rows_per_block):
+            j = min(i + rows_per_block, out_shape[0])
+            copy[i:j] = dataset[(slice(i * step, j * step, step),) + index[1:]]
+    preloaded = PreloadedDataset(copy, dataset)
+    preloaded.is_preview = step > 1
+    return preloaded
+
+
+class BackgroundLoader(QtCore.QObject):
+    """Choose renderers for, and read, the data to be displayed, in a background thread.
+
+    Call `request` with the object to show: `loaded` is then emitted (in the GUI thread) with the request id, the
+    list of suitable renderers, and the object to render.  Datasets are preloaded into memory (see preload_dataset)
+    so that rendering them doesn't block the GUI with disk reads.  Datasets with more than `preview_size` elements
+    are first emitted as a decimated preview, then at full resolution.  If requests arrive faster than they can be
+    loaded (e.g. scrolling through a file with the arrow keys), only the most recent is loaded.
+    """
+    loaded = QtCore.Signal(int, object, object)  # request id, renderers, data to render
+    preview_size = 2**22
+    max_preload_size = 2**28
+
+    def __init__(self, parent=None):
+        super(BackgroundLoader, self).__init__(parent)
+        self._condition = threading.Condition()
+        self._pending = None
+        self._request_id = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request(self, h5object):
+        """Load an object in the background, replacing any request that hasn't started yet.  Returns a request id."""
+        with self._condition:
+            self._request_id += 1
+            self._pending = (self._request_id, h5object)
+            self._condition.notify()
+            return self._request_id
+
+    def is_current(self, request_id):
+        """Whether a request is the most recent one (otherwise its results should be ignored)"""
+        return request_id == self._request_id
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                request_id, h5object = self._pending
+                self._pending = None
+            renderers = suitable_renderers(h5object)
+            try:
+                self._load(request_id, h5object, renderers)
+            except Exception as e:
+                print("Failed to load {} for rendering: {}".format(h5object, e))
+                if self.is_current(request_id):
+                    self.loaded.emit(request_id, renderers, h5object)
+
+    def _load(self, request_id, h5object, renderers):
+        if not isinstance(h5object, h5py.Dataset) or h5object.size > self.max_preload_size:
+            self.loaded.emit(request_id, renderers, h5object)  # render it in the GUI thread as before
+            return
+        if h5object.size > self.preview_size and len(h5object.shape) > 1:
+            leading_size = h5object.size // h5object.shape[-1]
+            target = max(self.preview_size // h5object.shape[-1], 1)
+            step = int(np.ceil((leading_size / target) ** (1.0 / (len(h5object.shape) - 1))))
+            if step > 1:
+                self.loaded.emit(request_id, renderers, preload_dataset(h5object, step=step))
+        if self.is_current(request_id):
+            self.loaded.emit(request_id, renderers, preload_dataset(h5object))
 
 #hdf5_info_base,
 #hdf5_info_widget = uic.loadUi(os.path.join(os.path.dirname(__file__), 'hdf5_info_renderer.ui'))
@@ -730,7 +916,7 @@ class SpectrumRenderer(FigureRendererPG):
     control/shift as used in most windows apps.
     """
     def display_data(self):
-        if type(self.h5object) == h5py.Dataset:
+        if isinstance(self.h5object, h5py.Dataset):
             self.h5object = {self.h5object.name : self.h5object}
         #Perform averaging
         h5list = {}
@@ -990,10 +1176,27 @@ class HyperSpec_Alan(DataRenderer, QtWidgets.QWidget):
         self.setLayout(self.layout)
         self.display_data()
 
+    @staticmethod
+    def hs_image_name(h5object):
+        """The name of the first processed hyperspectral image in the group.
+
+        Scans saved with raw_only set have no processed image, so we process
+        the raw data instead (see load_hs_image).
+        """
+        return 'raw_data/hs_image' if h5object.attrs.get('raw_only', False) else 'hs_image'
+
+    @classmethod
+    def load_hs_image(cls, h5object, suffix=''):
+        """Return the processed hyperspectral image with the given suffix ('', '2', ...)."""
+        if h5object.attrs.get('raw_only', False):
+            from nplab.experiment.hyperspectral_imaging.hyperspectral_imaging import process_hs_image
+            return process_hs_image(h5object['raw_data/hs_image'+suffix])
+        return np.array(h5object['hs_image'+suffix])
+
     def display_data(self):
         # A try and except loop to determine the number of hyperspectral image avaible
         try:
-            original_string = 'hs_image'
+            original_string = self.hs_image_name(self.h5object)
             test_string = original_string
             num_hyperspec = 1
             Fail = False
@@ -1016,7 +1219,7 @@ class HyperSpec_Alan(DataRenderer, QtWidgets.QWidget):
                 hyperspec_nom_str = str(hyperspec_nom)
                 
             #Grab the correct hyperspec data
-            data = np.transpose(np.array(self.h5object['hs_image'+hyperspec_nom_str]))
+            data = np.transpose(self.load_hs_image(self.h5object, hyperspec_nom_str))
             #Change NaNs to zeros (prevents error)
             data[0][np.where(np.isnan(data[0]))] = 0 
         
@@ -1048,7 +1251,7 @@ class HyperSpec_Alan(DataRenderer, QtWidgets.QWidget):
     def is_suitable(cls, h5object):
         suitability = 0
         try:
-            h5object['hs_image']
+            h5object[cls.hs_image_name(h5object)]
             suitability = suitability + 10
         except KeyError:
             return -1
@@ -26,7 +26,7 @@ if is_pyqt5():
 else:
     matplotlib.use('Qt4Agg')
 
-from nplab.ui.data_renderers import suitable_renderers
+from nplab.ui.data_renderers import suitable_renderers, BackgroundLoader
 from nplab.ui.ui_tools import UiTools
 import functools
 from nplab.utils.array_with_attrs import DummyHDF5Group
@@ -35,6 +35,7 @@ import nplab.datafile as df
 import subprocess
 import os
 import datetime
+import threading
 
 
 # base, widget = uic.loadUiType(os.path.join(os.path.dirname(__file__), 'hdf5_browser.ui'))
@@ -53,6 +54,7 @@ class HDF5ItemViewer(QtWidgets.QWidget, UiTools):
                  refresh_button=None,
                  copy_button=None,
                  default_button=None,
+                 background_loading=False,
                  ):
         """Create a viewer widget for any dataset or datagroup object
         
@@ -77,6 +79,10 @@ class HDF5ItemViewer(QtWidgets.QWidget, UiTools):
         default_button : QPushButton (optional)
             If specified, use the supplied button to select the default 
             rendererinstead of creating one.
+        background_loading : bool (optional)
+            If True, choose the renderer and read the data in a background thread
+            (see `nplab.ui.data_renderers.BackgroundLoader`), so the GUI stays
+            responsive when looking at big datasets.
         """
         super(HDF5ItemViewer, self).__init__(parent)
         
@@ -118,6 +124,12 @@ class HDF5ItemViewer(QtWidgets.QWidget, UiTools):
         self.layout().setContentsMargins(0,0,0,0)
         
         self.renderers = list()
+
+        if background_loading:
+            self.loader = BackgroundLoader(self)
+            self.loader.loaded.connect(self._data_loaded)
+        else:
+            self.loader = None
         
         if show_controls: # this part may be broken
             hb = QtWidgets.QHBoxLayout()
@@ -145,8 +157,21 @@ class HDF5ItemViewer(QtWidgets.QWidget, UiTools):
         self._data = newdata
 
         # When data changes, update the list of renderers
-        
-        renderers = suitable_renderers(self.data)
+        if self.loader is not None:
+            self.loader.request(newdata)  # calls _data_loaded when it's ready
+        else:
+            self.show_data(suitable_renderers(newdata), newdata)
+
+    _render_data = None
+
+    def _data_loaded(self, request_id, renderers, render_data):
+        """Display data that have been loaded in the background (unless something else has been selected since)"""
+        if self.loader.is_current(request_id):
+            self.show_data(renderers, render_data)
+
+    def show_data(self, renderers, render_data):
+        """Update the list of renderers, and render the data (which may be a preloaded copy of self.data)"""
+        self._render_data = render_data
         combobox = self.renderer_combobox
         previous_selection = combobox.currentIndex() # remember previous choice
         try:#Attempt to keep the same range
@@ -206,7 +231,7 @@ class HDF5ItemViewer(QtWidgets.QWidget, UiTools):
         # The class of the renderer is stored as the combobox data
         RendererClass = self.renderer_combobox.itemData(index)
         try:
-            self.renderer = RendererClass(self.data, self)
+            self.renderer = RendererClass(self._render_data if self._render_data is not None else self.data, self)
         except TypeError:
             # If the box is empty (e.g. it's just been cleared) use a blank widget
             self.renderer = QtWidgets.QWidget()
@@ -265,8 +290,37 @@ def igorOpen(dataset):
             subprocess.Popen( igorpath+' '+ igortmpfile+'.txt')
 
 
+def timestamp_order(group, keys):
+    """Return keys sorted by the creation_timestamp of the items, or in natural order if any item lacks one.
+
+    ISO format timestamps sort correctly as strings, so we don't need to parse them."""
+    try:
+        time_stamps = []
+        for key in keys:
+            try:
+                time_stamp_str = group[key].attrs['creation_timestamp']
+            except AttributeError:
+                print(group[key])
+                print('has no creation_timestamp attribute.')
+                time_stamp_str = '2021-01-01T01:01:01.000001'
+            if isinstance(time_stamp_str, bytes):
+                time_stamp_str = time_stamp_str.decode()
+            time_stamps.append(time_stamp_str)
+        return [keys[i] for i in np.argsort(time_stamps, kind='stable')]
+    except KeyError:
+        return sorted(keys, key=split_number_from_name)
+
+
+_sorted_keys_cache = {}  # (filename, group name) -> keys in timestamp order
+
+
 class HDF5TreeItem(object):
-    """A simple class to represent items in an HDF5 tree"""
+    """A simple class to represent items in an HDF5 tree
+
+    Children are created lazily, a page at a time (see fetch_more), so that groups with very many items can be shown
+    straight away.  Until the items have been sorted by timestamp (which is slow, and done by HDF5ItemModel in the
+    background) they are in natural name order.
+    """
     def __init__(self, data_file, parent, name, row):
         """Create a new item for an HDF5 tree
 
@@ -283,6 +337,9 @@ class HDF5TreeItem(object):
         self.parent = parent
         self.name = name
         self.row = row
+        self._keys = None
+        self._children = None
+        self.timestamp_sorted = False
         if parent is not None:
             assert name.startswith(parent.name)
             assert name in data_file
@@ -301,41 +358,70 @@ class HDF5TreeItem(object):
             self._has_children = hasattr(self.data_file[self.name], "keys")
         return self._has_children
 
-    _children = None
     @property
-    def children(self):
-        """Children of the current item (as HDF5TreeItems)"""
+    def keys(self):
+        """The names of this item's children, in display order"""
         if self.has_children is False:
             return []
+        if self._keys is None:
+            cached = _sorted_keys_cache.get((self.data_file.filename, self.name))
+            keys = [k for k in self.data_file[self.name].keys()
+                    if not (self.name == "/" and k == df.SHARED_ATTRIBUTES_GROUP)]  # hide shared attributes
+            if cached is not None and len(cached) == len(keys):
+                self._keys = cached
+                self.timestamp_sorted = True
+            else:
+                self._keys = sorted(keys, key=split_number_from_name)
+        return self._keys
+
+    @property
+    def n_fetched(self):
+        """The number of children that have been created so far"""
+        return 0 if self._children is None else len(self._children)
+
+    def can_fetch_more(self):
+        """Whether there are children that haven't been created yet"""
+        return self.has_children and self.n_fetched < len(self.keys)
+
+    def fetch_more(self, n):
+        """Create up to n more children, returning the number created"""
         if self._children is None:
-            keys = list(self.data_file[self.name].keys())
-            try:
-                time_stamps = []
-                for value in self.data_file[self.name].values():
-                   
-                    try:
-                        time_stamp_str = value.attrs['creation_timestamp']
-                    except AttributeError:
-                        print(value)
-                        print('has no creation_timestamp attribute.')
-                        time_stamp_str = '2021-01-01T01:01:01.000001'
-                    #if type(time_stamp_str) is bytes:
-                    if isinstance(time_stamp_str, bytes):
-                        time_stamp_str = time_stamp_str.decode() #b'somestring'.decode('UTF-8')
-                    #print(time_stamp_str)
-                    try:
-                        time_stamp_float = datetime.datetime.strptime(time_stamp_str, "%Y-%m-%dT%H:%M:%S.%f")
-                    except ValueError:
-                        time_stamp_str =  time_stamp_str+'.0'
-                        time_stamp_float = datetime.datetime.strptime(time_stamp_str,"%Y-%m-%dT%H:%M:%S.%f")
-                    time_stamps.append(time_stamp_float)
-                keys = np.array(keys)[np.argsort(time_stamps)]
-            except KeyError:
-                keys.sort(key=split_number_from_name)
-            
-            self._children = [HDF5TreeItem(self.data_file, self, self.name.rstrip("/") + "/" + k, i)
-                              for i, k in enumerate(keys)]
-        return self._children
+            self._children = []
+        start = len(self._children)
+        new_keys = self.keys[start:start + n]
+        self._children += [HDF5TreeItem(self.data_file, self, self.name.rstrip("/") + "/" + k, start + i)
+                           for i, k in enumerate(new_keys)]
+        return len(new_keys)
+
+    def set_keys(self, keys):
+        """Change the order of the children, keeping the same number of them created.
+
+        Children that are still shown keep their HDF5TreeItem, and have their row updated."""
+        old_children = dict((c.basename, c) for c in (self._children or []))
+        n_fetched = self.n_fetched
+        self._keys = keys
+        self.timestamp_sorted = True
+        if self._children is not None:
+            self._children = []
+            for i, k in enumerate(keys[:n_fetched]):
+                child = old_children.pop(k, None)
+                if child is None:
+                    child = HDF5TreeItem(self.data_file, self, self.name.rstrip("/") + "/" + k, i)
+                child.row = i
+                self._children.append(child)
+            for child in old_children.values():
+                child.purge_children()
+
+    @property
+    def children(self):
+        """Children of the current item (as HDF5TreeItems) - this creates all of them"""
+        while self.can_fetch_more():
+            self.fetch_more(len(self.keys))
+        return self._children or []
+
+    def child(self, row):
+        """The child in a given row (it must have been fetched already)"""
+        return self._children[row]
 
     def purge_children(self):
         """Empty the cached list of children"""
@@ -343,10 +429,10 @@ class HDF5TreeItem(object):
             if self._children is not None:
                 for child in self._children:
                     child.purge_children() # We must delete them all the way down!
-                    self._children.remove(child)
-                    del child # Not sure if this is needed...
                 self._children = None
+            self._keys = None
             self._has_children = None
+            self.timestamp_sorted = False
         except:
             print("{} failed to purge its children".format(self.name))
 
@@ -354,7 +440,7 @@ class HDF5TreeItem(object):
     def h5item(self):
         """The underlying HDF5 item for this tree item."""
         assert self.name in self.data_file, "Error, {} is no longer a valid HDF5 item".format(self.name)
-        return self.data_file[self.name]
+        return df.wrap_h5py_item(self.data_file[self.name])  # wrapped, so shared attributes are resolved
 
     def __del__(self):
         self.purge_children()
@@ -372,15 +458,22 @@ def print_tree(item, prefix=""):
 class HDF5ItemModel(QtCore.QAbstractItemModel):
     """This model takes its data from an HDF5 Group for display in a tree.
 
-    It loads the file as the tree is expanded for speed - in the future it might implement sanity checks to
-    abort loading very long folders.
+    It loads the file as the tree is expanded for speed: the children of a group are added a page at a time
+    (Qt calls canFetchMore/fetchMore as the view scrolls), and are sorted by their creation timestamps in a
+    background thread, so the names appear straight away and are re-ordered when the sort is done.  The sorted
+    order is cached, and the items of collapsed branches are released (see release_children).
     """
+    page_size = 200
+    timestamps_sorted = QtCore.Signal(object, int, object)  # item, model generation, sorted keys
+
     def __init__(self, data_group):
         """Represent an HDF5 group to a QTreeView or similar.
         :type data_group: nplab.datafile.Group
         """
         super(HDF5ItemModel, self).__init__()
         self.root_item = None
+        self._generation = 0  # incremented when the tree is reset, so stale sorts can be ignored
+        self.timestamps_sorted.connect(self._apply_sorted_keys)
         self.data_group = data_group
         
     _data_group = None
@@ -394,6 +487,7 @@ class HDF5ItemModel(QtCore.QAbstractItemModel):
         """Set the data group represented by the model"""
         if self.root_item is not None:
             del self.root_item
+        self._generation += 1
         self._data_group = new_data_group
         self.root_item = HDF5TreeItem(new_data_group.file, None, new_data_group.name, 0)
 
@@ -413,7 +507,7 @@ class HDF5ItemModel(QtCore.QAbstractItemModel):
         """
         try:
             parent = self._index_to_item(parent_index)
-            return self.createIndex(row, column, parent.children[row])
+            return self.createIndex(row, column, parent.child(row))
         except:
             return QtCore.QModelIndex()
 
@@ -421,6 +515,8 @@ class HDF5ItemModel(QtCore.QAbstractItemModel):
         """Find the index of the parent of the item at a given index."""
         try:
             parent = self._index_to_item(index).parent
+            if parent is None or parent is self.root_item:
+                return QtCore.QModelIndex()
             return self.createIndex(parent.row, 0, parent)
         except:
             # Something went wrong with finding the parent so return an invalid index
@@ -442,11 +538,9 @@ class HDF5ItemModel(QtCore.QAbstractItemModel):
         return [""]
 
     def rowCount(self, index):
-        """The number of rows exposed by the model"""
+        """The number of rows exposed by the model (i.e. the children fetched so far)"""
         try:
-            item = self._index_to_item(index)
-            assert item.has_children
-            return len(item.children)
+            return self._index_to_item(index).n_fetched
         except:
             # if it doesn't have keys, assume there are no children.
             return 0
@@ -454,11 +548,68 @@ class HDF5ItemModel(QtCore.QAbstractItemModel):
     def hasChildren(self, index):
         """Whether or not this object has children"""
         return self._index_to_item(index).has_children
-        #try:
-        #    assert hasattr(self._index_to_item(index), "keys")
-        #    return True
-        #except:
-        #    return False
+
+    def canFetchMore(self, index):
+        """Whether the item has children that haven't been added to the model yet"""
+        try:
+            return self._index_to_item(index).can_fetch_more()
+        except:
+            return False
+
+    def fetchMore(self, index):
+        """Add the next page of children to the model, and start sorting them if that's not been done"""
+        item = self._index_to_item(index)
+        if item.n_fetched == 0 and not item.timestamp_sorted:
+            self._sort_in_background(item)
+        n_fetched = item.n_fetched
+        n_new = min(self.page_size, len(item.keys) - n_fetched)
+        if n_new <= 0:
+            return
+        self.beginInsertRows(index, n_fetched, n_fetched + n_new - 1)
+        item.fetch_more(n_new)
+        self.endInsertRows()
+
+    def _sort_in_background(self, item):
+        """Sort the children of an item by timestamp in a background thread, then re-order them in the model"""
+        generation = self._generation
+        keys = list(item.keys)
+        group = self.root_item.data_file[item.name]
+
+        def sort_keys():
+            try:
+                self.timestamps_sorted.emit(item, generation, timestamp_order(group, keys))
+            except Exception as e:
+                print("Could not sort {} by timestamp: {}".format(item.name, e))
+        thread = threading.Thread(target=sort_keys)
+        thread.daemon = True
+        thread.start()
+
+    def _apply_sorted_keys(self, item, generation, keys):
+        """Re-order an item's children once they've been sorted (runs in the GUI thread)"""
+        _sorted_keys_cache[(item.data_file.filename, item.name)] = keys
+        if generation != self._generation or item._keys is None or set(keys) != set(item._keys):
+            return  # the tree has changed since we started sorting
+        self.layoutAboutToBeChanged.emit()
+        old_indexes = [i for i in self.persistentIndexList() if i.isValid() and i.internalPointer().parent is item]
+        old_items = [i.internalPointer() for i in old_indexes]
+        item.set_keys(keys)
+        new_indexes = []
+        for old_index, child in zip(old_indexes, old_items):
+            if child.row < item.n_fetched and item.child(child.row) is child:
+                new_indexes.append(self.createIndex(child.row, old_index.column(), child))
+            else:
+                new_indexes.append(QtCore.QModelIndex())
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
+
+    def release_children(self, index):
+        """Forget the children of a (collapsed) item, to free the memory they use"""
+        item = self._index_to_item(index)
+        if item.n_fetched == 0:
+            return
+        self.beginRemoveRows(index, 0, item.n_fetched - 1)
+        item.purge_children()
+        self.endRemoveRows()
 
     def columnCount(self, index=None, *args, **kwargs):
         """Return the number of columns"""
@@ -471,6 +622,9 @@ class HDF5ItemModel(QtCore.QAbstractItemModel):
         using this model will automatically reload.
         """
         self.beginResetModel()
+        self._generation += 1
+        for key in [k for k in _sorted_keys_cache if k[0] == self.root_item.data_file.filename]:
+            del _sorted_keys_cache[key]
         self.root_item.purge_children()
         self.endResetModel()
 
@@ -499,6 +653,8 @@ class HDF5ItemModel(QtCore.QAbstractItemModel):
         treeview.customContextMenuRequested.connect(functools.partial(self.context_menu, treeview))
         # Allow multiple objects to be selected
         treeview.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        # Free the items in branches that are collapsed
+        treeview.collapsed.connect(self.release_children)
 
     def context_menu(self, treeview, position):
         """Generate a right-click menu for the items"""
@@ -552,6 +708,7 @@ class HDF5Browser(QtWidgets.QWidget, UiTools):
         self.selection_model.selectionChanged.connect(self.selection_changed)
         self.viewer = HDF5ItemViewer(parent=self, 
                                      show_controls=True,
+                                     background_loading=True,
                                      )
         self.refresh_tree_button = QtWidgets.QPushButton() #Create a refresh button
         self.refresh_tree_button.setText("Refresh Tree")
@@ -28,6 +28,7 @@ from nplab.utils.array_with_attrs import ArrayWithAttrs
 import cv2
 #import cv2.cv
 from scipy import ndimage
+from scipy import fft
 
 class ImageWithLocation(ArrayWithAttrs):
     """An image, as a numpy array, with attributes to provide location information"""
@@ -227,6 +228,8 @@ def locate_feature_in_image(image, feature, margin=0, restrict=False):
     the first image, of the "datum pixel" of the feature image.  If no datum pixel is specified, we assume it's the
     centre of the image.  The output of this function can be passed into the pixel_to_location() method of the larger
     image to yield the position in the sample of the feature you're looking for.
+
+    If you're looking for the same feature in many images, a `FeatureTracker` is much faster.
     """
     # The line below is superfluous if we keep the datum-aware code below it.
     assert image.shape[0] > feature.shape[0] and image.shape[1] > feature.shape[1], "Image must be larger than feature!"
@@ -256,4 +259,108 @@ def locate_feature_in_image(image, feature, margin=0, restrict=False):
     peak = ndimage.measurements.center_of_mass(corr)  # take the centroid (NB this is of grayscale values, not binary)
     pos = np.array(peak) + image_shift + datum_pixel(feature) # return the position of the feature's datum point.
     return pos
-    
\ No newline at end of file
+    
+
+def _grayscale_float32(image):
+    """Return an image as a 2D float32 array, averaging over colour channels if there are any."""
+    image = np.asarray(image)
+    if image.ndim == 3:
+        return np.mean(image, axis=2, dtype=np.float32)
+    return image.astype(np.float32, copy=False)
+
+
+def _parabolic_peak_offset(before, peak, after):
+    """The sub-pixel offset of the peak of a parabola through three equally-spaced points."""
+    denominator = before - 2 * peak + after
+    if denominator >= 0:  # not a maximum
+        return 0.0
+    return 0.5 * (before - after) / denominator
+
+
+class FeatureTracker(object):
+    """Find the same feature repeatedly in a series of images, quickly enough to keep up with a camera.
+
+    `locate_feature_in_image` converts both images and runs a full template match every time it's called.  This
+    class prepares the feature once (converting it to a zero-mean float32 array and caching its Fourier transform for
+    each size of search window), then finds it by phase correlation, with a parabolic fit to locate the correlation
+    peak to a fraction of a pixel.  No window function is applied: the template is zero-padded, and only offsets that
+    keep it inside the search window are used, so the correlation never wraps around the edges of the crop (tapering
+    the template with a Hann window made no difference to the accuracy in testing).  By default the cross-power spectrum is only partly whitened
+    (`whitening=0.5`) rather than normalised to unit magnitude as in textbook phase correlation: the template is
+    zero-padded to the size of the window, and fully whitening the frequencies where it has almost no power amplifies
+    noise more than it sharpens the peak.
+
+    Only a window `margin` pixels larger than the feature on each side is searched, centred on where we expect the
+    feature to be: by default where we last found it or, the first time, where the datum pixels of the feature and the
+    image coincide.  If the correlation peak is weak (its height, in standard deviations of the correlation surface,
+    is less than `min_confidence`) we search the whole image instead.  Set margin to 0 to always search the whole
+    image.
+
+    `locate` returns the position of the feature's datum pixel in the image, as `locate_feature_in_image` does.  It
+    always returns the best match it found, so check `confidence` if the feature might not be in the image at all.
+    """
+    def __init__(self, feature, margin=50, min_confidence=6.0, whitening=0.5):
+        self.feature = feature
+        self.margin = margin
+        self.min_confidence = min_confidence
+        self.whitening = whitening
+        self.feature_datum = datum_pixel(feature)
+        template = _grayscale_float32(feature)
+        self.template = template - template.mean()
+        self._template_fft = dict()  # conjugated FFTs of the template, zero-padded to each window shape we've used
+        self.last_position = None
+        self.confidence = None
+        self.used_full_search = False
+
+    def _conjugate_template_fft(self, shape):
+        """The complex conjugate of the template's FFT, padded to a given shape (cached)."""
+        if shape not in self._template_fft:
+            self._template_fft[shape] = np.conj(fft.rfft2(self.template, s=shape, workers=-1))
+        return self._template_fft[shape]
+
+    def _correlate(self, window):
+        """Return (offset, confidence) of the template's top-left corner in a window, by phase correlation."""
+        window = _grayscale_float32(window)
+        window = window - window.mean()
+        shape = tuple(fft.next_fast_len(n, real=True) for n in window.shape)
+        cross_power = fft.rfft2(window, s=shape, workers=-1) * self._conjugate_template_fft(shape)
+        if self.whitening:
+            cross_power /= (np.abs(cross_power) + 1e-6) ** self.whitening
+        correlation = fft.irfft2(cross_power, s=shape, workers=-1)
+        # only offsets that keep the template inside the window are valid (the rest have wrapped around)
+        valid = correlation[:window.shape[0] - self.template.shape[0] + 1,
+                            :window.shape[1] - self.template.shape[1] + 1]
+        i, j = np.unravel_index(np.argmax(valid), valid.shape)
+        confidence = (valid[i, j] - valid.mean()) / (valid.std() + 1e-12)
+        offset = np.array([i, j], dtype=float)
+        if 0 < i < valid.shape[0] - 1:
+            offset[0] += _parabolic_peak_offset(valid[i - 1, j], valid[i, j], valid[i + 1, j])
+        if 0 < j < valid.shape[1] - 1:
+            offset[1] += _parabolic_peak_offset(valid[i, j - 1], valid[i, j], valid[i, j + 1])
+        return offset, confidence
+
+    def locate(self, image, predicted_position=None):
+        """Find the feature in an image, and return the position of its datum pixel (in the image's pixels).
+
+        predicted_position is where we expect the feature's datum pixel to be: it defaults to where it was last
+        found, or where the datum pixels of the image and the feature coincide if this is the first image.
+        """
+        shape = np.array(image.shape[:2])
+        template_shape = np.array(self.template.shape)
+        assert np.all(shape > template_shape), "Image must be larger than feature!"
+        if predicted_position is None:
+            predicted_position = self.last_position if self.last_position is not None else datum_pixel(image)
+        confidence = -np.inf
+        if self.margin > 0:
+            # crop out the search window (from the original image, so we only convert the pixels we need)
+            corner = np.round(np.asarray(predicted_position) - self.feature_datum).astype(int) - self.margin
+            corner = np.clip(corner, 0, shape - template_shape - 1)
+            end = np.minimum(corner + template_shape + 2 * self.margin + 1, shape)
+            offset, confidence = self._correlate(image[corner[0]:end[0], corner[1]:end[1], ...])
+        self.used_full_search = confidence < self.min_confidence
+        if self.used_full_search:
+            corner = np.zeros(2, dtype=int)
+            offset, confidence = self._correlate(image)
+        self.confidence = confidence
+        self.last_position = corner + offset + self.feature_datum
+        return self.last_position
@@ -0,0 +1,87 @@
+"""
+ALS Baseline Tests
+==================
+
+Check the shared asymmetric least squares baseline agrees with the original sparse solve, for single spectra and
+batches, and that the modules that used to have their own copy now use it.
+"""
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+from nplab.analysis.background_removal import asymmetric_least_squares as als
+
+
+def sparse_baseline_als(y, lam, p, niter=10):
+    """The implementation that used to be copied into each module, for comparison."""
+    L = len(y)
+    D = sparse.csc_matrix(np.diff(np.eye(L), 2))
+    w = np.ones(L)
+    for i in range(niter):
+        W = sparse.spdiags(w, 0, L, L)
+        Z = W + lam * D.dot(D.transpose())
+        z = spsolve(Z, w*y)
+        w = p * (y > z) + (1-p) * (y < z)
+    return z
+
+
+def make_spectra(n, length=300):
+    """Noisy peaks on a sloping, curved background."""
+    rng = np.random.RandomState(0)
+    x = np.linspace(0, 1, length)
+    centres = rng.uniform(0.2, 0.8, (n, 1))
+    return 100*np.exp(-x) + 50*np.exp(-((x - centres)/0.02)**2) + rng.normal(size=(n, length))
+
+
+def test_single_spectra_match_the_sparse_solve():
+    for length in (3, 4, 7, 300):
+        y = make_spectra(1, length)[0]
+        assert np.allclose(als.baseline_als(y, 1e5, 0.01), sparse_baseline_als(y, 1e5, 0.01), rtol=1e-6, atol=1e-6)
+    y = make_spectra(1)[0]
+    assert np.allclose(als.als(y, p=0.05, niter=5), sparse_baseline_als(y, 1e3, 0.05, niter=5))
+    with pytest.raises(ValueError):
+        als.baseline_als(y[:2], 1e3, 0.01)
+
+
+def test_batches_match_single_spectra():
+    spectra = make_spectra(als.MIN_BATCH_SIZE + 10)
+    single = np.array([als.baseline_als(y, 1e5, 0.01) for y in spectra])
+    assert np.allclose(als.baseline_als(spectra, 1e5, 0.01), single, rtol=1e-6, atol=1e-6)
+    assert np.allclose(als.baseline_als(spectra[:5], 1e5, 0.01), single[:5])
+    assert np.allclose(als.baseline_als(spectra[:20], 1e5, 0.01, processes=2, block_size=10), single[:20])
+    assert als.baseline_als(np.empty((0, 300)), 1e5, 0.01).shape == (0, 300)
+    assert als.penalty_diagonals(300, 1e5) is als.penalty_diagonals(300, 1e5)
+
+
+CALL_SITES = """
+import sys
+import numpy as np
+from nplab.analysis.general_spec_tools import spectrum_tools
+from nplab.analysis.background_removal import ALS_BG_removal
+spectra = np.load(sys.argv[1])
+np.savez(sys.argv[2],
+         spectrum_tools=spectrum_tools.baseline_als(spectra[0], 1e3, 0.05, niter=5),
+         ALS_BG_removal=ALS_BG_removal.baseline_als(spectra, 1e5, 0.01),
+         ALS_BG_removal_single=ALS_BG_removal.baseline_als(spectra[0], 1e5, 0.01))
+"""
+
+
+def test_call_sites_use_the_shared_baseline(tmpdir):
+    # these modules import pyplot, which would pick a matplotlib backend for the rest of the tests, so they're
+    # imported in another process with a headless backend
+    spectra = make_spectra(3)
+    spectra_file, baselines_file = str(tmpdir.join('spectra.npy')), str(tmpdir.join('baselines.npz'))
+    np.save(spectra_file, spectra)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, MPLBACKEND='Agg', PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    subprocess.run([sys.executable, '-c', CALL_SITES, spectra_file, baselines_file], env=env, check=True)
+    baselines = np.load(baselines_file)
+    assert np.allclose(baselines['spectrum_tools'], sparse_baseline_als(spectra[0], 1e3, 0.05, niter=5))
+    expected = np.array([sparse_baseline_als(y, 1e5, 0.01) for y in spectra])
+    assert np.allclose(baselines['ALS_BG_removal'], expected, rtol=1e-6, atol=1e-6)
+    assert np.allclose(baselines['ALS_BG_removal_single'], expected[0], rtol=1e-6, atol=1e-6)
@@ -0,0 +1,99 @@
+"""
+Autofocus Tests
+===============
+
+Check the search-based autofocus finds the focus of a simulated microscope, and remembers it.
+"""
+import threading
+
+import cv2
+import numpy as np
+
+from nplab.instrument.camera import DummyCamera
+from nplab.instrument.camera.autofocus import FocusMap, parabola_vertex
+from nplab.instrument.camera.camera_with_location import CameraWithLocation
+from nplab.instrument.stage import DummyStage
+
+
+class SimulatedStage(DummyStage):
+    def __init__(self):
+        super(SimulatedStage, self).__init__()
+        self.axis_names = ('x', 'y', 'z')
+        self._position = np.zeros(3)
+
+    def move(self, position, axis=None, relative=False):
+        super(SimulatedStage, self).move(list(np.ravel(position)) if axis is None else position, axis, relative)
+
+
+def focal_plane(x, y):
+    return 1.3 + 0.05 * x
+
+
+class SimulatedCamera(DummyCamera):
+    def __init__(self, stage):
+        super(SimulatedCamera, self).__init__()
+        self.stage = stage
+        self.texture = (np.random.RandomState(0).random_sample((128, 128)) * 255).astype(np.float32)
+        self.exposures = 0
+
+    def raw_snapshot(self):
+        self.exposures += 1
+        x, y, z = self.stage.position
+        image = cv2.GaussianBlur(self.texture, (0, 0), 0.5 + 1.5 * abs(z - focal_plane(x, y)))
+        return True, image.astype(np.uint8)
+
+
+def make_cwl():
+    stage = SimulatedStage()
+    cwl = CameraWithLocation(SimulatedCamera(stage), stage)
+    cwl.pixel_to_sample_displacement = np.identity(3)
+    cwl.frames_to_discard = 0
+    cwl.camera.exposures = 0
+    return cwl
+
+
+def test_parabola_vertex():
+    assert np.isclose(parabola_vertex((0, 1, 3), (-4, -1, -1)), 2)
+    assert parabola_vertex((0, 1, 2), (0, 1, 2)) is None
+
+
+def test_search_autofocus_finds_focus():
+    cwl = make_cwl()
+    shift, positions, merits = cwl.search_autofocus()
+    assert abs(cwl.stage.position[2] - focal_plane(0, 0)) < 0.15
+    assert len(merits) == len(positions) == cwl.camera.exposures
+    assert np.allclose(shift[:2], 0)
+
+    cwl.autofocus_engine.roi_size = (50, 50)
+    cwl.stage.move([4, 0, 0])  # nearby, but the stage is a long way from focus
+    cwl.camera.exposures = 0
+    cwl.search_autofocus()
+    assert abs(cwl.stage.position[2] - focal_plane(4, 0)) < 0.15
+    assert cwl.camera.exposures < cwl.af_steps, "Starting from the predicted focus should be quick"
+
+
+def test_search_autofocus_uses_the_current_step_size():
+    cwl = make_cwl()
+    cwl.af_step_size = 0.4
+    shift, positions, merits = cwl.search_autofocus()
+    assert cwl.autofocus_engine.step == 0.4
+    assert np.isclose(positions[1][2] - positions[0][2], 0.4)
+    assert abs(cwl.stage.position[2] - focal_plane(0, 0)) < 0.15
+
+
+def test_search_autofocus_leaves_no_threads_running():
+    before = set(threading.enumerate())
+    cwl = make_cwl()
+    cwl.search_autofocus()
+    workers = [t for t in threading.enumerate() if t not in before and t.name.startswith('ThreadPoolExecutor')]
+    assert workers == [], "The merit calculation threads should be shut down after each search"
+
+
+def test_focus_map_predicts_nearby_regions():
+    focus_map = FocusMap(region_size=10)
+    assert focus_map.predict([0, 0]) is None
+    focus_map.add([1, 1, 5])
+    focus_map.add([25, 1, 7])
+    assert focus_map.predict([9, 9]) == 5
+    assert focus_map.predict([15, 1]) == 6, "Regions with no focus use the mean of their neighbours"
+    assert focus_map.predict([50, 50]) is None
@@ -0,0 +1,113 @@
+"""
+Camera Frame Buffer Tests
+=========================
+
+Check the ring buffer of recent frames kept by cameras.
+"""
+import time
+
+import numpy as np
+import pytest
+
+from nplab.instrument.camera import FrameRingBuffer, FrameOverrunError, DummyCamera
+
+
+def test_frames_are_numbered_and_reused():
+    buffer = FrameRingBuffer(4)
+    assert buffer.latest_sequence == 0
+    for i in range(6):
+        assert buffer.push(np.full((3, 2), i, dtype=np.uint8)) == i + 1
+    assert buffer.frame_shape == (3, 2)
+    assert buffer.oldest_sequence == 3
+    assert [seq for seq, t, frame in buffer.last_frames(2)] == [5, 6]
+    assert [frame[0, 0] for seq, t, frame in buffer.frames_since(3)] == [3, 4, 5]
+    timestamp, frame = buffer.get_frame(6)
+    assert frame[0, 0] == 5
+    assert not buffer.is_valid(2)
+
+
+def test_overruns_are_reported():
+    buffer = FrameRingBuffer(4)
+    for i in range(10):
+        buffer.push(np.full(5, i))
+    with pytest.raises(FrameOverrunError) as e:
+        buffer.frame_after(2, allow_overrun=False)
+    assert e.value.missed == 4
+    seq, timestamp, frame = buffer.frame_after(2)
+    assert seq == 7, "We should get the oldest frame that's left"
+    with pytest.raises(FrameOverrunError):
+        buffer.get_frame(1)
+    with pytest.raises(IOError):
+        buffer.frame_after(10, timeout=0.01)
+
+
+def test_frames_can_be_written_in_place():
+    buffer = FrameRingBuffer(3)
+    seq, slot = buffer.start_frame((2, 2), np.uint16)
+    slot[...] = 7
+    assert not buffer.is_valid(seq), "Frames aren't valid until they're committed"
+    buffer.commit_frame(seq, timestamp=1.5)
+    timestamp, frame = buffer.get_frame(seq)
+    assert timestamp == 1.5
+    assert np.all(frame == 7)
+    assert np.shares_memory(frame, slot)
+
+
+def test_latest_raw_frame_survives_the_buffer_wrapping():
+    camera = DummyCamera()
+    camera.frame_buffer = FrameRingBuffer(3)
+
+    def fill(value):
+        def fill_function(out):
+            out[...] = value
+            return True
+        return fill_function
+    camera.write_frame_in_place(fill(1), shape=(4, 4), dtype=np.uint8)
+    frame = camera.latest_raw_frame
+    assert np.all(frame == 1)
+    assert not np.shares_memory(frame, camera.frame_buffer.get_frame(1)[1])
+    for i in range(2, 6):
+        camera.write_frame_in_place(fill(i))
+    assert np.all(frame == 1), "The frame we were given shouldn't change when its slot is reused"
+    assert np.all(camera.latest_raw_frame == 5)
+
+
+def test_get_next_frame_in_live_view():
+    camera = DummyCamera()
+    camera.live_view = True
+    try:
+        first = camera.get_next_frame(timeout=5)
+        assert first.shape == (100, 100, 3)
+        seq = camera.frame_buffer.latest_sequence
+        camera.get_next_frame(timeout=5, discard_frames=1)
+        assert camera.frame_buffer.latest_sequence >= seq + 2
+    finally:
+        camera.live_view = False
+
+
+def test_record_saves_frames_to_one_dataset(tmpdir, monkeypatch):
+    import nplab.datafile as df
+    f = df.DataFile(str(tmpdir.join("recording.h5")))
+    monkeypatch.setattr(df, "_current_datafile", f)  # restored after the test
+    camera = DummyCamera()
+    camera.live_view_interval = 0.001
+    try:
+        group = camera.record(n_frames=20, attrs={'sample': 'test'}, timeout=5)
+        assert not camera.live_view, "Live view should be stopped if record started it"
+        frames = group['frames']
+        assert frames.shape == (20, 100, 100, 3)
+        assert frames.chunks == (1, 100, 100, 3)
+        sequences = group['sequence_numbers'][()]
+        assert np.all(np.diff(sequences) > 0)
+        assert group.attrs['dropped_frames'] == sequences[-1] - sequences[0] - 19
+        assert group.attrs['n_frames'] == 20
+        assert np.all(np.diff(group['timestamps'][()]) >= 0)
+        assert group.attrs['sample'] == 'test'
+
+        recording = camera.record(duration=10, block=False)
+        time.sleep(0.2)
+        group = recording.stop()
+        assert 0 < group['frames'].shape[0] == recording.n_frames
+    finally:
+        camera.live_view = False
+        f.close()
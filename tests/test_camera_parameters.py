@@ -0,0 +1,54 @@
+"""
+Camera Parameter Tests
+======================
+
+Check that camera parameters are cached, so metadata doesn't have to be read from the camera every time.
+"""
+import time
+
+from nplab.instrument.camera import DummyCamera
+
+
+class CountingCamera(DummyCamera):
+    def __init__(self):
+        self.reads = 0
+        super(CountingCamera, self).__init__()
+
+    def get_camera_parameter(self, name):
+        self.reads += 1
+        return super(CountingCamera, self).get_camera_parameter(name)
+
+
+def test_parameter_names_do_not_read_the_camera():
+    camera = CountingCamera()
+    assert camera.camera_parameter_names() == ['exposure', 'gain']
+    assert camera.reads == 0
+
+
+def test_metadata_uses_the_parameter_cache():
+    camera = CountingCamera()
+    assert camera.metadata['exposure'] == 40
+    reads = camera.reads
+    for i in range(10):
+        camera.raw_image(bundle_metadata=True)
+    assert camera.reads == reads, "Parameters should only be read once"
+
+    camera.exposure = 20  # the read-back should update the cache
+    reads = camera.reads
+    assert camera.metadata['exposure'] == 20
+    assert camera.reads == reads
+
+    camera._camera_parameters['gain'] = 5  # e.g. changed on the camera itself
+    assert camera.metadata['gain'] == 1
+    assert camera.refresh_parameters() == {'exposure': 20, 'gain': 5}
+    assert camera.metadata['gain'] == 5
+
+
+def test_cached_parameters_expire():
+    camera = CountingCamera()
+    camera.parameter_cache_ttl = 0.01
+    camera.metadata
+    reads = camera.reads
+    time.sleep(0.02)
+    camera.metadata
+    assert camera.reads == reads + 2
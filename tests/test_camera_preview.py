@@ -0,0 +1,73 @@
+"""
+Camera Preview Tests
+====================
+
+Check the preview widget drops frames it can't keep up with, and doesn't draw more pixels than it needs to.
+"""
+import time
+
+import numpy as np
+
+from nplab.utils.gui import get_qt_app
+from nplab.instrument.camera import CameraPreviewWidget, DummyCamera
+
+
+def process_events_for(app, seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def test_preview_is_rate_limited():
+    app = get_qt_app()
+    widget = CameraPreviewWidget(max_fps=20)
+    widget.resize(200, 200)
+    widget.show()
+    for i in range(50):
+        widget.update_image(np.full((64, 64), i, dtype=np.uint16))
+    process_events_for(app, 0.2)
+    assert widget.frames_received == 50
+    assert widget.frames_displayed == 1, "Only the latest frame should be drawn"
+    assert widget.dropped_frames == 49
+    assert widget.image_item.image[0, 0] == 49
+    assert widget.image_item.image.dtype == np.uint16
+
+    start = time.time()
+    while time.time() - start < 0.5:
+        widget.update_image(np.zeros((64, 64), dtype=np.uint8))
+        process_events_for(app, 0.005)
+    assert widget.frames_displayed <= 1 + 0.5 * 20 + 1
+    widget.close()
+
+
+def test_preview_downsamples_large_frames():
+    app = get_qt_app()
+    widget = CameraPreviewWidget()
+    widget.resize(200, 200)
+    widget.show()
+    frame = np.zeros((2000, 2000, 3), dtype=np.uint8)
+    for i in range(2):  # the first frame sets the view range
+        widget.update_image(frame)
+        process_events_for(app, 0.1)
+    assert widget.image_item.downsampling > 1
+    assert widget.image_item.image.shape[0] <= 2000 // widget.image_item.downsampling + 1
+    assert widget.image_item.mapRectToParent(widget.image_item.boundingRect()).width() == 2000
+    widget.close()
+
+
+def test_filtered_frame_is_cached():
+    camera = DummyCamera()
+    calls = []
+
+    def filter_function(frame):
+        calls.append(1)
+        return frame // 2
+    camera.filter_function = filter_function
+    camera.update_latest_frame(np.ones((4, 4), dtype=np.uint8) * 6)
+    for i in range(5):
+        assert camera.latest_frame[0, 0] == 3
+    assert len(calls) == 1
+    camera.update_latest_frame(np.ones((4, 4), dtype=np.uint8) * 8)
+    assert camera.latest_frame[0, 0] == 4
+    assert len(calls) == 2
@@ -0,0 +1,164 @@
+"""
+DataFile Tests
+==============
+
+Tests of the extra functions nplab adds to h5py files and groups.
+"""
+import pytest
+import h5py
+import numpy as np
+
+import nplab.datafile as df
+
+
+@pytest.fixture
+def shared_file(tmpdir):
+    f = df.DataFile(str(tmpdir.join("shared.h5")), shared_attributes=True)
+    yield f
+    f.close()
+
+
+def test_shared_attributes_are_stored_once(shared_file):
+    wavelengths = np.linspace(400, 900, 1024)
+    for i in range(10):
+        shared_file.create_dataset("spectrum_%d", data=np.zeros(1024),
+                                   attrs={'wavelengths': wavelengths, 'integration_time': 10})
+    assert len(shared_file[df.SHARED_ATTRIBUTES_GROUP]) == 1, "The wavelengths should only be stored once"
+    shared_file.create_dataset("spectrum_%d", data=np.zeros(1024), attrs={'wavelengths': wavelengths + 1})
+    assert len(shared_file[df.SHARED_ATTRIBUTES_GROUP]) == 2
+
+
+def test_shared_attributes_are_resolved(shared_file):
+    wavelengths = np.linspace(400, 900, 1024)
+    d = shared_file.create_dataset("spectrum", data=np.zeros(1024),
+                                   attrs={'wavelengths': wavelengths, 'small': np.arange(3)})
+    assert isinstance(d.attrs['wavelengths'], np.ndarray)
+    assert np.all(d.attrs['wavelengths'] == wavelengths)
+    assert np.all(shared_file['spectrum'].attrs['wavelengths'] == wavelengths)
+    assert np.all(dict(shared_file['spectrum'].attrs.items())['wavelengths'] == wavelengths)
+    assert np.all(d.attrs['small'] == np.arange(3)), "Small attributes should be saved as normal"
+
+    # plain h5py sees a reference to the shared copy
+    reference = h5py.Dataset.attrs.fget(d)['wavelengths']
+    assert isinstance(reference, h5py.Reference)
+    assert np.all(shared_file.file[reference][()] == wavelengths)
+
+
+def test_no_shared_attributes_by_default(tmpdir):
+    f = df.DataFile(str(tmpdir.join("plain.h5")))
+    d = f.create_dataset("spectrum", data=np.zeros(1024), attrs={'wavelengths': np.linspace(400, 900, 1024)})
+    assert df.SHARED_ATTRIBUTES_GROUP not in f
+    assert isinstance(h5py.Dataset.attrs.fget(d)['wavelengths'], np.ndarray)
+    f.close()
+
+
+def test_append_buffer(tmpdir):
+    f = df.DataFile(str(tmpdir.join("append.h5")))
+    with f.append_buffer("spectra", buffer_rows=10) as buffer:
+        for i in range(25):
+            buffer.append(np.ones(16) * i)
+        assert len(buffer) == 25
+        assert f["spectra"].shape[0] >= 20, "Full buffers should have been written"
+        assert f["spectra"].attrs["valid_length"] == 20
+        assert f["spectra"].shape[0] % 10 == 0, "The dataset should grow in whole chunks"
+        f.append_dataset("spectra", np.ones(16) * 25)  # goes through the open buffer
+    assert f["spectra"].shape == (26, 16), "The dataset should be trimmed when the buffer is closed"
+    assert "valid_length" not in f["spectra"].attrs
+    assert np.all(f["spectra"][:, 0] == np.arange(26))
+
+    f.append_dataset("spectra", np.ones(16) * 26)  # no buffer open, so this is written straight away
+    assert f["spectra"].shape == (27, 16)
+    f.close()
+
+
+def test_append_buffer_resumes(tmpdir):
+    f = df.DataFile(str(tmpdir.join("append.h5")))
+    buffer = f.append_buffer("values", buffer_rows=4, flush_interval=None)
+    buffer.extend(range(6))
+    buffer.flush()
+    # simulate a crash: the dataset is over-allocated, but valid_length says how much is real
+    assert f["values"].attrs["valid_length"] == 6
+    resumed = df.AppendBuffer(f, "values", buffer_rows=4)
+    resumed.extend(range(6, 9))
+    resumed.close()
+    assert np.all(f["values"][:] == np.arange(9))
+    f.close()
+
+
+def test_async_writes(tmpdir):
+    f = df.DataFile(str(tmpdir.join("async.h5")), async_writes=True, async_queue_size=4)
+    data = np.zeros(100)
+    futures = []
+    for i in range(20):
+        data[:] = i
+        futures.append(f.create_dataset("spectrum_%d", data=data, attrs={'index': i}))
+        f.append_dataset("log", np.array([i, i ** 2]))
+    f.wait_until_written()
+    assert all(future.done() for future in futures)
+    for i in range(20):
+        assert np.all(f["spectrum_%d" % i][()] == i), "Data should be copied when the write is queued"
+        assert f["spectrum_%d" % i].attrs['index'] == i
+        assert 'creation_timestamp' in f["spectrum_%d" % i].attrs
+    assert f["log"].shape == (20, 2)
+    assert futures[3].name == "/spectrum_3", "A DatasetFuture should behave like the dataset"
+    assert np.all(futures[3][()] == 3)
+    f.close()
+
+
+def test_async_write_errors(tmpdir, caplog):
+    f = df.DataFile(str(tmpdir.join("async_errors.h5")), async_writes=True)
+    f.create_dataset("spectrum", data=np.zeros(10))
+    future = f.create_dataset("spectrum", data=np.zeros(10), auto_increment=False)  # already exists
+    with pytest.raises(ValueError):
+        future.result()
+    assert any(r.name == "nplab.datafile" and r.levelname == "ERROR" for r in caplog.records), \
+        "Errors should be logged as they happen, in case nobody waits for the writes"
+    with pytest.raises(ValueError):
+        f.wait_until_written()
+    f.wait_until_written()  # the error is only reported once
+    f.close()
+
+
+def test_unique_names(tmpdir):
+    f = df.DataFile(str(tmpdir.join("names.h5")))
+    for i in range(5):
+        f.create_dataset("spectrum_%d", data=np.zeros(3))
+    f.create_group("spectrum")
+    assert f.find_unique_name("spectrum_%d") == "spectrum_5"
+    assert f.find_unique_name("spectrum") == "spectrum_5"
+    assert f.find_unique_name("image_%d") == "image_0"
+
+    # changes made without going through nplab (e.g. another handle) must not cause collisions
+    h5py.Group.create_dataset(f, "spectrum_5", data=np.zeros(3))
+    h5py.Group.create_dataset(f, "spectrum_6", data=np.zeros(3))
+    assert f.find_unique_name("spectrum_%d") == "spectrum_7"
+    del f["spectrum_2"]
+    assert f.find_unique_name("spectrum_%d") == "spectrum_2"
+    f.close()
+
+
+def test_numbered_items(tmpdir):
+    f = df.DataFile(str(tmpdir.join("numbered.h5")))
+    for i in range(12):
+        f.create_dataset("tile_%d", data=np.zeros(3))
+    f.create_dataset("tile", data=np.zeros(3))
+    f.create_dataset("tiles_0", data=np.zeros(3))
+    f.create_dataset("tile__20", data=np.zeros(3))
+    assert f.count_numbered_items("tile") == 13
+    assert [d.name for d in f.numbered_items("tile")] == ["/tile_%d" % i for i in range(12)] + ["/tile__20"]
+    f.close()
+
+
+def test_numbered_items_after_changes_by_another_handle(tmpdir):
+    f = df.DataFile(str(tmpdir.join("changed.h5")))
+    for i in range(5):
+        f.create_dataset("s_%d", data=np.zeros(3))
+    assert f.count_numbered_items("s") == 5
+    # delete and create items without going through nplab, so the number of items stays the same
+    h5py.Group.__delitem__(f, "s_3")
+    h5py.Group.create_dataset(f, "s_9", data=np.zeros(3))
+    assert [d.name for d in f.numbered_items("s")] == ["/s_0", "/s_1", "/s_2", "/s_4", "/s_9"]
+    h5py.Group.create_dataset(f, "s_10", data=np.zeros(3))
+    assert f.count_numbered_items("s") == 6
+    assert f.find_unique_name("s_%d") == "s_3"
+    f.close()
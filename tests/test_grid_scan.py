@@ -0,0 +1,146 @@
+"""
+Grid Scan Tests
+===============
+
+Check that pipelined grid scans visit the same points as ordinary ones.
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from nplab.experiment.scanning_experiment import GridScan
+from nplab.instrument.stage import DummyStage
+
+
+class RecordingGridScan(GridScan):
+    def __init__(self):
+        super(RecordingGridScan, self).__init__()
+        self.set_stage(DummyStage(), axes=['x1', 'y1'])
+        self.step_unit = 'nm'
+        self.size_unit = 'nm'
+        self.size[:] = 40
+        self.step[:] = 10
+        self.visited = []
+        self.processed = []
+        self.processing_threads = set()
+
+    def scan_function(self, *indices):
+        self.visited.append(indices)
+
+    def acquire(self, *indices):
+        self.visited.append(indices)
+        return np.array(self.stage.position[:2])
+
+    def process_data(self, data, *indices):
+        time.sleep(0.001)
+        self.processing_threads.add(threading.current_thread())
+        self.processed.append((indices, data))
+
+
+def run_scan(scanner):
+    scanner.scan(scanner.axes, scanner.size, scanner.step, scanner.init)
+
+
+def test_pipelined_scan_matches_serial_scan():
+    serial = RecordingGridScan()
+    run_scan(serial)
+    pipelined = RecordingGridScan()
+    pipelined.pipeline_depth = 3
+    run_scan(pipelined)
+    assert len(serial.visited) == 25
+    assert pipelined.visited == serial.visited, "The snake ordering should be the same"
+    assert [indices for indices, data in pipelined.processed] == serial.visited
+    assert threading.current_thread() not in pipelined.processing_threads
+    for indices, position in pipelined.processed:
+        # data are acquired before the stage moves on, even though processing lags behind
+        assert np.allclose(position[::-1], [ax[i] for ax, i in zip(pipelined.scan_axes, indices)])
+    assert set(pipelined.stage_timings) >= {'move', 'acquire', 'process', 'queue_wait'}
+
+
+def test_pipelined_scan_errors_abort_the_scan():
+    scanner = RecordingGridScan()
+    scanner.pipeline_depth = 2
+
+    def process_data(data, *indices):
+        raise ValueError("processing failed")
+    scanner.process_data = process_data
+    with pytest.raises(ValueError):
+        run_scan(scanner)
+    assert len(scanner.visited) < 25
+
+
+def test_each_point_is_one_stage_command():
+    scanner = RecordingGridScan()
+    stage = scanner.stage
+    commands = []
+    stage.move = lambda *args, **kwargs: commands.append(args) or DummyStage.move(stage, *args, **kwargs)
+    stage.get_position = lambda *args, **kwargs: commands.append('query') or DummyStage.get_position(stage, *args, **kwargs)
+    run_scan(scanner)
+    assert len(scanner.visited) == 25
+    assert commands.count('query') == 1, "Positions of the axes that aren't moving should come from the cache"
+    assert len(commands) == 1 + 25 + 1, "One move per point, and one back to the start"
+    del stage.move, stage.get_position  # don't leave the stage in a reference cycle
+
+
+class FlyGridScan(RecordingGridScan):
+    def __init__(self):
+        super(FlyGridScan, self).__init__()
+        self.fly_scan = True
+        self.fly_dwell = 0.01
+        self.positions = []
+
+    def scan_function(self, *indices):
+        self.visited.append(indices)
+        self.positions.append(self.fly_readback[1])
+
+
+def test_fly_scan_visits_the_same_points():
+    serial = RecordingGridScan()
+    run_scan(serial)
+    fly = FlyGridScan()
+    run_scan(fly)
+    assert fly.visited == serial.visited
+    for indices, position in zip(fly.visited, fly.positions):
+        assert np.allclose(position, [ax[i] for ax, i in zip(fly.scan_axes, indices)])
+    assert fly.fly_lagged_points == 0
+    assert not fly.stage.trajectory_running
+
+
+class SlowFlyGridScan(FlyGridScan):
+    def scan_function(self, *indices):
+        super(SlowFlyGridScan, self).scan_function(*indices)
+        time.sleep(0.03)
+
+
+def test_fly_scan_warns_when_the_stage_moves_on_during_scan_function():
+    fly = SlowFlyGridScan()
+    with pytest.warns(UserWarning, match="increase fly_dwell"):
+        run_scan(fly)
+    assert len(fly.visited) == 25
+    assert fly.fly_lagged_points >= 20, "The stage should have left almost every point before it was measured"
+
+
+class SlowStage(DummyStage):
+    def move_many(self, *args, **kwargs):
+        time.sleep(0.05)
+        super(SlowStage, self).move_many(*args, **kwargs)
+
+
+def test_fly_scan_counts_points_where_scan_function_finishes_during_the_move():
+    fly = SlowFlyGridScan()
+    fly.set_stage(SlowStage(), axes=['x1', 'y1'])
+    with pytest.warns(UserWarning, match="increase fly_dwell"):
+        run_scan(fly)
+    assert len(fly.visited) == 25
+    assert fly.fly_lagged_points >= 20, "scan_function overran the dwell time, even if the next point wasn't reached"
+
+
+def test_fly_scan_needs_a_dwell_time():
+    fly = FlyGridScan()
+    fly.fly_dwell = 0
+    with pytest.raises(ValueError):
+        run_scan(fly)
+    assert fly.visited == []
+    assert not fly.stage.trajectory_running
@@ -0,0 +1,84 @@
+"""
+HDF5 Browser Tests
+==================
+
+Check the tree model adds items a page at a time, and sorts them by timestamp in the background.
+"""
+import time
+
+import pytest
+
+import nplab.datafile as df
+from nplab.utils.gui import QtCore, get_qt_app
+from nplab.ui.hdf5_browser import HDF5ItemModel
+
+
+@pytest.fixture
+def big_file(tmpdir):
+    f = df.DataFile(str(tmpdir.join("browser.h5")))
+    g = f.create_group("group")
+    for i in range(450):
+        g.create_dataset("d_%d", data=[i])
+    f.flush()
+    yield f
+    f.close()
+
+
+def test_children_are_fetched_in_pages(big_file):
+    app = get_qt_app()
+    model = HDF5ItemModel(big_file)
+    root = QtCore.QModelIndex()
+    assert model.rowCount(root) == 0
+    assert model.canFetchMore(root)
+    model.fetchMore(root)
+    group_index = model.index(0, 0, root)
+    assert model.data(group_index, QtCore.Qt.DisplayRole) == "group"
+
+    model.fetchMore(group_index)
+    assert model.rowCount(group_index) == model.page_size
+    while model.canFetchMore(group_index):
+        model.fetchMore(group_index)
+    assert model.rowCount(group_index) == 450
+
+    item = group_index.internalPointer()
+    for i in range(100):  # wait for the background sort to finish
+        app.processEvents()
+        if item.timestamp_sorted:
+            break
+        time.sleep(0.01)
+    assert item.timestamp_sorted
+    names = [model.data(model.index(r, 0, group_index), QtCore.Qt.DisplayRole) for r in range(450)]
+    assert names == ["d_%d" % i for i in range(450)]
+
+    model.release_children(group_index)
+    assert model.rowCount(group_index) == 0
+    assert model.canFetchMore(group_index)
+
+
+def test_suitable_renderers_are_cached(tmpdir):
+    from nplab.ui import data_renderers
+    f = df.DataFile(str(tmpdir.join("renderers.h5")))
+    d = f.create_resizable_dataset("spectrum", (10, 100), maxshape=(None, 100), dtype=float)
+    first = data_renderers.suitable_renderers(d)
+    assert data_renderers.suitability_cache_key(d) in data_renderers._suitability_cache
+    assert data_renderers.suitable_renderers(d) == first
+    d.resize((20, 100))  # a change of shape should give a new key
+    assert data_renderers.suitability_cache_key(d) not in data_renderers._suitability_cache
+    f.close()
+
+
+def test_preloaded_preview(tmpdir):
+    import numpy as np
+    from nplab.ui.data_renderers import preload_dataset
+    f = df.DataFile(str(tmpdir.join("preload.h5")))
+    data = np.random.random((30, 20, 16))
+    d = f.create_dataset("cube", data=data, attrs={'wavelengths': np.arange(16)})
+    full = preload_dataset(d, block_bytes=1000)
+    assert full.name == d.name
+    assert full.file.filename == f.filename
+    assert np.all(full[()] == data)
+    preview = preload_dataset(d, step=3, block_bytes=1000)
+    assert preview.is_preview
+    assert np.all(preview[()] == data[::3, ::3, :])
+    assert np.all(preview.attrs['wavelengths'] == np.arange(16))
+    f.close()
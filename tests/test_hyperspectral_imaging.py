@@ -0,0 +1,136 @@
+"""
+Hyperspectral Imaging Tests
+===========================
+
+Check that hyperspectral scans saving only raw data store it a row at a time in the spectrometer's own dtype, and
+that processing it afterwards gives the same image as processing it during the scan.
+"""
+import gc
+
+import numpy as np
+import pytest
+
+import nplab.datafile
+from nplab.experiment.scanning_experiment import GridScan
+from nplab.experiment.hyperspectral_imaging.hyperspectral_imaging import HyperspectralScan, process_hs_image
+from nplab.instrument.spectrometer import DummySpectrometer, Spectrometer
+from nplab.instrument.stage import DummyStage
+from nplab.ui.data_renderers import HyperSpec_Alan
+
+
+class CountingSpectrometer(DummySpectrometer):
+    """A spectrometer returning integer counts, which can stop the scan after a given number of spectra."""
+    metadata_property_names = Spectrometer.metadata_property_names
+
+    def __init__(self, abort_after=None):
+        super(CountingSpectrometer, self).__init__()
+        rng = np.random.RandomState(0)
+        n = len(self.wavelengths)
+        self.background = 100 + 10*rng.random_sample(n)
+        self.reference = self.background + 1000 + rng.random_sample(n)
+        self.abort_after = abort_after
+        self.scan = None
+        self.spectra = []
+        self._rng = rng
+
+    def read_spectrum(self, bundle_metadata=False):
+        spectrum = self._rng.poisson(1000, len(self.wavelengths)).astype(np.uint16)
+        self.spectra.append(spectrum)
+        if len(self.spectra) == self.abort_after:
+            self.scan.abort_requested = True
+        return spectrum
+
+
+class RecordingHyperspectralScan(HyperspectralScan):
+    def __init__(self, spectrometer):
+        super(RecordingHyperspectralScan, self).__init__()
+        self.set_stage(DummyStage(), axes=['x1', 'y1'])
+        self.step_unit = 'nm'
+        self.size_unit = 'nm'
+        self.size[:] = 40
+        self.step[:] = 10
+        self.set_spectrometers(spectrometer)
+        spectrometer.scan = self
+        self.raw_only = True
+        self.visited = []
+
+    def process_data(self, raw_spectra, *indices):
+        self.visited.append(indices)
+        super(RecordingHyperspectralScan, self).process_data(raw_spectra, *indices)
+
+
+@pytest.fixture
+def datafile(monkeypatch):
+    monkeypatch.setattr(nplab.datafile, "_current_datafile", None)  # restored after the test
+    f = nplab.datafile.set_temporary_current_datafile()  # the scan saves to the current datafile
+    yield f
+    gc.collect()  # scans close the current datafile when they're deleted, so get that over with now
+    if f.id.valid:
+        f.close()
+
+
+def run_scan(spectrometer):
+    scan = RecordingHyperspectralScan(spectrometer)
+    GridScan.run(scan)  # in a thread as usual, but without the Qt timer that updates the GUI
+    scan.acquisition_thread.join()
+    return scan
+
+
+def test_raw_data_saved_a_row_at_a_time_in_native_dtype(datafile):
+    spectrometer = CountingSpectrometer()
+    scan = run_scan(spectrometer)
+    raw = scan.data['raw_data/hs_image']
+    assert 'hs_image' not in scan.data
+    assert scan.data.attrs['raw_only']
+    assert raw.dtype == np.uint16
+    assert raw.shape == (5, 5, len(spectrometer.wavelengths))
+    assert raw.chunks == (1, 5, len(spectrometer.wavelengths)), "There should be one chunk per scan line"
+    assert len(scan.visited) == 25
+    for indices, spectrum in zip(scan.visited, spectrometer.spectra):
+        assert np.array_equal(raw[indices], spectrum)
+
+
+def test_partial_row_saved_at_close(datafile):
+    spectrometer = CountingSpectrometer(abort_after=13)  # two full rows, and three points of the third
+    scan = run_scan(spectrometer)
+    raw = scan.data['raw_data/hs_image']
+    assert len(scan.visited) == 13
+    assert len(set(i for i, j in scan.visited[10:])) == 1, "The last three points should be in one row"
+    for indices, spectrum in zip(scan.visited, spectrometer.spectra):
+        assert np.array_equal(raw[indices], spectrum)
+    missed = np.ones(raw.shape[:2], dtype=bool)
+    missed[tuple(np.transpose(scan.visited))] = False
+    assert np.all(raw[...][missed] == 0)
+    assert np.all(np.isnan(scan._live_views[0][missed])), "Points we didn't reach shouldn't be in the live view"
+
+
+def test_processing_raw_data_matches_spectrometer(datafile):
+    spectrometer = CountingSpectrometer()
+    scan = run_scan(spectrometer)
+    raw = scan.data['raw_data/hs_image']
+    processed = process_hs_image(raw)
+    for indices, spectrum in zip(scan.visited, spectrometer.spectra):
+        assert np.allclose(processed[indices], spectrometer.process_spectrum(spectrum))
+    assert np.allclose(process_hs_image(raw, wavelength_index=7), processed[..., 7])
+
+
+def test_live_view_kept_in_memory(datafile):
+    spectrometer = CountingSpectrometer()
+    scan = run_scan(spectrometer)
+    processed = process_hs_image(scan.data['raw_data/hs_image'])
+    w = scan._live_view_indices[0]
+    assert spectrometer.wavelengths[w] == scan.view_wavelength
+    assert np.allclose(scan._live_views[0], processed[..., w])
+    # changing the view wavelength reloads the live view from the file
+    scan.view_wavelength = 650
+    view = scan.set_latest_view(*scan.visited[-1])[0]
+    w = scan._live_view_indices[0]
+    assert spectrometer.wavelengths[w] == 650
+    assert np.allclose(view, processed[..., w])
+
+
+def test_renderer_processes_raw_only_scans(datafile):
+    scan = run_scan(CountingSpectrometer())
+    assert HyperSpec_Alan.hs_image_name(scan.data) == 'raw_data/hs_image'
+    assert HyperSpec_Alan.is_suitable(scan.data) > 0
+    assert np.allclose(HyperSpec_Alan.load_hs_image(scan.data), process_hs_image(scan.data['raw_data/hs_image']))
@@ -35,6 +35,36 @@ def test_metadata_slicing():
     assert np.all(sliced_iwl.datum_location == sample_iwl.datum_location), \
         "The position shift was incorrect for step==2"
 
+def shifted_frame(texture, dy, dx, size=512):
+    """Crop a frame out of a texture, shifted by a fraction of a pixel."""
+    import cv2
+    shift = np.float32([[1, 0, dx], [0, 1, dy]])
+    shifted = cv2.warpAffine(texture, shift, texture.shape[::-1], flags=cv2.INTER_LINEAR)
+    return shifted[50:50 + size, 50:50 + size]
+
+
+def test_feature_tracker():
+    import cv2
+    from nplab.utils.image_with_location import FeatureTracker, locate_feature_in_image
+    texture = cv2.GaussianBlur(np.random.RandomState(0).random_sample((612, 612)).astype(np.float32), (0, 0), 2)
+    texture = (255 * (texture - texture.min()) / np.ptp(texture)).astype(np.uint8)
+    first = shifted_frame(texture, 0, 0)
+    feature = ImageWithLocation(first[206:306, 206:306])  # datum pixel (49, 49) is at (255, 255) in the frame
+    tracker = FeatureTracker(feature, margin=20)
+    assert np.allclose(tracker.locate(first), [255, 255], atol=0.1)
+    for dy, dx in [(1.3, -0.6), (4.5, 2.25), (7.0, 5.5)]:
+        frame = shifted_frame(texture, dy, dx)
+        position = tracker.locate(frame)
+        assert np.allclose(position, [255 + dy, 255 + dx], atol=0.3)
+        assert not tracker.used_full_search
+    assert np.allclose(position, locate_feature_in_image(frame, feature), atol=1)
+
+    # if we predict the wrong place, it should fall back to searching the whole image
+    position = tracker.locate(frame, predicted_position=(100, 400))
+    assert tracker.used_full_search
+    assert np.allclose(position, [262, 260.5], atol=0.3)
+
+
 if __name__ == "__main__":
     try:
         test_metadata_slicing()
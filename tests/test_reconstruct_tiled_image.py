@@ -0,0 +1,122 @@
+"""
+Tiled Image Reconstruction Tests
+================================
+
+Check the particle tracking app stitches tiles back together, in memory and into an HDF5 pyramid.
+"""
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import nplab.datafile as df
+from nplab.utils.array_with_attrs import ArrayWithAttrs
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), "..", "nplab", "Lab1_BX-60 Local Python Scripts",
+                           "particle_tracking_app", "particle_tracking_app", "reconstruct_tiled_image.py")
+
+
+@pytest.fixture(scope="module")
+def rti():
+    """Import the module by path, as its folder isn't a package."""
+    spec = importlib.util.spec_from_file_location("reconstruct_tiled_image", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # so worker processes can find its functions
+    spec.loader.exec_module(module)
+    yield module
+    del sys.modules[spec.name]
+
+
+def make_tiles(n=3, size=200, step=170, error=1.5):
+    """Cut a random image into overlapping tiles, with (zero mean) errors in their recorded positions."""
+    rng = np.random.RandomState(0)
+    errors = rng.uniform(-error, error, (n*n, 2))
+    errors -= np.mean(errors, axis=0)
+    scene = ndimage.gaussian_filter(rng.random_sample((step*(n-1)+size, step*(n-1)+size, 3)), (3, 3, 0))
+    scene = ((scene - scene.min())/np.ptp(scene)*255).astype(np.uint8)
+    tiles = []
+    for i in range(n):
+        for j in range(n):
+            tile = ArrayWithAttrs(scene[i*step:i*step+size, j*step:j*step+size].copy())
+            M = np.identity(4)
+            M[3, :2] = [i*step, j*step] + errors[len(tiles)]
+            M[3, 2] = 0
+            tile.attrs['pixel_to_sample_matrix'] = M
+            tiles.append(tile)
+    return scene, tiles
+
+
+def test_parallel_correlation_matches_serial(rti):
+    scene, tiles = make_tiles()
+    positions, centre = rti.get_pixel_positions(tiles)
+    pairs = rti.find_overlapping_pairs(positions, tiles[0].shape[:2])
+    assert len(pairs) == 12
+    serial = rti.croscorrelate_overlapping_images(tiles, pairs, positions, processes=1)
+    parallel = rti.croscorrelate_overlapping_images(tiles, pairs, positions, processes=2)
+    assert np.allclose(serial, parallel)
+    truth = np.array([[i*170, j*170] for i in range(3) for j in range(3)], dtype=float)
+    assert np.allclose(serial, rti.pair_displacements(pairs, truth), atol=0.5)
+
+    solved = rti.solve_positions(pairs, positions, serial)
+    assert rti.rms_error(pairs, solved, serial) < 0.1
+    assert np.allclose(np.mean(solved, axis=0), np.mean(positions, axis=0))
+
+
+def test_stitched_image_matches_the_original(rti):
+    scene, tiles = make_tiles()
+    stitched = rti.reconstruct_tiled_image(tiles, processes=1)
+    assert stitched.shape == scene.shape
+    assert np.all(np.asarray(stitched) == scene)
+    assert stitched.pixel_to_sample_matrix.shape == (4, 4)
+
+
+def test_pyramid_is_written_to_the_file(rti, tmpdir):
+    scene, tiles = make_tiles()
+    f = df.DataFile(str(tmpdir.join("stitched.h5")))
+    try:
+        in_memory = rti.reconstruct_tiled_image(tiles, processes=1)
+        group = f.create_group("pyramid")
+        level_0 = rti.reconstruct_tiled_image(tiles, output_group=group, processes=1)
+        assert group.attrs['levels'] == 2
+        assert level_0.chunks == (256, 256, 3)
+        assert np.all(level_0[()] == scene)
+        smaller = rti.load_pyramid_level(group, max_size=300)
+        assert smaller.shape == (270, 270, 3)
+        # the datum pixel should still be in the same place on the sample
+        assert np.allclose(smaller.datum_location, in_memory.datum_location)
+        assert np.abs(smaller.astype(float) - scene[::2, ::2]).mean() < 10
+
+        small_group = f.create_group("small_chunks")
+        levels = rti.write_tiled_image_pyramid(tiles, rti.get_pixel_positions(tiles)[0], small_group,
+                                               dict(in_memory.attrs), chunk_size=64, min_size=150, block_size=100)
+        assert [level.shape[0] for level in levels] == [540, 270, 135]
+        assert levels[0].chunks == (64, 64, 3)
+        assert np.all(levels[2][()] == rti.load_pyramid_level(small_group, max_size=150))
+    finally:
+        f.close()
+
+
+def test_pyramid_level_is_read_a_piece_at_a_time(rti, tmpdir):
+    scene, tiles = make_tiles()
+    f = df.DataFile(str(tmpdir.join("stitched.h5")))
+    try:
+        in_memory = rti.reconstruct_tiled_image(tiles, processes=1)
+        rti.reconstruct_tiled_image(tiles, output_group=f.create_group("pyramid"), processes=1)
+        level = rti.PyramidLevel(f["pyramid"])
+        assert level.shape == scene.shape
+        assert np.allclose(level.pixel_to_location((10, 20)), in_memory.pixel_to_location((10, 20)))
+        feature = level.feature_at((100, 150), size=(40, 40))
+        assert np.all(np.asarray(feature) == scene[80:120, 130:170])
+        assert np.allclose(feature.datum_location, in_memory.pixel_to_location((100, 150)))
+        covered = np.zeros(scene.shape[:2], dtype=int)
+        for image, (u0, v0, u1, v1) in level.blocks(block_size=200, margin=30):
+            covered[u0:u1, v0:v1] += 1
+            assert np.all(np.asarray(image) == scene[max(u0 - 30, 0):u1 + 30, max(v0 - 30, 0):v1 + 30])
+            assert np.allclose(image.pixel_to_location((0, 0)),
+                               in_memory.pixel_to_location((max(u0 - 30, 0), max(v0 - 30, 0))))
+        assert np.all(covered == 1)
+    finally:
+        f.close()
@@ -0,0 +1,47 @@
+"""
+Serial Instrument Tests
+=======================
+
+Check the buffered line reader, using pyserial's loopback device.
+"""
+from nplab.instrument.serial_instrument import SerialInstrument
+
+
+class LoopbackInstrument(SerialInstrument):
+    port_settings = {'timeout': 0.05}
+    termination_character = "\r\n"
+
+
+def test_pipelined_replies_are_read_line_by_line():
+    instrument = LoopbackInstrument('loop://')
+    try:
+        instrument.ser.write(b"reply 0\r\nreply 1\r\nreply 2")
+        assert instrument.readline() == "reply 0\n"
+        assert instrument.ser.in_waiting == 0, "Everything waiting should be read in one go"
+        assert instrument.readline() == "reply 1\n", "Bytes after the end of a line should be kept"
+        instrument.ser.write(b" contin")
+        assert instrument.readline() == "reply 2 contin", "A partial line should be returned when the port times out"
+        instrument.ser.write(b"ued\r\n")
+        assert instrument.readline() == "ued\n"
+        assert instrument.readline() == ""
+
+        instrument.ser.write(b"stale reply\r\nfresh")
+        assert instrument.readline() == "stale reply\n"
+        instrument.flush_input_buffer()
+        assert instrument.readline() == "", "Flushing should discard buffered replies"
+    finally:
+        instrument.close()
+
+
+def test_termination_characters():
+    instrument = LoopbackInstrument('loop://')
+    try:
+        instrument.ser.write(b"a long line " * 300 + b"\r\n")
+        assert instrument.readline() == "a long line " * 300 + "\n"
+        instrument.termination_character = "\r"
+        instrument.termination_read = "\r"
+        instrument.ser.write(b"split\rend\r")
+        assert instrument.readline() == "split\n"
+        assert instrument.readline() == "end\n"
+    finally:
+        instrument.close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Server instrument tests
+=======================
+
+Runs a server and client for a trivial instrument on the loopback interface, and checks that arrays survive the
+round trip with both the binary and the text protocols.
+"""
+import pytest
+import time
+import numpy as np
+
+from nplab.instrument import Instrument
+from nplab.instrument.server_instrument import create_server_class, create_client_class, encode_binary, \
+    decode_binary, binary_magic, binary_header, get_connection, close_connections
+from nplab.utils.array_with_attrs import ArrayWithAttrs
+
+
+class ArrayInstrument(Instrument):
+    gain = 2
+
+    def frame(self, shape=(64, 48)):
+        return np.arange(np.prod(shape), dtype=np.uint16).reshape(shape)
+
+    def spectrum(self):
+        return ArrayWithAttrs(np.linspace(0, 1, 100), attrs=dict(integration_time=10, label='dummy'))
+
+    def scale(self, value):
+        return value * self.gain
+
+    def wait(self, duration):
+        time.sleep(duration)
+        return duration
+
+    def fail(self):
+        raise ValueError("failed on purpose")
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = create_server_class(ArrayInstrument)(('localhost', 0))
+    server.run(with_gui=False, backgrounded=True)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('binary_transport', [True, False])
+def test_round_trip(server, binary_transport):
+    client = create_client_class(ArrayInstrument)(server.server_address, binary_transport=binary_transport)
+    assert client.binary_transport == binary_transport
+
+    frame = client.frame((64, 48))
+    assert frame.shape == (64, 48)
+    assert np.all(frame == ArrayInstrument().frame((64, 48)))
+
+    spectrum = client.spectrum()
+    assert isinstance(spectrum, ArrayWithAttrs)
+    assert spectrum.attrs['label'] == 'dummy'
+    assert np.allclose(spectrum, np.linspace(0, 1, 100))
+
+    assert client.scale(3) == 6
+    client.gain = 5
+    assert client.gain == 5
+    client.gain = 2
+
+
+def test_binary_keeps_dtype(server):
+    client = create_client_class(ArrayInstrument)(server.server_address)
+    assert client.frame().dtype == np.uint16
+
+
+def test_encode_decode():
+    array = np.random.random((3, 4, 5)).astype(np.float32)
+    frame, payload = encode_binary(array, 7)
+    assert frame.startswith(binary_magic)
+    request_id, header_length, payload_length = binary_header.unpack(
+        frame[len(binary_magic):len(binary_magic) + binary_header.size])
+    assert request_id == 7
+    assert payload_length == array.nbytes
+    decoded = decode_binary(frame[len(binary_magic) + binary_header.size:], bytearray(payload))
+    assert decoded.dtype == array.dtype
+    assert np.all(decoded == array)
+
+    frame, payload = encode_binary({'a': [1, 2.5, 'three']})
+    assert len(payload) == 0
+    assert decode_binary(frame[len(binary_magic) + binary_header.size:], payload) == {'a': [1, 2.5, 'three']}
+
+
+def test_persistent_connection(server):
+    client = create_client_class(ArrayInstrument)(server.server_address)
+    connection = get_connection(server.server_address)
+    for i in range(20):
+        assert client.scale(i) == 2 * i
+    assert get_connection(server.server_address) is connection, "Calls should reuse the pooled connection"
+    with pytest.raises(RuntimeError):
+        client.fail()
+    assert client.scale(1) == 2, "The connection should survive a server-side error"
+
+
+def test_pipelined_requests(server):
+    client = create_client_class(ArrayInstrument)(server.server_address)
+    futures = [client.call_async('scale', i) for i in range(50)]
+    assert [f.result(timeout=5) for f in futures] == [2 * i for i in range(50)]
+
+    server.concurrent_requests = True
+    try:
+        slow = client.call_async('wait', 0.5)
+        fast = client.call_async('wait', 0.01)
+        assert fast.result(timeout=5) == 0.01
+        assert not slow.done(), "Replies should be able to arrive out of order"
+        assert slow.result(timeout=5) == 0.5
+    finally:
+        server.concurrent_requests = False
+
+
+def test_connection_pool_reconnects(server):
+    client = create_client_class(ArrayInstrument)(server.server_address)
+    close_connections()
+    assert client.scale(2) == 4
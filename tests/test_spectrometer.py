@@ -0,0 +1,293 @@
+"""
+Spectrometer Tests
+==================
+
+Check background subtraction and referencing of spectra, singly and in blocks, averaging, and
+synchronised acquisition from several spectrometers.
+"""
+import threading
+
+import numpy as np
+import pytest
+
+import nplab.datafile
+from nplab.instrument.spectrometer import DummySpectrometer, Spectrometers
+from nplab.instrument.spectrometer.accumulators import (BoxcarAccumulator, ExponentialAccumulator,
+                                                         WelfordAccumulator)
+from nplab.instrument.spectrometer.group_acquisition import GroupAcquisition
+from nplab.instrument.spectrometer.time_series import TimeSeries
+
+
+@pytest.fixture(scope='module', autouse=True)
+def datafile():
+    f = nplab.datafile.set_temporary_current_datafile()  # the spectrometer wants a datafile, don't pop up a dialog
+    yield f
+    f.close()
+
+
+@pytest.fixture
+def spectrometer():
+    spectrometer = DummySpectrometer()
+    rng = np.random.RandomState(0)
+    n = len(spectrometer.wavelengths)
+    spectrometer.background_constant = rng.random_sample(n)
+    spectrometer.background_gradient = rng.random_sample(n)
+    spectrometer.background_int = spectrometer.reference_int = 10
+    spectrometer.background = spectrometer.background_constant + 10*spectrometer.background_gradient
+    spectrometer.reference = spectrometer.background + 1 + rng.random_sample(n)
+    spectrometer.reference[5] = spectrometer.background[5]  # no light at this pixel
+    return spectrometer
+
+
+def test_processing_matches_the_formula(spectrometer):
+    s = spectrometer
+    spectrum = np.random.random_sample(len(s.wavelengths)) * 5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = (spectrum - s.background)/(s.reference - s.background)
+    expected[np.isinf(expected)] = np.nan
+    processed = s.process_spectrum(spectrum)
+    assert np.isnan(processed[5])
+    assert np.allclose(processed, expected, equal_nan=True)
+
+    s.variable_int_enabled = True
+    s.integration_time = 20
+    background = s.background_constant + s.background_gradient*20
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = ((spectrum - background)
+                    / ((s.reference - (s.background_constant + s.background_gradient*10))*20/10))
+    expected[np.isinf(expected)] = np.nan
+    assert np.allclose(s.process_spectrum(spectrum), expected, equal_nan=True)
+
+    s.reference = None
+    assert np.allclose(s.process_spectrum(spectrum), spectrum - background)
+    s.absorption_enabled = True
+    spectrum += 30  # brighter than the background, so the absorbance is defined
+    assert np.allclose(s.process_spectrum(spectrum), np.log10(1/(spectrum - background)))
+
+
+def test_corrections_are_cached(spectrometer):
+    s = spectrometer
+    offset, gain = s.get_correction_coefficients()
+    assert s.get_correction_coefficients()[1] is gain
+    s.integration_time = 20  # only matters with variable integration time
+    assert s.get_correction_coefficients()[1] is gain
+    s.variable_int_enabled = True
+    variable_offset = s.get_correction_coefficients()[0]
+    assert not np.allclose(variable_offset, offset)
+    s.integration_time = 30
+    assert np.allclose(s.get_correction_coefficients()[0], s.background_constant + 30*s.background_gradient)
+    s.background = None
+    assert s.get_correction_coefficients() == (None, None)
+
+
+def test_blocks_of_spectra(spectrometer):
+    s = spectrometer
+    spectra = np.random.random_sample((7, len(s.wavelengths)))
+    expected = np.array([s.process_spectrum(spectrum) for spectrum in spectra])
+    assert np.allclose(s.process_spectrum(spectra), expected, equal_nan=True)
+    out = np.empty_like(spectra)
+    assert s.process_spectrum(spectra, out=out) is out
+    assert np.allclose(out, expected, equal_nan=True)
+    counts = (spectra*1000).astype(np.uint16)
+    assert np.allclose(s.process_spectrum(counts), s.process_spectrum(counts.astype(float)), equal_nan=True)
+
+    spectrometers = Spectrometers([s, DummySpectrometer()])
+    processed = spectrometers.process_spectra([spectra[0], spectra[1]])
+    assert np.allclose(processed[0], expected[0], equal_nan=True)
+    assert np.allclose(processed[1], spectra[1])
+
+
+def test_time_series_is_streamed_to_the_file(spectrometer, tmpdir):
+    f = nplab.datafile.DataFile(str(tmpdir.join("time_series.h5")))
+    try:
+        spectrometer.integration_time = 1
+        series = TimeSeries(spectrometer, num_spectra=10, interval=20, group=f, buffer_rows=4)
+        progress = []
+        dataset = series.run(update_progress=progress.append)
+        assert dataset.shape == (10, len(spectrometer.wavelengths))
+        assert progress == list(range(11))
+        times = f[dataset.attrs['times']][()]
+        assert np.all(times == dataset.attrs['start times'])
+        # spectra are started on a fixed schedule, so the times don't drift
+        assert series.missed_deadlines == 0
+        assert np.all(np.abs(times - 0.02*np.arange(10)) < 0.015)
+        assert np.allclose(series.statistics.mean, np.mean(dataset[()], axis=0))
+        assert np.all(series.statistics.minimum == np.min(dataset[()], axis=0))
+        assert np.all(series.statistics.maximum == np.max(dataset[()], axis=0))
+    finally:
+        f.close()
+
+
+def test_time_series_keeps_up_when_reading_takes_the_whole_interval(spectrometer):
+    spectrometer.integration_time = 20  # so the default interval (with no delay) is the time taken to read
+    dataset = spectrometer.time_series(num_spectra=10, delay=0)
+    times = dataset.attrs['start times']
+    # each spectrum should start as soon as the last one finishes, not wait for the slot after next; overheads can
+    # add up to a whole slot by the end, but shouldn't make every reading miss its deadline
+    assert dataset.attrs['missed deadlines'] <= 2
+    assert np.all(np.diff(times) < 0.03)
+    assert times[-1] < 0.25
+
+
+def test_indefinite_time_series_can_be_stopped(spectrometer):
+    spectrometer.integration_time = 1
+    stop = threading.Event()
+    threading.Timer(0.2, stop.set).start()
+    dataset = spectrometer.time_series(num_spectra=0, delay=0, stop_event=stop)
+    assert dataset.shape[0] == dataset.attrs['number of spectra'] > 1
+    assert spectrometer.current_time_series.statistics.count == dataset.shape[0]
+
+
+def test_accumulators_match_numpy():
+    rng = np.random.RandomState(1)
+    spectra = 1000 + rng.normal(size=(23, 50))
+    boxcar, welford = BoxcarAccumulator(5), WelfordAccumulator(5)
+    for i, spectrum in enumerate(spectra):
+        boxcar.add(spectrum)
+        welford.add(spectrum)
+        window = spectra[max(0, i - 4):i + 1]
+        assert np.allclose(boxcar.mean, np.mean(window, axis=0))
+        assert np.allclose(boxcar.spectra(), window)
+        assert np.allclose(welford.mean, np.mean(spectra[:i + 1], axis=0))
+        if i > 0:
+            assert np.allclose(boxcar.variance, np.var(window, axis=0, ddof=1))
+            assert np.allclose(welford.variance, np.var(spectra[:i + 1], axis=0, ddof=1))
+    assert boxcar.full and boxcar.count == 5 and welford.count == 23
+    assert np.allclose(boxcar.standard_error, np.std(spectra[-5:], axis=0, ddof=1)/np.sqrt(5))
+
+    ema = ExponentialAccumulator(3)
+    expected = spectra[0]
+    for spectrum in spectra:
+        ema.add(spectrum)
+    for spectrum in spectra[1:]:
+        expected = expected + 0.5*(spectrum - expected)
+    assert np.allclose(ema.mean, expected)
+    ema.window = 4
+    assert ema.count == 0 and ema.mean is None and not ema.full
+
+
+def test_averaged_spectra_are_read_and_saved(spectrometer):
+    s = spectrometer
+    s.integration_time = 1
+    s.averaging_enabled = True
+    s.number_of_averages = 4
+    reads = []
+    read_spectrum = s.read_spectrum
+    s.read_spectrum = lambda: reads.append(1) or read_spectrum()
+    try:
+        average = s.read_averaged_spectrum()
+        assert len(reads) == 4
+        assert np.allclose(average, np.mean(s.accumulator.spectra(), axis=0))
+        s.read_processed_spectrum()  # a rolling average only needs one new spectrum
+        assert len(reads) == 5
+        s.save_spectrum()
+        assert len(reads) == 5
+        dataset = s.get_root_data_folder()[s.filename + '_0']
+        assert dataset.shape == (4, len(s.wavelengths))
+        assert dataset.attrs['number of averages'] == 4
+        assert np.allclose(dataset.attrs['noise'], np.std(dataset[()], axis=0, ddof=1)/2)
+        s.read_averaged_spectrum(new_deque=True)  # as for a background or reference
+        assert len(reads) == 9
+    finally:
+        del s.read_spectrum
+
+
+class TriggeredSpectrometer(DummySpectrometer):
+    """A spectrometer that waits for an external trigger once it's armed."""
+    def __init__(self):
+        super(TriggeredSpectrometer, self).__init__()
+        self.triggered = threading.Event()
+        self.armed = False
+
+    def arm_acquisition(self, external_trigger=False):
+        self.armed = external_trigger
+
+    def disarm_acquisition(self):
+        self.armed = False
+
+    def read_spectrum(self, bundle_metadata=False):
+        if self.armed:
+            assert self.triggered.wait(5), "The trigger never came"
+            self.triggered.clear()
+        return super(TriggeredSpectrometer, self).read_spectrum()
+
+
+def test_synchronised_acquisition():
+    vis, nir = DummySpectrometer(), DummySpectrometer()
+    vis.integration_time, nir.integration_time = 5, 20
+    spectrometers = Spectrometers([vis, nir])
+    record = spectrometers.read_synchronised_spectra(timeout=5)
+    assert record['spectrum_0'].shape == record['spectrum_1'].shape == (len(vis.wavelengths),)
+    assert record['start_0'] < record['end_0'] < record['end_1']
+    assert record['end_1'] - record['start_1'] >= 0.02
+    assert record['skew'] == abs(record['start_1'] - record['start_0']) < 0.02
+
+    group = spectrometers.save_synchronised_spectra(num_acquisitions=5, timeout=5)
+    assert group['spectrum_0'].shape == (5, len(vis.wavelengths))
+    assert group['spectrum_1'].attrs['integration_time'] == 20
+    timing = group['timing'][()]
+    assert np.all(np.diff(timing['time']) > 0.02)
+    assert np.all(timing['end_1'] >= timing['start_1'] + 0.02)
+    assert group.attrs['count'] == 5
+    assert 0 < group.attrs['throughput'] < 50
+    assert group.attrs['max skew'] == np.max(timing['skew'])
+    with pytest.raises(NotImplementedError):
+        spectrometers.read_synchronised_spectra(trigger=lambda: None)
+
+
+def test_synchronised_acquisition_with_a_trigger():
+    spectrometers = [TriggeredSpectrometer(), TriggeredSpectrometer()]
+    for s in spectrometers:
+        s.integration_time = 1
+
+    def trigger():
+        for s in spectrometers:
+            s.triggered.set()
+    with Spectrometers(spectrometers).synchronised_acquisition(trigger=trigger, timeout=5) as acquisition:
+        assert all(s.armed for s in spectrometers)
+        for i in range(3):
+            record = acquisition.acquire()
+        assert acquisition.statistics.count == 3
+    assert not any(s.armed for s in spectrometers)
+    assert record['end_0'] > record['time'] and record['end_1'] > record['time']
+
+    spectrometers[0].triggered.clear()
+    acquisition = GroupAcquisition(spectrometers, trigger=lambda: None, timeout=0.1)
+    with pytest.raises(IOError):
+        acquisition.acquire()
+    assert not acquisition.armed
+
+
+class BlockingSpectrometer(DummySpectrometer):
+    """A spectrometer whose reads wait until they're released, and which checks they don't overlap."""
+    def __init__(self):
+        super(BlockingSpectrometer, self).__init__()
+        self.integration_time = 1
+        self.release = threading.Event()
+        self.reading = threading.Lock()
+        self.overlapping_reads = 0
+
+    def read_spectrum(self, bundle_metadata=False):
+        if not self.reading.acquire(blocking=False):
+            self.overlapping_reads += 1
+            return super(BlockingSpectrometer, self).read_spectrum()
+        try:
+            self.release.wait(5)
+            return super(BlockingSpectrometer, self).read_spectrum()
+        finally:
+            self.reading.release()
+
+
+def test_synchronised_acquisition_waits_for_reads_that_timed_out():
+    spectrometer = BlockingSpectrometer()
+    acquisition = GroupAcquisition([spectrometer], timeout=0.05)
+    with pytest.raises(IOError):
+        acquisition.acquire()  # the spectrometer is stuck
+    with pytest.raises(IOError, match="still busy"):
+        acquisition.acquire()  # and still stuck, so we mustn't start another read
+    assert not acquisition.armed
+    spectrometer.release.set()
+    record = acquisition.acquire()
+    acquisition.disarm()
+    assert record['spectrum_0'].shape == spectrometer.wavelengths.shape
+    assert spectrometer.overlapping_reads == 0
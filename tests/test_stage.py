@@ -0,0 +1,136 @@
+"""
+Stage Tests
+===========
+
+Check the position cache and multi-axis moves of the Stage base class.
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from nplab.instrument.stage import Stage, DummyStage
+
+
+class CountingStage(Stage):
+    """A stage that can only make moves of all three axes, and counts its commands."""
+    def __init__(self):
+        super(CountingStage, self).__init__()
+        self._position = np.zeros(3)
+        self.moves = 0
+        self.queries = 0
+
+    def move(self, pos, axis=None, relative=False):
+        assert axis is None, "This stage can only move all its axes at once"
+        self.moves += 1
+        if relative:
+            self._position += pos
+        else:
+            self._position[:] = pos
+
+    def get_position(self, axis=None):
+        self.queries += 1
+        if axis is None:
+            return self._position.copy()
+        return self.get_axis_param(lambda ax: self._position[self.axis_names.index(ax)], axis)
+
+    def home(self):
+        self._position[:] = 0  # a raw command to the controller, which doesn't go through move
+
+
+def test_moves_use_the_position_cache():
+    stage = CountingStage()
+    stage.move_axis(1.0, 'x')
+    assert stage.queries == 1, "The first move should read the position of the other axes"
+    stage.move_many({'y': 2.0, 'z': 3.0})
+    stage.move_axis(0.5, 'x', relative=True)
+    assert stage.moves == 3
+    assert stage.queries == 1
+    assert np.all(stage.cached_position() == [1.5, 2.0, 3.0])
+    assert stage.cached_position('y') == 2.0
+    assert np.all(stage._position == [1.5, 2.0, 3.0])
+    with pytest.raises(ValueError):
+        stage.move_many({'w': 1.0})
+
+    stage.move([0, 0, 0])  # a direct move, which the cache can't track
+    stage.move_axis(4.0, 'z')
+    assert stage.queries == 2
+    assert np.all(stage._position == [0, 0, 4.0])
+
+
+def test_homing_between_moves_invalidates_the_position_cache():
+    stage = CountingStage()
+    stage.move_many({'x': 1.0, 'y': 2.0})
+    stage.home()
+    stage.move_axis(5.0, 'z')
+    assert np.all(stage._position == [0, 0, 5.0]), "Axes we didn't move shouldn't go back to where they were"
+    assert stage.queries == 2
+
+
+def test_position_cache_expires():
+    stage = CountingStage()
+    stage.position_cache_max_age = 0.05
+    stage.move_many({'x': 1.0, 'y': 2.0})
+    stage._position[1] = 3.0  # e.g. moved with a joystick
+    time.sleep(0.1)
+    stage.move_axis(5.0, 'z')
+    assert np.all(stage._position == [1.0, 3.0, 5.0])
+    assert stage.queries == 2
+
+
+def test_dummy_stage_moves_many_axes():
+    stage = DummyStage()
+    stage.move_many({'x1': 1.0, 'y2': 2.0})
+    assert stage.position == (1.0, 0, 0, 0, 2.0, 0)
+    stage.move_axis(1.0, 'y2', relative=True)
+    assert stage.cached_position('y2') == 3.0 == stage.get_position('y2')
+
+
+def test_wait_until_stopped_with_notification():
+    stage = CountingStage()
+    stage.stop_notification = True
+    stage.move_many({'x': 1.0})
+    threading.Timer(0.05, stage.notify_stopped, kwargs={'positions': {'x': 0.99}}).start()
+    stage.wait_until_stopped(timeout=5)
+    assert stage.cached_position('x') == 0.99
+    stage.move_many({'x': 2.0})
+    with pytest.raises(IOError):
+        stage.wait_until_stopped(timeout=0.01)
+
+
+def test_emulated_trajectory_readback():
+    stage = DummyStage()
+    assert not stage.trajectory_stop_requested, "There's nothing to stop before a trajectory has started"
+    points = [[0, 1], [1, 1], [1, 2]]
+    stage.load_trajectory(points, dwell=0.01, axes=('x1', 'y1'))
+    stage.start_trajectory()
+    reached = [(index, position) for index, t, position in stage.iter_trajectory_readback(timeout=5)]
+    stage.wait_for_trajectory(timeout=5)
+    assert [index for index, position in reached] == [0, 1, 2]
+    assert np.allclose([position for index, position in reached], points)
+    assert stage.get_position('y1') == 2
+    indices, times, positions = stage.get_trajectory_readback()
+    assert np.all(np.diff(times) >= 0.01), "The stage should dwell at each point"
+    assert np.allclose(stage.trajectory_position_at(times[1] + 0.25*(times[2] - times[1])), [1, 1.25])
+    for i in range(2):
+        assert times[i] + 0.01 <= stage.trajectory_departure_time(i) <= times[i + 1]
+    assert stage.trajectory_departure_time(2) is None, "The stage stays at the last point"
+    with pytest.raises(ValueError):
+        stage.load_trajectory(points, axes=('x1',))
+
+
+def test_trajectory_can_be_stopped_and_reads_back_the_position():
+    stage = CountingStage()
+    stage.trajectory_readback = True
+    stage.load_trajectory(np.arange(100.0), dwell=0.01, axes=('z',))
+    stage.start_trajectory()
+    assert stage.trajectory_running
+    for index, t, position in stage.iter_trajectory_readback(timeout=5):
+        if index == 2:
+            stage.stop_trajectory(timeout=5)
+    assert not stage.trajectory_running
+    indices, times, positions = stage.get_trajectory_readback()
+    assert 3 <= len(indices) < 100
+    assert np.allclose(positions[:, 0], indices)
+    assert stage.queries == len(indices) + 1